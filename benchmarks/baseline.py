@@ -0,0 +1,169 @@
+'''
+Measures the hot paths of the proxy against a local DICOMweb stand-in (see harness.py and dicomweb_standin.py):
+- find_studies: C-find answers/second of a STUDY-level query returning all the studies
+- move_instance, move_chunk, move_transit: C-move instances/second and peak python memory of a study
+  with the 'Instance' and 'Chunk' retrieve modes and in transit mode
+
+Each scenario is run '--runs' times and the best throughput is kept, to absorb the noise of the machine.
+The peak memory is measured with tracemalloc in an additional run, so that it does not slow down the throughput
+measurement.
+
+usage:
+    python3 benchmarks/baseline.py                                  # prints the results
+    python3 benchmarks/baseline.py --save benchmarks/baselines/local.json
+    python3 benchmarks/baseline.py --compare benchmarks/baselines/local.json --tolerance 0.2
+
+With --compare, the script exits with 1 if a throughput is lower or a peak memory is higher than the baseline
+by more than the tolerance.  The baselines depend on the machine: compare with a baseline saved on the same one.
+'''
+import argparse
+import json
+import pathlib
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here))
+
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunFind, RunMove
+
+FIND_QUERY = [
+    (0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+    (0x0008, 0x0020, 'StudyDate', ''),
+    (0x0008, 0x0050, 'AccessionNumber', ''),
+    (0x0010, 0x0010, 'PatientName', ''),
+    (0x0010, 0x0020, 'PatientID', ''),
+    (0x0020, 0x000D, 'StudyInstanceUID', '')
+]
+
+MOVE_SCENARIOS = {
+    "move_instance": {"RetrieveMode": "Instance"},
+    "move_chunk": {"RetrieveMode": "Chunk"},
+    "move_transit": {"TransitMode": True}
+}
+
+
+def MeasureFind(args):
+    with DicomWebStandIn(studies=args.studies) as standin:
+        simulated = SimulatedOrthanc()
+        simulated.add_dicomweb_server("PACS", standin.url)
+        simulated.install()
+
+        def run():
+            answers = 0
+            for i in range(args.find_repeats):
+                answers += len(RunFind("PACS", FIND_QUERY).answers)
+            return answers
+
+        return Measure(run, "answers_per_second", args.runs)
+
+
+def MeasureMove(args, options):
+    with DicomWebStandIn(studies=1, series_per_study=args.series, instances_per_series=args.instances_per_series,
+                         instance_size=args.instance_size, latency_ms=args.latency_ms) as standin:
+        simulated = SimulatedOrthanc()
+        simulated.add_dicomweb_server("PACS", standin.url)
+        simulated.install(options)
+
+        def run():
+            stored = simulated.stored_instances
+            count = RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=standin.study_uid(0))
+            if simulated.stored_instances - stored != count:
+                raise Exception('{0} instances sent to the target instead of {1}'.format(simulated.stored_instances - stored, count))
+            if simulated.current_stored_bytes != 0:
+                raise Exception('{0} bytes left in the proxy after the C-move'.format(simulated.current_stored_bytes))
+            return count
+
+        return Measure(run, "instances_per_second", args.runs)
+
+
+def Measure(run, rateName, runs):
+    duration = None
+    for i in range(runs):
+        start = time.perf_counter()
+        count = run()
+        duration = min(duration or float("inf"), time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "count": count,
+        rateName: round(count / duration, 1),
+        "peak_memory_bytes": peak
+    }
+
+
+def Compare(results, baseline, tolerance):
+    # :return: the list of the regressions
+    regressions = []
+    for scenario, metrics in baseline["scenarios"].items():
+        if scenario not in results["scenarios"]:
+            continue
+        for name, expected in metrics.items():
+            actual = results["scenarios"][scenario][name]
+            if name.endswith("_per_second") and actual < expected * (1 - tolerance):
+                regressions.append("{0}.{1}: {2} < {3}".format(scenario, name, actual, expected))
+            elif name.endswith("_bytes") and actual > expected * (1 + tolerance):
+                regressions.append("{0}.{1}: {2} > {3}".format(scenario, name, actual, expected))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--studies", type=int, default=1000, help="number of studies returned by the C-find")
+    parser.add_argument("--find-repeats", type=int, default=5)
+    parser.add_argument("--series", type=int, default=4, help="number of series of the moved study")
+    parser.add_argument("--instances-per-series", type=int, default=100)
+    parser.add_argument("--instance-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency of each request to the DICOMweb stand-in")
+    parser.add_argument("--runs", type=int, default=3, help="number of runs of each scenario, the best one is kept")
+    parser.add_argument("--scenario", action="append", choices=["find_studies"] + list(MOVE_SCENARIOS),
+                        help="scenario to run (all by default, can be repeated)")
+    parser.add_argument("--save", help="JSON file in which the results are saved as a baseline")
+    parser.add_argument("--compare", help="JSON baseline the results are compared with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="accepted relative regression (default: 0.2)")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or ["find_studies"] + list(MOVE_SCENARIOS)
+    results = {
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items()
+                       if key not in {"runs", "scenario", "save", "compare", "tolerance"}},
+        "scenarios": {}
+    }
+    for scenario in scenarios:
+        if scenario == "find_studies":
+            results["scenarios"][scenario] = MeasureFind(args)
+        else:
+            results["scenarios"][scenario] = MeasureMove(args, MOVE_SCENARIOS[scenario])
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps(results, indent=2))
+
+    if args.save:
+        pathlib.Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["parameters"] != results["parameters"]:
+            print("warning: the baseline was measured with other parameters: {0}".format(baseline["parameters"]))
+        regressions = Compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("regression: {0}".format(regression))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+'''
+Local DICOMweb server serving synthetic studies, used by the benchmarks instead of a real PACS.
+
+The studies are generated on the fly: 'studies' studies of 'series_per_study' series of 'instances_per_series'
+instances of 'instance_size' bytes. Each request is delayed by 'latency_ms' to simulate a remote server, and each
+new connection by 'connect_latency_ms' to simulate the TCP/TLS handshakes and the authentication.
+If 'qido_max_results' > 0, the QIDO-RS answers are capped to it, like some archives do.
+Supported routes (enough for the proxy):
+- QIDO-RS: /studies, /studies/{study}/series, /studies/{study}/instances, /studies/{study}/series/{series}/instances
+  with the 'StudyInstanceUID', 'PatientID', 'limit' and 'offset' arguments
+- metadata: /studies/{study}/metadata, /studies/{study}/series/{series}/metadata
+- WADO-RS: /studies/{study}, /studies/{study}/series/{series}, /studies/{study}/series/{series}/instances/{sop}
+
+It can also be run on its own (e.g. as the DICOMweb server of the docker setups):
+    python3 benchmarks/dicomweb_standin.py --port 8043 --studies 100
+'''
+import argparse
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+UID_ROOT = "1.2.826.0.1.3680043.10.1"
+BOUNDARY = "4d3c9a1e-standin-boundary"
+
+
+class DicomWebStandIn:
+
+    def __init__(self, studies=10, series_per_study=2, instances_per_series=50, instance_size=64 * 1024,
+                 latency_ms=0, port=0, patients=None, connect_latency_ms=0, qido_max_results=0):
+        self.studies = studies
+        self.series_per_study = series_per_study
+        self.instances_per_series = instances_per_series
+        self.instance_size = instance_size
+        self.latency_ms = latency_ms
+        self.connect_latency_ms = connect_latency_ms
+        self.qido_max_results = qido_max_results
+        self.patients = patients or studies
+        self.requests = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with standin.lock:
+                    standin.connections += 1
+                if standin.connect_latency_ms > 0:
+                    time.sleep(standin.connect_latency_ms / 1000)
+
+            def do_GET(self):
+                standin._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/".format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="dicomweb-standin", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # the synthetic data
+
+    def study_uid(self, study):
+        return "{0}.{1}".format(UID_ROOT, study)
+
+    def series_uid(self, study, series):
+        return "{0}.{1}.{2}".format(UID_ROOT, study, series)
+
+    def sop_uid(self, study, series, instance):
+        return "{0}.{1}.{2}.{3}".format(UID_ROOT, study, series, instance)
+
+    def _parse_uid(self, uid):
+        # study, series and instance numbers from a UID generated by this server
+        if not uid.startswith(UID_ROOT + "."):
+            return None
+        try:
+            numbers = [int(n) for n in uid[len(UID_ROOT) + 1:].split(".")]
+        except ValueError:
+            return None
+        limits = [self.studies, self.series_per_study, self.instances_per_series]
+        if any(n < 0 or n >= limit for n, limit in zip(numbers, limits)):
+            return None
+        return numbers
+
+    def _study_dataset(self, study):
+        return {
+            "00080020": {"vr": "DA", "Value": ["2024{0:02d}{1:02d}".format(study % 12 + 1, study % 28 + 1)]},
+            "00080050": {"vr": "SH", "Value": ["ACC{0}".format(study)]},
+            "00080061": {"vr": "CS", "Value": ["CT", "SR"]},
+            "00081030": {"vr": "LO", "Value": ["Synthetic study {0}".format(study)]},
+            "00100010": {"vr": "PN", "Value": [{"Alphabetic": "PATIENT^{0}".format(study % self.patients)}]},
+            "00100020": {"vr": "LO", "Value": ["PID{0}".format(study % self.patients)]},
+            "00100030": {"vr": "DA", "Value": ["19700101"]},
+            "0020000D": {"vr": "UI", "Value": [self.study_uid(study)]},
+            "00201206": {"vr": "IS", "Value": [self.series_per_study]},
+            "00201208": {"vr": "IS", "Value": [self.series_per_study * self.instances_per_series]}
+        }
+
+    def _series_dataset(self, study, series):
+        return {
+            "00080060": {"vr": "CS", "Value": ["CT"]},
+            "0008103E": {"vr": "LO", "Value": ["Series {0}".format(series)]},
+            "0020000D": {"vr": "UI", "Value": [self.study_uid(study)]},
+            "0020000E": {"vr": "UI", "Value": [self.series_uid(study, series)]},
+            "00200011": {"vr": "IS", "Value": [series + 1]},
+            "00201209": {"vr": "IS", "Value": [self.instances_per_series]}
+        }
+
+    def _instance_dataset(self, study, series, instance):
+        dataset = self._series_dataset(study, series)
+        dataset.update({
+            "00080016": {"vr": "UI", "Value": ["1.2.840.10008.5.1.4.1.1.2"]},
+            "00080018": {"vr": "UI", "Value": [self.sop_uid(study, series, instance)]},
+            "00200013": {"vr": "IS", "Value": [instance + 1]}
+        })
+        return dataset
+
+    def _instance_content(self, study, series, instance):
+        # a preamble + 'DICM' + the SOP instance UID, padded to the instance size
+        header = b"\x00" * 128 + b"DICM" + self.sop_uid(study, series, instance).encode("ascii")
+        return header + b"\x00" * max(0, self.instance_size - len(header))
+
+    # the routes
+
+    def _qido_studies(self, arguments):
+        studies = range(self.studies)
+        if "StudyInstanceUID" in arguments:
+            studies = [n[0] for n in [self._parse_uid(uid) for uid in arguments["StudyInstanceUID"].split(",")] if n is not None]
+        if "PatientID" in arguments:
+            studies = [study for study in studies if "PID{0}".format(study % self.patients) == arguments["PatientID"]]
+        return [self._study_dataset(study) for study in studies]
+
+    def _instances(self, study, series=None):
+        series_list = range(self.series_per_study) if series is None else [series]
+        return [(study, se, i) for se in series_list for i in range(self.instances_per_series)]
+
+    def _route(self, path, arguments):
+        '''
+        :return: (json answers, None) for QIDO-RS and metadata, (None, [(study, series, instance)]) for WADO-RS
+        '''
+        parts = [urllib.parse.unquote(p) for p in path.strip("/").split("/") if p != ""]
+        if len(parts) == 0 or parts[0] != "studies":
+            raise KeyError(path)
+        if len(parts) == 1:
+            return self._qido_studies(arguments), None
+
+        study = (self._parse_uid(parts[1]) or [None])[0]
+        if study is None:
+            raise KeyError(path)
+
+        if len(parts) == 2:
+            return None, self._instances(study)
+        if parts[2:] == ["metadata"]:
+            return [self._instance_dataset(*i) for i in self._instances(study)], None
+        if parts[2:] == ["series"]:
+            return [self._series_dataset(study, series) for series in range(self.series_per_study)], None
+        if parts[2:] == ["instances"]:
+            return [self._instance_dataset(*i) for i in self._instances(study)], None
+
+        if parts[2] != "series" or len(parts) < 4:
+            raise KeyError(path)
+        numbers = self._parse_uid(parts[3])
+        if numbers is None or len(numbers) != 2 or numbers[0] != study:
+            raise KeyError(path)
+        series = numbers[1]
+
+        if len(parts) == 4:
+            return None, self._instances(study, series)
+        if parts[4:] == ["metadata"] or parts[4:] == ["instances"]:
+            return [self._instance_dataset(*i) for i in self._instances(study, series)], None
+        if parts[4] == "instances" and len(parts) == 6:
+            numbers = self._parse_uid(parts[5])
+            if numbers is None or len(numbers) != 3 or numbers[:2] != [study, series]:
+                raise KeyError(path)
+            return None, [tuple(numbers)]
+        raise KeyError(path)
+
+    def _handle(self, request):
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000)
+
+        url = urllib.parse.urlsplit(request.path)
+        arguments = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            answers, instances = self._route(url.path, arguments)
+        except KeyError:
+            request.send_response(404)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+
+        if answers is not None:
+            offset = int(arguments.get("offset", 0))
+            limit = int(arguments.get("limit", 0))
+            answers = answers[offset:offset + limit] if limit > 0 else answers[offset:]
+            if self.qido_max_results > 0:
+                answers = answers[:self.qido_max_results]
+            body = json.dumps(answers).encode("utf-8")
+            content_type = "application/dicom+json"
+        else:
+            chunks = []
+            for study, series, instance in instances:
+                location = "{0}studies/{1}/series/{2}/instances/{3}".format(
+                    self.url, self.study_uid(study), self.series_uid(study, series), self.sop_uid(study, series, instance))
+                chunks.append("--{0}\r\nContent-Type: application/dicom\r\nContent-Location: {1}\r\n\r\n".format(
+                    BOUNDARY, location).encode("ascii"))
+                chunks.append(self._instance_content(study, series, instance))
+                chunks.append(b"\r\n")
+            chunks.append("--{0}--\r\n".format(BOUNDARY).encode("ascii"))
+            body = b"".join(chunks)
+            content_type = 'multipart/related; type="application/dicom"; boundary={0}'.format(BOUNDARY)
+
+        request.send_response(200)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8043)
+    parser.add_argument("--studies", type=int, default=10)
+    parser.add_argument("--series-per-study", type=int, default=2)
+    parser.add_argument("--instances-per-series", type=int, default=50)
+    parser.add_argument("--instance-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--connect-latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    standin = DicomWebStandIn(studies=args.studies, series_per_study=args.series_per_study,
+                              instances_per_series=args.instances_per_series, instance_size=args.instance_size,
+                              latency_ms=args.latency_ms, port=args.port, connect_latency_ms=args.connect_latency_ms)
+    print("DICOMweb stand-in listening on {0}".format(standin.url))
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
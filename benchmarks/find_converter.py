@@ -0,0 +1,88 @@
+'''
+Micro-benchmark of the conversion of QIDO-RS answers into the JSON given to orthanc.CreateDicom,
+on 10k study-level answers: the FindAnswerConverter of proxy.py vs the previous recursive conversion.
+
+usage: python3 benchmarks/find_converter.py [--answers 10000] [--repeat 5]
+'''
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import proxy
+
+
+def LegacyBuildTagsListFromDicomWebAnswer(answer):
+    # the conversion used up to v 24.10.3.1 (kept Value[0] only and flattened the sequences)
+    dicomDict = {}
+    for tag, value_info in answer.items():
+        if "Value" in value_info:
+            value = value_info["Value"][0]
+            if isinstance(value, dict):
+                if "Alphabetic" in value:
+                    dicomDict[tag] = value["Alphabetic"]
+                else:
+                    dicomDict.update(LegacyBuildTagsListFromDicomWebAnswer(value))
+            else:
+                dicomDict[tag] = str(value)
+    return dicomDict
+
+
+def BuildAnswer(i):
+    return {
+        "00080005": {"vr": "CS", "Value": ["ISO_IR 100"]},
+        "00080020": {"vr": "DA", "Value": ["20240101"]},
+        "00080030": {"vr": "TM", "Value": ["120000"]},
+        "00080050": {"vr": "SH", "Value": ["ACC{0}".format(i)]},
+        "00080056": {"vr": "CS", "Value": ["ONLINE"]},
+        "00080061": {"vr": "CS", "Value": ["CT", "SR", "PR"]},
+        "00080090": {"vr": "PN", "Value": [{"Alphabetic": "Referring^Doctor"}]},
+        "00081030": {"vr": "LO", "Value": ["CT THORAX ABDOMEN"]},
+        "00081032": {"vr": "SQ", "Value": [{"00080100": {"vr": "SH", "Value": ["CODE"]},
+                                            "00080102": {"vr": "SH", "Value": ["LOCAL"]}}]},
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]},
+        "00100020": {"vr": "LO", "Value": ["PAT{0}".format(i)]},
+        "00100030": {"vr": "DA", "Value": ["19700101"]},
+        "00100040": {"vr": "CS", "Value": ["M"]},
+        "0020000D": {"vr": "UI", "Value": ["1.2.826.0.1.3680043.8.498.{0}".format(i)]},
+        "00200010": {"vr": "SH", "Value": ["1"]},
+        "00201206": {"vr": "IS", "Value": [4]},
+        "00201208": {"vr": "IS", "Value": [1200]}
+    }
+
+
+def Measure(function, answers, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for answer in answers:
+            function(answer)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return round(len(answers) / best)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--answers", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    answers = [BuildAnswer(i) for i in range(args.answers)]
+    requested_tags = {"00100010", "00100020", "00080020", "00080061", "00081030", "0020000D"}
+
+    results = {
+        "legacy_answers_per_second": Measure(lambda a: json.dumps(LegacyBuildTagsListFromDicomWebAnswer(a)), answers, args.repeat),
+        "converter_answers_per_second": Measure(proxy.FindAnswerConverter().convert, answers, args.repeat),
+        "converter_requested_tags_answers_per_second": Measure(proxy.FindAnswerConverter(requested_tags).convert, answers, args.repeat)
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+'''
+Compares the C-find conversion with and without 'QidoIncludeField', against a DICOMweb server
+that returns the full study-level metadata unless an 'includefield' argument is provided.
+The DICOMweb server and the Orthanc REST API are simulated by the stub 'orthanc' module.
+
+usage: python3 benchmarks/find_includefield.py [--answers 5000] [--repeat 3]
+'''
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+
+# a typical modality query: PatientID as a filter + a few return keys
+QUERY_TAGS = [
+    (0x0008, 0x0052, "QueryRetrieveLevel", "STUDY"),
+    (0x0010, 0x0020, "PatientID", "PAT*"),
+    (0x0010, 0x0010, "PatientName", ""),
+    (0x0008, 0x0020, "StudyDate", ""),
+    (0x0008, 0x1030, "StudyDescription", ""),
+    (0x0008, 0x0050, "AccessionNumber", ""),
+    (0x0020, 0x000D, "StudyInstanceUID", "")
+]
+
+
+def BuildFullStudyAnswer(i):
+    # the study-level metadata as returned by some servers when no 'includefield' is provided
+    answer = {
+        "00080005": {"vr": "CS", "Value": ["ISO_IR 100"]},
+        "00080020": {"vr": "DA", "Value": ["20240101"]},
+        "00080030": {"vr": "TM", "Value": ["120000"]},
+        "00080050": {"vr": "SH", "Value": ["ACC{0}".format(i)]},
+        "00080061": {"vr": "CS", "Value": ["CT", "SR"]},
+        "00080090": {"vr": "PN", "Value": [{"Alphabetic": "Referring^Doctor"}]},
+        "00081030": {"vr": "LO", "Value": ["CT THORAX ABDOMEN"]},
+        "00081032": {"vr": "SQ", "Value": [{"00080100": {"vr": "SH", "Value": ["CODE"]},
+                                            "00080102": {"vr": "SH", "Value": ["LOCAL"]}}]},
+        "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]},
+        "00100020": {"vr": "LO", "Value": ["PAT{0}".format(i)]},
+        "00100030": {"vr": "DA", "Value": ["19700101"]},
+        "00100040": {"vr": "CS", "Value": ["M"]},
+        "0020000D": {"vr": "UI", "Value": ["1.2.826.0.1.3680043.8.498.{0}".format(i)]},
+        "00200010": {"vr": "SH", "Value": ["1"]},
+        "00201206": {"vr": "IS", "Value": [4]},
+        "00201208": {"vr": "IS", "Value": [1200]}
+    }
+    # private and other tags that some archives add to every answer
+    for element in range(0x1000, 0x1030):
+        answer["0009{0:04X}".format(element)] = {"vr": "LO", "Value": ["private value {0}".format(element)]}
+    return answer
+
+
+# the attributes always returned by a QIDO-RS server at the study level (PS3.18 table 6.7.1-2)
+DEFAULT_STUDY_TAGS = {"00080005", "00080020", "00080030", "00080050", "00080061", "00080090", "00100010",
+                      "00100020", "00100030", "00100040", "0020000D", "00200010", "00201206", "00201208"}
+
+
+def Run(answers_count, include_field):
+    full_answers = [BuildFullStudyAnswer(i) for i in range(answers_count)]
+    payload_bytes = 0
+
+    def DicomWebGet(uri, body):
+        nonlocal payload_bytes
+        arguments = json.loads(body)["Arguments"]
+        if "includefield" in arguments:
+            tags = DEFAULT_STUDY_TAGS | set(arguments["includefield"].split(","))
+            answers = [{tag: value for tag, value in answer.items() if tag in tags} for answer in full_answers]
+        else:
+            answers = full_answers
+        r = json.dumps(answers)
+        payload_bytes += len(r)
+        return r
+
+    orthanc.Reset()
+    orthanc.configuration["DicomWebProxy"] = {"QidoIncludeField": include_field}
+    orthanc.SetRestApiHandler('POST', '/dicom-web/servers/', DicomWebGet)
+
+    import proxy
+    proxy.proxy_configuration = orthanc.configuration["DicomWebProxy"]
+
+    answers = orthanc.FindAnswers()
+    start = time.perf_counter()
+    proxy.OnFind(answers, orthanc.FindQuery(QUERY_TAGS), "MODALITY", "PACS")
+    duration = time.perf_counter() - start
+
+    return {
+        "payload_bytes": payload_bytes,
+        "answers_per_second": round(len(answers.answers) / duration),
+        "answer_bytes": sum(len(a) for a in answers.answers)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--answers", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    for include_field in [False, True]:
+        runs = [Run(args.answers, include_field) for _ in range(args.repeat)]
+        best = max(runs, key=lambda r: r["answers_per_second"])
+        results["includefield" if include_field else "all-fields"] = best
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
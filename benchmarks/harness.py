@@ -0,0 +1,224 @@
+'''
+Simulated Orthanc around the proxy, for the benchmarks.
+
+The stub 'orthanc' module is given:
+- the DICOMweb client of the Orthanc DICOMweb plugin ('/dicom-web/servers/{alias}/get' and '/retrieve'),
+  sending real HTTP requests to a DicomWebStandIn (or to any DICOMweb server)
+- the storage area + index of the proxy, in memory (LookupInstance, POST '/instances', '/instances/{id}/...',
+  '/tools/bulk-delete', '/tools/find')
+- target modalities ('/modalities', '/modalities/{alias}/store' and '/store-straight') accepting everything
+
+usage:
+    with DicomWebStandIn(studies=10) as standin:
+        simulated = SimulatedOrthanc()
+        simulated.add_dicomweb_server("PACS", standin.url)
+        simulated.install({"RetrieveMode": "Chunk"})
+        answers = RunFind("PACS", [(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY')])
+        count = RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=standin.study_uid(0))
+'''
+import json
+import pathlib
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+
+
+def ParseMultipart(body: bytes, contentType: str):
+    # :return: a list of (headers dict with lowercase names, content)
+    boundary = contentType.split("boundary=")[1].split(";")[0].strip('"')
+    parts = []
+    for part in body.split(b"--" + boundary.encode("ascii"))[1:]:
+        if part.startswith(b"--"):
+            break
+        rawHeaders, _, content = part.partition(b"\r\n\r\n")
+        headers = {}
+        for line in rawHeaders.decode("ascii").strip().split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        parts.append((headers, content[:-2] if content.endswith(b"\r\n") else content))
+    return parts
+
+
+class SimulatedOrthanc:
+
+    def __init__(self, modalities=None):
+        self.modalities = modalities or {"modality": "MODALITY"}    # alias -> AET
+        self.servers = {}           # alias -> (url, http headers)
+        self.lock = threading.Lock()
+        self.instances = {}         # orthanc id -> (sop instance uid, study instance uid, size)
+        self.ids = {}               # sop instance uid -> orthanc id
+        self.http_requests = 0
+        self.stored_instances = 0
+        self.stored_bytes = 0
+        self.peak_stored_bytes = 0
+        self.current_stored_bytes = 0
+
+    def add_dicomweb_server(self, alias: str, url: str, headers: dict = None):
+        self.servers[alias] = (url if url.endswith("/") else url + "/", headers or {})
+
+    def install(self, options: dict = None):
+        # the handlers of the stub are replaced, then the proxy is (re)configured with the 'DicomWebProxy' options
+        orthanc.Reset()
+        orthanc.configuration["DicomWebProxy"] = options or {}
+        orthanc.configuration["DicomWeb"] = {"Servers": {alias: {"Url": url, "HttpHeaders": headers}
+                                                         for alias, (url, headers) in self.servers.items()}}
+        orthanc.SetRestApiHandler('GET', '/modalities', self.get_modalities)
+        for alias in self.servers:
+            orthanc.SetRestApiHandler('POST', '/dicom-web/servers/{0}/get'.format(alias), self.dicomweb_get)
+            orthanc.SetRestApiHandler('POST', '/dicom-web/servers/{0}/retrieve'.format(alias), self.dicomweb_retrieve)
+        for alias in self.modalities:
+            orthanc.SetRestApiHandler('POST', '/modalities/{0}/store'.format(alias), self.store)
+            orthanc.SetRestApiHandler('POST', '/modalities/{0}/store-straight'.format(alias), self.store_straight)
+        orthanc.SetRestApiHandler('LOOKUP', '', self.lookup)
+        orthanc.SetRestApiHandler('POST', '/instances', self.post_instance)
+        orthanc.SetRestApiHandler('GET', '/instances/', self.get_instance)
+        orthanc.SetRestApiHandler('POST', '/tools/bulk-delete', self.bulk_delete)
+        orthanc.SetRestApiHandler('POST', '/tools/find', self.find)
+
+        import proxy
+        proxy.proxy_configuration = orthanc.configuration["DicomWebProxy"]
+        proxy.modality_alias_cache = proxy.ModalityAliasCache()
+        proxy.dicomweb_clients.configure(orthanc.configuration)
+
+    # the DICOMweb client
+
+    def _http_get(self, alias: str, uri: str, arguments: dict, headers: dict):
+        url, serverHeaders = self.servers[alias]
+        if arguments:
+            uri += "?" + urllib.parse.urlencode(arguments)
+        request = urllib.request.Request(url + uri, headers=dict(serverHeaders, **headers))
+        with self.lock:
+            self.http_requests += 1
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.read(), response.headers.get("Content-Type", "")
+        except urllib.error.HTTPError as e:
+            raise Exception('HTTP status {0} from the DICOMweb server for {1}'.format(e.code, uri))
+
+    def _alias(self, uri: str):
+        return uri.split('/')[3]
+
+    def dicomweb_get(self, uri, body):
+        payload = json.loads(body)
+        content, _ = self._http_get(self._alias(uri), payload["Uri"], payload.get("Arguments", {}), payload.get("HttpHeaders", {}))
+        return content
+
+    def dicomweb_retrieve(self, uri, body):
+        # the instances are stored in the proxy, as the DICOMweb plugin does
+        alias = self._alias(uri)
+        payload = json.loads(body)
+        headers = {"Accept": 'multipart/related; type="application/dicom"'}
+        headers.update(payload.get("HttpHeaders", {}))
+        for resource in payload["Resources"]:
+            wadoUri = "studies/{0}".format(resource["Study"])
+            if "Series" in resource:
+                wadoUri += "/series/{0}".format(resource["Series"])
+                if "Instance" in resource:
+                    wadoUri += "/instances/{0}".format(resource["Instance"])
+            content, contentType = self._http_get(alias, wadoUri, {}, headers)
+            for partHeaders, part in ParseMultipart(content, contentType):
+                sop = partHeaders["content-location"].rstrip("/").split("/")[-1]
+                self._store_instance(sop, resource["Study"], len(part))
+        return "{}"
+
+    # the storage area and the index
+
+    def _store_instance(self, sop: str, study: str, size: int):
+        with self.lock:
+            orthanc_id = "id-" + sop
+            if orthanc_id not in self.instances:
+                self.current_stored_bytes += size
+                self.peak_stored_bytes = max(self.peak_stored_bytes, self.current_stored_bytes)
+            self.instances[orthanc_id] = (sop, study, size)
+            self.ids[sop] = orthanc_id
+
+    def post_instance(self, uri, body):
+        # an instance of the stand-in: its SOPInstanceUID follows the 'DICM' prefix, its StudyInstanceUID is the
+        # SOPInstanceUID without the series and instance numbers
+        sop = body[132:].split(b"\x00")[0].decode("ascii")
+        self._store_instance(sop, sop.rsplit(".", 2)[0], len(body))
+        return json.dumps({"ID": "id-" + sop, "Status": "Success"})
+
+    def lookup(self, sop, body):
+        with self.lock:
+            if sop not in self.ids:
+                raise Exception('Unknown resource')
+            return self.ids[sop]
+
+    def get_instance(self, uri, body):
+        orthanc_id = uri.split('/')[2]
+        with self.lock:
+            sop, study, size = self.instances[orthanc_id]
+        if uri.endswith('/statistics'):
+            return json.dumps({"DiskSize": str(size)})
+        if uri.endswith('/metadata/TransferSyntax'):
+            return b"1.2.840.10008.1.2.1"
+        raise Exception('No simulated route for {0}'.format(uri))
+
+    def bulk_delete(self, uri, body):
+        with self.lock:
+            for orthanc_id in json.loads(body)["Resources"]:
+                if orthanc_id in self.instances:
+                    sop, study, size = self.instances.pop(orthanc_id)
+                    self.ids.pop(sop, None)
+                    self.current_stored_bytes -= size
+        return "{}"
+
+    def find(self, uri, body):
+        with self.lock:
+            return json.dumps([{
+                "ID": orthanc_id,
+                "FileSize": size,
+                "MainDicomTags": {"SOPInstanceUID": sop},
+                "RequestedTags": {"StudyInstanceUID": study}
+            } for orthanc_id, (sop, study, size) in self.instances.items()])
+
+    # the target modalities
+
+    def get_modalities(self, uri, body):
+        return json.dumps({alias: {"AET": aet} for alias, aet in self.modalities.items()})
+
+    def store(self, uri, body):
+        with self.lock:
+            for orthanc_id in json.loads(body)["Resources"]:
+                self.stored_instances += 1
+                self.stored_bytes += self.instances[orthanc_id][2]
+        return "{}"
+
+    def store_straight(self, uri, body):
+        with self.lock:
+            self.stored_instances += 1
+            self.stored_bytes += len(body)
+        return "{}"
+
+
+def RunFind(calledAet: str, tags: list, issuerAet: str = "MODALITY"):
+    # :param tags: the C-find query, as a list of (group, element, name, value)
+    import proxy
+    answers = orthanc.FindAnswers()
+    proxy.OnFind(answers, orthanc.FindQuery(tags), issuerAet, calledAet)
+    return answers
+
+
+def RunMove(**request):
+    # runs a C-move the way Orthanc drives the move callbacks
+    # :return: the number of sub-operations
+    import proxy
+    request.setdefault("TargetAET", "MODALITY")
+    request.setdefault("OriginatorAET", request["TargetAET"])
+    driver = proxy.CreateMoveCallback(**request)
+    try:
+        count = proxy.GetMoveSizeCallback(driver)
+        for i in range(count):
+            proxy.ApplyMoveCallback(driver)
+    finally:
+        proxy.FreeMoveCallback(driver)
+    return count
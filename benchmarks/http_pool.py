@@ -0,0 +1,65 @@
+'''
+Requests/second to the DICOMweb server with and without 'HttpPool', against the local stand-in (see harness.py).
+Without the pool, each request goes through the DICOMweb client of Orthanc (simulated by the harness with a new
+connection per request); with the pool, the connections are kept alive. The TCP/TLS handshakes and the authentication
+of a new connection are simulated by '--connect-latency-ms'.
+
+Each scenario is a C-find followed by a C-move of a study in the 'Instance' retrieve mode (one WADO-RS request
+per instance).
+
+usage: python3 benchmarks/http_pool.py [--instances 200] [--connect-latency-ms 20] [--latency-ms 1]
+'''
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here))
+
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunFind, RunMove
+
+
+def Run(options, args):
+    with DicomWebStandIn(studies=1, series_per_study=1, instances_per_series=args.instances,
+                         instance_size=args.instance_size, latency_ms=args.latency_ms,
+                         connect_latency_ms=args.connect_latency_ms) as standin:
+        simulated = SimulatedOrthanc()
+        simulated.add_dicomweb_server("PACS", standin.url)
+        simulated.install(options)
+
+        start = time.perf_counter()
+        RunFind("PACS", [(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'), (0x0020, 0x000D, 'StudyInstanceUID', '')])
+        count = RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=standin.study_uid(0))
+        duration = time.perf_counter() - start
+
+        return {
+            "requests": standin.requests,
+            "connections": standin.connections,
+            "requests_per_second": round(standin.requests / duration, 1),
+            "instances_per_second": round(count / duration, 1)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", type=int, default=200)
+    parser.add_argument("--instance-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency-ms", type=float, default=1)
+    parser.add_argument("--connect-latency-ms", type=float, default=20)
+    parser.add_argument("--http2", action="store_true", help="also measure 'HttpPoolHttp2' (requires httpx and h2)")
+    args = parser.parse_args()
+
+    results = {
+        "orthanc_client": Run({"HttpPool": False}, args),
+        "pool": Run({"HttpPool": True}, args)
+    }
+    if args.http2:
+        results["pool_http2"] = Run({"HttpPool": True, "HttpPoolHttp2": True}, args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
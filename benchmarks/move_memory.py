@@ -0,0 +1,93 @@
+'''
+Measures the memory used by each C-move driver while it holds the instances list of a large study.
+The DICOMweb server and the Orthanc REST API are simulated by the stub 'orthanc' module.
+
+usage: python3 benchmarks/move_memory.py [--instances 10000] [--moves 20] [--max-mb-per-move 10]
+The script exits with an error if the memory used per move exceeds --max-mb-per-move, so that regressions are caught.
+'''
+import argparse
+import gc
+import json
+import pathlib
+import sys
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+
+
+def GetRss():
+    # resident set size in bytes (Linux only)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+
+def BuildStudyMetadata(study_uid, instances_count, instances_per_series):
+    # a typical CT instance metadata contains ~100 tags, let's keep a few of them to be realistic enough
+    instances = []
+    for i in range(instances_count):
+        series_uid = "{0}.{1}".format(study_uid, i // instances_per_series)
+        instances.append({
+            "0020000D": {"vr": "UI", "Value": [study_uid]},
+            "0020000E": {"vr": "UI", "Value": [series_uid]},
+            "00080018": {"vr": "UI", "Value": ["{0}.{1}".format(series_uid, i)]},
+            "00080060": {"vr": "CS", "Value": ["CT"]},
+            "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]},
+            "00200013": {"vr": "IS", "Value": [i]}
+        })
+    return json.dumps(instances)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", type=int, default=10000)
+    parser.add_argument("--moves", type=int, default=20)
+    parser.add_argument("--instances-per-series", type=int, default=500)
+    parser.add_argument("--max-mb-per-move", type=float, default=10)
+    args = parser.parse_args()
+
+    study_uid = "1.2.826.0.1.3680043.8.498.1234567890"
+    metadata = BuildStudyMetadata(study_uid, args.instances, args.instances_per_series)
+
+    # only the listing is measured here, not the retrieval
+    orthanc.configuration["DicomWebProxy"] = {"PrefetchWorkers": 0}
+    orthanc.SetRestApiHandler('GET', '/modalities', lambda uri, body: json.dumps({"modality": {"AET": "MODALITY"}}))
+    orthanc.SetRestApiHandler('POST', '/dicom-web/servers/', lambda uri, body: metadata)
+
+    import proxy
+
+    gc.collect()
+    rss_before = GetRss()
+
+    drivers = []
+    for i in range(args.moves):
+        driver = proxy.MoveDriver(request={
+            "SourceAET": "PACS",
+            "Level": "STUDY",
+            "StudyInstanceUID": study_uid,
+            "TargetAET": "MODALITY",
+            "OriginatorAET": "MODALITY"
+        })
+        driver.get_instances_list()
+        drivers.append(driver)
+
+    gc.collect()
+    rss_after = GetRss()
+
+    per_move_mb = (rss_after - rss_before) / args.moves / (1024 * 1024)
+    print(json.dumps({
+        "instances_per_move": args.instances,
+        "moves": args.moves,
+        "rss_per_move_mb": round(per_move_mb, 2),
+        "rss_total_mb": round((rss_after - rss_before) / (1024 * 1024), 2)
+    }, indent=2))
+
+    if per_move_mb > args.max_mb_per_move:
+        print("REGRESSION: {0:.2f} MB per move > {1} MB".format(per_move_mb, args.max_mb_per_move))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+C-move throughput for small and large instances depending on 'StoreBatchSize'.
+The stub 'orthanc' module simulates the C-store toward the target: each '/modalities/{id}/store' call
+costs one association negotiation (--association-ms) + the transfer of the instances (--bandwidth-mbps).
+The DICOMweb server answers immediately so that only the forwarding is measured.
+
+usage: python3 benchmarks/move_store_batch.py [--association-ms 15] [--bandwidth-mbps 800]
+'''
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+
+PROFILES = {
+    # name: (instances count, instance size)
+    "small (MR slices, 128 kB)": (200, 128 * 1024),
+    "large (mammography, 30 MB)": (20, 30 * 1024 * 1024)
+}
+
+
+def Run(instances_count, instance_size, batch_size, association_ms, bandwidth_mbps):
+    associations = 0
+
+    def Store(uri, body):
+        nonlocal associations
+        resources = json.loads(body)["Resources"]
+        associations += 1
+        time.sleep(association_ms / 1000 + len(resources) * instance_size * 8 / (bandwidth_mbps * 1000 * 1000))
+        return "{}"
+
+    orthanc.Reset()
+    orthanc.configuration["DicomWebProxy"] = {"StoreBatchSize": batch_size, "PrefetchWindow": max(8, batch_size)}
+    orthanc.SetRestApiHandler('GET', '/modalities', lambda uri, body: json.dumps({"modality": {"AET": "MODALITY"}}))
+    orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get', lambda uri, body: json.dumps([{
+        "0020000D": {"vr": "UI", "Value": ["1.2.3"]},
+        "0020000E": {"vr": "UI", "Value": ["1.2.3.4"]},
+        "00080018": {"vr": "UI", "Value": ["1.2.3.4.{0}".format(i)]}
+    } for i in range(instances_count)]))
+    orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/retrieve', lambda uri, body: "{}")
+    orthanc.SetRestApiHandler('LOOKUP', '', lambda sop, body: "id-" + sop)
+    orthanc.SetRestApiHandler('POST', '/modalities/modality/store', Store)
+    orthanc.SetRestApiHandler('POST', '/tools/bulk-delete', lambda uri, body: "{}")
+
+    import proxy
+    proxy.proxy_configuration = orthanc.configuration["DicomWebProxy"]
+
+    start = time.perf_counter()
+    driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID="1.2.3",
+                                      TargetAET="MODALITY", OriginatorAET="MODALITY")
+    count = proxy.GetMoveSizeCallback(driver)
+    for i in range(count):
+        proxy.ApplyMoveCallback(driver)
+    proxy.FreeMoveCallback(driver)
+    duration = time.perf_counter() - start
+
+    return {
+        "associations": associations,
+        "instances_per_second": round(count / duration, 1),
+        "megabytes_per_second": round(count * instance_size / duration / (1024 * 1024), 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--association-ms", type=float, default=15)
+    parser.add_argument("--bandwidth-mbps", type=float, default=800)
+    parser.add_argument("--batch-sizes", type=str, default="1,10,50")
+    args = parser.parse_args()
+
+    results = {}
+    for profile, (instances_count, instance_size) in PROFILES.items():
+        results[profile] = {}
+        for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+            results[profile]["StoreBatchSize={0}".format(batch_size)] = Run(instances_count, instance_size, batch_size,
+                                                                            args.association_ms, args.bandwidth_mbps)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+'''
+Compares a C-move through the Orthanc storage (default) with a C-move in transit mode ('TransitMode': true).
+The stub 'orthanc' module simulates the storage area (files written in a temporary folder) and the
+SQLite index of Orthanc, so that the disk writes and the per-instance latency of both paths can be compared.
+
+usage: python3 benchmarks/move_transit.py [--instances 500] [--instance-size 524288]
+'''
+import argparse
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+
+BOUNDARY = "6f7ea1d1-6c52-4a4b-9e5f-2d2a7b3c1e90"
+
+
+class SimulatedOrthanc:
+    # storage area + index of the proxy, a DICOMweb server and a target modality
+    def __init__(self, folder, instances_count, instance_size):
+        self.folder = folder
+        self.instances_count = instances_count
+        self.content = os.urandom(instance_size)
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(os.path.join(folder, "index.db"), check_same_thread=False)
+        self.index.execute("CREATE TABLE instances (id TEXT PRIMARY KEY, sop TEXT UNIQUE, path TEXT)")
+        self.bytes_written = 0
+        self.index_writes = 0
+        self.stored_in_target = 0
+
+    def list_instances(self, uri, body):
+        return json.dumps([{
+            "0020000D": {"vr": "UI", "Value": ["1.2.3"]},
+            "0020000E": {"vr": "UI", "Value": ["1.2.3.4"]},
+            "00080018": {"vr": "UI", "Value": ["1.2.3.4.{0}".format(i)]}
+        } for i in range(self.instances_count)])
+
+    def dicomweb_get(self, uri, body):
+        payload = json.loads(body)
+        if payload["Uri"].endswith("/metadata"):
+            return self.list_instances(uri, body)
+        # WADO-RS of a single instance
+        return (b"--" + BOUNDARY.encode() + b"\r\nContent-Type: application/dicom\r\n\r\n" + self.content
+                + b"\r\n--" + BOUNDARY.encode() + b"--")
+
+    def dicomweb_retrieve(self, uri, body):
+        # the instances are written in the storage area and indexed, as Orthanc would do
+        for resource in json.loads(body)["Resources"]:
+            sop = resource["Instance"]
+            path = os.path.join(self.folder, sop)
+            with open(path, "wb") as f:
+                f.write(self.content)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.lock:
+                self.index.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?)", ("id-" + sop, sop, path))
+                self.index.commit()
+                self.bytes_written += len(self.content)
+                self.index_writes += 1
+        return "{}"
+
+    def lookup(self, sop, body):
+        with self.lock:
+            return self.index.execute("SELECT id FROM instances WHERE sop = ?", (sop,)).fetchone()[0]
+
+    def store(self, uri, body):
+        # C-store of stored instances: they are read from the storage area
+        for orthanc_id in json.loads(body)["Resources"]:
+            with self.lock:
+                path = self.index.execute("SELECT path FROM instances WHERE id = ?", (orthanc_id,)).fetchone()[0]
+            with open(path, "rb") as f:
+                f.read()
+            self.stored_in_target += 1
+        return "{}"
+
+    def store_straight(self, uri, body):
+        self.stored_in_target += 1
+        return "{}"
+
+    def bulk_delete(self, uri, body):
+        for orthanc_id in json.loads(body)["Resources"]:
+            with self.lock:
+                row = self.index.execute("SELECT path FROM instances WHERE id = ?", (orthanc_id,)).fetchone()
+                self.index.execute("DELETE FROM instances WHERE id = ?", (orthanc_id,))
+                self.index.commit()
+                self.index_writes += 1
+            if row is not None:
+                os.remove(row[0])
+        return "{}"
+
+
+def Run(transit_mode, instances_count, instance_size):
+    with tempfile.TemporaryDirectory() as folder:
+        simulated = SimulatedOrthanc(folder, instances_count, instance_size)
+
+        orthanc.Reset()
+        orthanc.configuration["DicomWebProxy"] = {"TransitMode": transit_mode}
+        orthanc.SetRestApiHandler('GET', '/modalities', lambda uri, body: json.dumps({"modality": {"AET": "MODALITY"}}))
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get', simulated.dicomweb_get)
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/retrieve', simulated.dicomweb_retrieve)
+        orthanc.SetRestApiHandler('LOOKUP', '', simulated.lookup)
+        orthanc.SetRestApiHandler('POST', '/modalities/modality/store-straight', simulated.store_straight)
+        orthanc.SetRestApiHandler('POST', '/modalities/modality/store', simulated.store)
+        orthanc.SetRestApiHandler('POST', '/tools/bulk-delete', simulated.bulk_delete)
+
+        import proxy
+        proxy.proxy_configuration = orthanc.configuration["DicomWebProxy"]
+        proxy.modality_alias_cache = proxy.ModalityAliasCache()
+
+        start = time.perf_counter()
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID="1.2.3",
+                        TargetAET="MODALITY", OriginatorAET="MODALITY")
+        count = proxy.GetMoveSizeCallback(driver)
+        latencies = []
+        for i in range(count):
+            instance_start = time.perf_counter()
+            proxy.ApplyMoveCallback(driver)
+            latencies.append(time.perf_counter() - instance_start)
+        proxy.FreeMoveCallback(driver)
+        duration = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            "instances": simulated.stored_in_target,
+            "instances_per_second": round(count / duration, 1),
+            "latency_ms_p50": round(latencies[len(latencies) // 2] * 1000, 3),
+            "latency_ms_p95": round(latencies[int(len(latencies) * 0.95)] * 1000, 3),
+            "storage_bytes_written": simulated.bytes_written,
+            "index_writes": simulated.index_writes
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", type=int, default=500)
+    parser.add_argument("--instance-size", type=int, default=512 * 1024)
+    args = parser.parse_args()
+
+    print(json.dumps({
+        "storage": Run(False, args.instances, args.instance_size),
+        "transit": Run(True, args.instances, args.instance_size)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
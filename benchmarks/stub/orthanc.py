@@ -0,0 +1,145 @@
+'''
+Minimal stand-in for the 'orthanc' module provided by the Orthanc python plugin.
+It only implements what proxy.py uses, so that the proxy can be exercised outside of an Orthanc container.
+
+The REST API calls are dispatched to the handlers registered with SetRestApiHandler():
+    orthanc.SetRestApiHandler('POST', '/dicom-web/servers/', lambda uri, body: ...)
+The longest matching uri prefix wins.
+'''
+import json
+
+
+class CreateDicomFlags:
+    NONE = 0
+
+
+class HttpMethod:
+    GET = 1
+    POST = 2
+    PUT = 3
+    DELETE = 4
+
+
+class ChangeType:
+    ORTHANC_STARTED = 0
+
+
+class FindQuery:
+    '''
+    C-find query, built from a list of (group, element, name, value)
+    '''
+    def __init__(self, tags):
+        self.tags = tags
+
+    def GetFindQuerySize(self):
+        return len(self.tags)
+
+    def GetFindQueryTagGroup(self, index):
+        return self.tags[index][0]
+
+    def GetFindQueryTagElement(self, index):
+        return self.tags[index][1]
+
+    def GetFindQueryTagName(self, index):
+        return self.tags[index][2]
+
+    def GetFindQueryValue(self, index):
+        return self.tags[index][3]
+
+
+class FindAnswers:
+    def __init__(self):
+        self.answers = []
+        self.incomplete = False
+
+    def FindAddAnswer(self, dicom):
+        self.answers.append(dicom)
+
+    def FindMarkIncomplete(self):
+        self.incomplete = True
+
+
+configuration = {}
+rest_api_handlers = {}          # (method, uri prefix) -> handler(uri, body)
+registered_callbacks = {}
+
+
+def SetRestApiHandler(method: str, uri_prefix: str, handler):
+    rest_api_handlers[(method, uri_prefix)] = handler
+
+
+def Reset():
+    configuration.clear()
+    rest_api_handlers.clear()
+    registered_callbacks.clear()
+
+
+def _dispatch(method: str, uri: str, body=None):
+    best = None
+    for (handler_method, prefix), handler in rest_api_handlers.items():
+        if handler_method == method and uri.startswith(prefix):
+            if best is None or len(prefix) > len(best[0]):
+                best = (prefix, handler)
+    if best is None:
+        raise Exception('No stub handler for {0} {1}'.format(method, uri))
+    return best[1](uri, body)
+
+
+def GetConfiguration():
+    return json.dumps(configuration)
+
+
+def LogInfo(message):
+    pass
+
+
+def LogWarning(message):
+    pass
+
+
+def LogError(message):
+    print(message)
+
+
+def RestApiGet(uri):
+    return _dispatch('GET', uri)
+
+
+def RestApiPost(uri, body):
+    return _dispatch('POST', uri, body)
+
+
+def RestApiPostAfterPlugins(uri, body):
+    return _dispatch('POST', uri, body)
+
+
+def RestApiDelete(uri):
+    return _dispatch('DELETE', uri)
+
+
+def LookupInstance(sop_instance_uid):
+    return _dispatch('LOOKUP', sop_instance_uid)
+
+
+def CreateDicom(json_tags, pixel_data, flags):
+    return json_tags.encode('utf-8')
+
+
+def RegisterFindCallback(callback):
+    registered_callbacks['find'] = callback
+
+
+def RegisterMoveCallback2(create, get_size, apply, free):
+    registered_callbacks['move'] = (create, get_size, apply, free)
+
+
+def RegisterIncomingHttpRequestFilter(callback):
+    registered_callbacks['filter'] = callback
+
+
+def RegisterRestCallback(uri, callback):
+    registered_callbacks[uri] = callback
+
+
+def RegisterOnChangeCallback(callback):
+    registered_callbacks['change'] = callback
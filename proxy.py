@@ -5,6 +5,23 @@ import orthanc
 import pprint, os
 from typing import List
 import dataclasses
+import threading
+import array
+import sys
+from concurrent.futures import ThreadPoolExecutor, Future
+import concurrent.futures
+import bisect
+import tempfile
+import struct
+import contextlib
+import queue
+import sqlite3
+import uuid
+import base64
+import http.client
+import ssl
+import urllib.parse
+from collections import OrderedDict, deque
 
 verbose_enabled = False
 
@@ -21,12 +38,454 @@ In the same way, as soon as a C-Move is received, Orthanc will get the resources
 Then, Orthanc will push (C-Move) these resources to the initial DICOM node. 
 
 IMPORTANT notes:
-- The QueryRetrieveLevel 'PATIENT' is not supported by this plugin.
+- DICOMweb has no patient level: the 'PATIENT' C-finds are sent at the study level and the answers are aggregated
+  per patient, the 'PATIENT' C-moves are expanded to the studies of the patient.
 - For C-find queries, the 'called AET' has to be identical to the alias of the DICOMweb server you want to query
 - For C-move queries, the 'source AET' has to be identical to the alias of the DICOMweb server you want to query
 
 
 '''
+
+# Default values of the options that can be set in the 'DicomWebProxy' section of the Orthanc configuration.
+# Each of them can be overridden for a given DICOMweb server in 'DicomWebProxy.Servers.{alias}'.
+DEFAULT_OPTIONS = {
+    "PrefetchWindow": 8,        # number of instances retrieved ahead of the one being forwarded (C-move)
+    "PrefetchWorkers": 4,       # number of threads retrieving instances in parallel (C-move)
+    "PrefetchMaxBytes": 0,      # max size of the instances retrieved but not forwarded yet, 0 = no limit (C-move)
+    "ModalitiesCacheTtl": 60,   # seconds during which the AET -> modality alias index is trusted (global only)
+    "QidoPageSize": 0,          # number of answers requested per QIDO-RS query (limit/offset), 0 = no paging (C-find) or QIDO_LISTING_PAGE_SIZE (C-move)
+    "QidoMaxResults": 0,        # max number of answers sent to the SCU, 0 = no limit (C-find)
+    "FindCacheTtl": 0,          # seconds during which the answers of a QIDO-RS query are reused, 0 = no cache (C-find)
+    "FindCacheMaxBytes": 67108864,  # max size of the cached QIDO-RS responses (global only)
+    "QidoIncludeField": True,   # request only the C-find return keys (includefield) and convert only them (C-find)
+    "RetrieveMode": "Instance", # "Instance", "Chunk" or "Series": resources retrieved per WADO-RS call (C-move)
+    "RetrieveChunkSize": 50,    # number of instances per WADO-RS call in the "Chunk" mode (C-move)
+    "ListingMode": "Metadata",  # "Metadata", "Qido" or "QidoSeries": how the instances to move are listed (C-move)
+    "ListingWorkers": 4,        # number of studies listed in parallel (C-move)
+    "TransitMode": False,       # instances are sent to the target without being stored in the proxy (C-move)
+    "TransitMaxMemoryBytes": 67108864,  # per move, instances kept in memory in transit mode, then spooled to temp files
+    "StoreBatchSize": 1,        # number of instances sent to the target in a single C-store association (C-move)
+    "InstanceCacheMaxBytes": 0, # max size of the instances kept in the proxy for the next C-moves, 0 = no cache (global only)
+    "InstanceCacheTtl": 86400,  # seconds during which a retrieved instance is kept in the instance cache (global only)
+    "StudyPrefetchCount": 0,    # number of studies returned by a C-find that are listed in advance, 0 = no prefetch
+    "StudyPrefetchRetrieve": False, # the prefetched studies are also retrieved in the instance cache
+    "StudyPrefetchTtl": 60,     # seconds during which a prefetched listing is reused by the C-moves
+    "StudyPrefetchRate": 10,    # max number of studies prefetched per minute, 0 = no limit
+    "SchedulerMaxInFlight": 0,  # max number of requests in flight to the DICOMweb server for all the C-moves, 0 = no limit
+    "SchedulerLatencyTarget": 0,# seconds: the max in flight is lowered when a request takes longer, 0 = fixed limit
+    "FederationTimeout": 10,    # seconds after which a federated C-find answers without the servers that are still busy
+    "MoveJournalWindow": 0,     # seconds during which an interrupted C-move can be resumed, 0 = no journal (global only)
+    "MoveJournalPath": "",      # sqlite file of the C-move journal, "" = in the temporary directory (global only)
+    "HttpPool": False,          # the requests to the DICOMweb server are sent through a pool of keep-alive connections
+    "HttpPoolSize": 8,          # max number of connections to the DICOMweb server in the pool
+    "HttpPoolHttp2": False      # the pool uses HTTP/2 (requires the 'httpx' and 'h2' python packages)
+}
+
+# bytes read at once from a multipart WADO-RS answer that is streamed by a pooled client (see IterMultipartRelated)
+MULTIPART_READ_SIZE = 1024 * 1024
+
+# number of forwarded instances deleted from the proxy in a single '/tools/bulk-delete' during a C-move
+CLEANUP_BATCH_SIZE = 100
+
+# seconds between 2 lookups of an instance while the chunk it belongs to is being retrieved
+CHUNK_POLLING_INTERVAL = 0.1
+
+# number of threads listing (and retrieving) the studies prefetched after a C-find, shared by all the servers
+STUDY_PREFETCH_WORKERS = 2
+
+# seconds after a modification of the modalities through the REST API during which the AET -> modality alias index
+# is not trusted: the modification is applied after the HTTP filter has invalidated the index, so an index built
+# in the meantime might be stale
+MODALITIES_CHANGE_DELAY = 5
+
+# max number of UIDs for which the server that reported them in a federated C-find is remembered
+FEDERATION_ROUTES_MAX_ENTRIES = 100000
+
+# seconds during which the transfer syntaxes that a DICOMweb server has failed to deliver are not requested again
+UNDELIVERABLE_TRANSFER_SYNTAXES_TTL = 3600
+
+# the HTTP statuses of a DICOMweb server that can not deliver the requested transfer syntaxes (content negotiation)
+CONTENT_NEGOTIATION_HTTP_STATUSES = {406, 415}
+
+# seconds during which a DICOMweb server that has failed to retrieve several resources at once is not asked to again,
+# when the HTTP status of the failure is not known
+BULK_RETRIEVE_REJECTED_TTL = 3600
+
+# the HTTP statuses of a DICOMweb server that does not support the retrieval of several resources at once
+BULK_RETRIEVE_REJECTION_HTTP_STATUSES = {400, 406, 413, 414, 415, 501}
+
+proxy_configuration = {}
+
+def GetServerOption(dicomwebServerAlias: str, option: str):
+    '''
+    Returns the value of an option of the 'DicomWebProxy' configuration section for a given DICOMweb server:
+    the value from 'DicomWebProxy.Servers.{alias}' if present, else the global value, else the default one.
+    '''
+    serverConfiguration = proxy_configuration.get("Servers", {}).get(dicomwebServerAlias, {})
+    if option in serverConfiguration:
+        return serverConfiguration[option]
+    return proxy_configuration.get(option, DEFAULT_OPTIONS[option])
+
+def GetFederationServers(alias: str):
+    '''
+    Returns the aliases of the DICOMweb servers of the federation 'DicomWebProxy.Federations.{alias}',
+    or None if alias is not a federation.
+    '''
+    return proxy_configuration.get("Federations", {}).get(alias)
+
+def GetOption(option: str):
+    '''
+    Returns the value of a global option of the 'DicomWebProxy' configuration section, else the default one.
+    '''
+    return proxy_configuration.get(option, DEFAULT_OPTIONS[option])
+
+class Counters:
+    '''
+    Thread-safe named counters, exposed on the '/dicom-dicomweb-proxy/statistics' route
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def get_all(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+counters = Counters()
+
+# upper bounds (in seconds) of the buckets of the latency histograms
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    '''
+    Thread-safe latency histograms and labelled counters, exposed in the Prometheus text format
+    on the '/dicom-dicomweb-proxy/metrics' route (with the statistics of the '/dicom-dicomweb-proxy/statistics' route)
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms = {}        # (name, labels) -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}            # (name, labels) -> value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(METRICS_LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def increment(self, name: str, value: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get_prometheus_text(self, statistics: dict) -> str:
+        def FormatLabels(labels, extra = ()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in labels) + '}'
+
+        with self.lock:
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+            values = dict(self.values)
+
+        lines = []
+        for name in sorted({name for name, labels in histograms}):
+            lines.append('# TYPE dicomweb_proxy_{0} histogram'.format(name))
+            for (histogramName, labels), histogram in sorted(histograms.items()):
+                if histogramName != name:
+                    continue
+                cumulated = 0
+                for bound, count in zip(METRICS_LATENCY_BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulated += count
+                    lines.append('dicomweb_proxy_{0}_bucket{1} {2}'.format(name, FormatLabels(labels, [("le", bound)]), cumulated))
+                lines.append('dicomweb_proxy_{0}_sum{1} {2}'.format(name, FormatLabels(labels), histogram[-1]))
+                lines.append('dicomweb_proxy_{0}_count{1} {2}'.format(name, FormatLabels(labels), cumulated))
+
+        for name in sorted({name for name, labels in values}):
+            lines.append('# TYPE dicomweb_proxy_{0}_total counter'.format(name))
+            for (valueName, labels), value in sorted(values.items()):
+                if valueName == name:
+                    lines.append('dicomweb_proxy_{0}_total{1} {2}'.format(name, FormatLabels(labels), value))
+
+        # the statistics are exported as they are, the nested ones (e.g. per server) with a label
+        for name, value in sorted(statistics.items()):
+            if isinstance(value, dict):
+                for label, nested in sorted(value.items()):
+                    for nestedName, nestedValue in sorted(nested.items()):
+                        lines.append('dicomweb_proxy_{0}_{1}{2} {3}'.format(name, nestedName, FormatLabels([("server", label)]), nestedValue))
+            else:
+                lines.append('dicomweb_proxy_{0} {1}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def NewTraceId() -> str:
+    # identifies a C-find or a C-move in the logs
+    return uuid.uuid4().hex[:8]
+
+class DicomWebHttpError(Exception):
+    '''
+    HTTP error status received from a DICOMweb server by a pooled client (the status of the errors of the
+    Orthanc DICOMweb client is not known)
+    '''
+    def __init__(self, dicomwebServerAlias: str, status: int, uri: str) -> None:
+        super().__init__('The DICOMweb server {0} has answered {1} to GET {2}'.format(dicomwebServerAlias, status, uri))
+        self.http_status = status
+
+class DicomWebClient:
+    '''
+    HTTP/1.1 client of a DICOMweb server keeping its connections alive, so that the TCP/TLS handshakes are not
+    paid for each request. At most 'size' connections are open at the same time.
+    '''
+    def __init__(self, dicomwebServerAlias: str, url: str, headers: dict, sslContext, timeout: float, size: int) -> None:
+        self.alias = dicomwebServerAlias
+        parsedUrl = urllib.parse.urlsplit(url)
+        self.https = parsedUrl.scheme == "https"
+        self.host = parsedUrl.hostname
+        self.port = parsedUrl.port or (443 if self.https else 80)
+        self.root = parsedUrl.path if parsedUrl.path.endswith("/") else parsedUrl.path + "/"
+        self.headers = headers
+        self.ssl_context = sslContext
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle_connections = []
+
+    def _connect(self):
+        counters.increment("http_pool_connections")
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _send(self, path: str, headers: dict):
+        # :return: (connection, response); the connection must be given back by _release() once the response is read
+        requestHeaders = dict(self.headers)
+        requestHeaders.update(headers)
+
+        with self.lock:
+            connection = self.idle_connections.pop() if len(self.idle_connections) > 0 else None
+        reused = connection is not None
+        if connection is None:
+            connection = self._connect()
+
+        while True:
+            try:
+                connection.request("GET", path, headers=requestHeaders)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server has closed an idle connection: the request is sent again on a new one
+                connection.close()
+                if not reused:
+                    raise
+                reused = False
+                connection = self._connect()
+            except Exception:
+                connection.close()
+                raise
+
+    def _release(self, connection, response):
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.idle_connections.append(connection)
+
+    def get(self, uri: str, arguments: dict, headers: dict):
+        '''
+        :return: (content type, body)
+        '''
+        path = self.root + uri
+        if len(arguments) > 0:
+            path += "?" + urllib.parse.urlencode(arguments)
+
+        with self.slots:
+            connection, response = self._send(path, headers)
+            try:
+                body = response.read()
+            except Exception:
+                connection.close()
+                raise
+            self._release(connection, response)
+
+        counters.increment("http_pool_requests")
+        if response.status >= 400:
+            raise DicomWebHttpError(self.alias, response.status, path)
+        return response.getheader("Content-Type", ""), body
+
+    def get_parts(self, uri: str, headers: dict):
+        '''
+        Yields the (headers, content) of the parts of a multipart/related answer as soon as they are received,
+        so that a single part is held in memory at a time.
+        '''
+        path = self.root + uri
+        with self.slots:
+            connection, response = self._send(path, headers)
+            counters.increment("http_pool_requests")
+            completed = False
+            try:
+                if response.status >= 400:
+                    response.read()
+                    completed = True
+                    raise DicomWebHttpError(self.alias, response.status, path)
+                yield from IterMultipartRelated(response.read)
+                response.read()     # the epilogue, if any
+                completed = True
+            finally:
+                # a connection whose response has not been fully read can not be reused
+                if completed:
+                    self._release(connection, response)
+                else:
+                    connection.close()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle_connections:
+                connection.close()
+            self.idle_connections = []
+
+class Http2DicomWebClient:
+    '''
+    HTTP/2 client of a DICOMweb server, based on httpx: the requests are multiplexed on a single connection.
+    '''
+    def __init__(self, dicomwebServerAlias: str, url: str, headers: dict, sslContext, timeout: float, size: int) -> None:
+        import httpx
+        self.alias = dicomwebServerAlias
+        self.client = httpx.Client(base_url=url if url.endswith("/") else url + "/", headers=headers, http2=True,
+                                   verify=sslContext, timeout=timeout, limits=httpx.Limits(max_connections=size))
+
+    def get(self, uri: str, arguments: dict, headers: dict):
+        response = self.client.get(uri, params=arguments, headers=headers)
+        counters.increment("http_pool_requests")
+        if response.status_code >= 400:
+            raise DicomWebHttpError(self.alias, response.status_code, uri)
+        return response.headers.get("Content-Type", ""), response.content
+
+    def get_parts(self, uri: str, headers: dict):
+        with self.client.stream("GET", uri, headers=headers) as response:
+            counters.increment("http_pool_requests")
+            if response.status_code >= 400:
+                raise DicomWebHttpError(self.alias, response.status_code, uri)
+            chunks = response.iter_bytes(MULTIPART_READ_SIZE)
+            yield from IterMultipartRelated(lambda size: next(chunks, b''))
+
+    def close(self):
+        self.client.close()
+
+class DicomWebClients:
+    '''
+    The pooled clients of the DICOMweb servers with 'HttpPool', built from their 'DicomWeb.Servers.{alias}'
+    configuration (URL, credentials, HTTP headers, client certificate) and the HTTPS options of Orthanc.
+    The other servers (and the ones defined through the REST API of the DICOMweb plugin) are reached through the
+    Orthanc DICOMweb client.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.configuration = {}
+        self.clients = {}           # alias -> DicomWebClient, or None if the server can not be pooled
+
+    def configure(self, configuration: dict):
+        # :param configuration: the whole Orthanc configuration
+        with self.lock:
+            for client in self.clients.values():
+                if client is not None:
+                    client.close()
+            self.configuration = configuration
+            self.clients = {}
+
+    def _create_client(self, dicomwebServerAlias: str):
+        server = self.configuration.get("DicomWeb", {}).get("Servers", {}).get(dicomwebServerAlias)
+        if server is None:
+            orthanc.LogWarning('HttpPool: the DICOMweb server {0} is not defined in DicomWeb.Servers, it is not pooled'.format(dicomwebServerAlias))
+            return None
+        if self.configuration.get("HttpProxy", "") != "":
+            orthanc.LogWarning('HttpPool: the DICOMweb servers are not pooled since Orthanc uses an HTTP proxy')
+            return None
+
+        if isinstance(server, list):
+            server = {"Url": server[0], "Username": server[1] if len(server) > 1 else None,
+                      "Password": server[2] if len(server) > 2 else None}
+        if server.get("Pkcs11", False):
+            orthanc.LogWarning('HttpPool: the DICOMweb server {0} uses PKCS#11, it is not pooled'.format(dicomwebServerAlias))
+            return None
+
+        headers = dict(server.get("HttpHeaders", {}))
+        if server.get("Username") is not None:
+            credentials = '{0}:{1}'.format(server["Username"], server.get("Password") or "")
+            headers["Authorization"] = "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+
+        if self.configuration.get("HttpsVerifyPeers", True):
+            sslContext = ssl.create_default_context(cafile=self.configuration.get("HttpsCACertificates") or None)
+        else:
+            sslContext = ssl.create_default_context()
+            sslContext.check_hostname = False
+            sslContext.verify_mode = ssl.CERT_NONE
+        if server.get("CertificateFile"):
+            sslContext.load_cert_chain(server["CertificateFile"], server.get("CertificateKeyFile"), server.get("CertificateKeyPassword"))
+
+        timeout = float(self.configuration.get("HttpTimeout", 60)) or None
+        size = max(1, int(GetServerOption(dicomwebServerAlias, "HttpPoolSize")))
+        if GetServerOption(dicomwebServerAlias, "HttpPoolHttp2"):
+            try:
+                return Http2DicomWebClient(dicomwebServerAlias, server["Url"], headers, sslContext, timeout, size)
+            except ImportError:
+                orthanc.LogWarning('HttpPoolHttp2: the httpx and h2 python packages are not installed, HTTP/1.1 is used for {0}'.format(dicomwebServerAlias))
+        return DicomWebClient(dicomwebServerAlias, server["Url"], headers, sslContext, timeout, size)
+
+    def get_client(self, dicomwebServerAlias: str):
+        if not GetServerOption(dicomwebServerAlias, "HttpPool"):
+            return None
+        with self.lock:
+            if dicomwebServerAlias not in self.clients:
+                self.clients[dicomwebServerAlias] = self._create_client(dicomwebServerAlias)
+            return self.clients[dicomwebServerAlias]
+
+dicomweb_clients = DicomWebClients()
+
+def DicomWebRequest(dicomwebServerAlias: str, route: str, payloadDict: dict):
+    '''
+    Sends a request to a DICOMweb server, as the '/dicom-web/servers/{alias}/get' and '/retrieve' routes of the
+    Orthanc DICOMweb plugin do, through the pooled client of the server if 'HttpPool' is enabled.
+    With the pooled client, the instances retrieved by 'retrieve' are stored in Orthanc through '/instances' one by one,
+    as soon as they are received.
+    '''
+    client = dicomweb_clients.get_client(dicomwebServerAlias)
+    if client is None:
+        return orthanc.RestApiPostAfterPlugins('/dicom-web/servers/{0}/{1}'.format(dicomwebServerAlias, route), json.dumps(payloadDict))
+
+    if route == "get":
+        _, body = client.get(payloadDict["Uri"], payloadDict.get("Arguments", {}), payloadDict.get("HttpHeaders", {}))
+        return body
+
+    headers = {"Accept": 'multipart/related; type="application/dicom"'}
+    headers.update(payloadDict.get("HttpHeaders", {}))
+    for resource in payloadDict["Resources"]:
+        uri = "studies/{0}".format(resource["Study"])
+        if "Series" in resource:
+            uri += "/series/{0}".format(resource["Series"])
+            if "Instance" in resource:
+                uri += "/instances/{0}".format(resource["Instance"])
+        for _, content in client.get_parts(uri, headers):
+            orthanc.RestApiPost('/instances', content)
+    return "{}"
+
 def GetMimeNameFromCharSet(charSet: str):
     '''
     Allows to get a valid 'Accept-Charset'  value for the dicomweb query, based on the DICOM tag 'SpecificCharacterSet'
@@ -60,98 +519,670 @@ def GetLevel(dicomLevel: str):
     LEVEL_MAPPING = {
         'IMAGE': 'instances',
         'SERIES': 'series',
-        'STUDY': 'studies'
+        'STUDY': 'studies',
+        'PATIENT': 'studies'    # there is no patient level in QIDO-RS, see PatientAnswers
     }
-    # defaulting to 'studies', patient level is not supported
+    # defaulting to 'studies'
     return LEVEL_MAPPING.get(dicomLevel, "studies")
 
-def QidoRs(query, dicomwebServerAlias = None):
+class QidoRsPage(list):
     '''
-    Builds a Qido RS query from the DICOM query received;
-    Queries the dicomweb server;
-    Returns the result (dict)
+    The answers of a QIDO-RS query (list of dict) + the raw response they have been parsed from
+    '''
+    raw = ""
+
+# the patient-level attributes computed by the proxy from the studies of each patient -> the study-level attribute
+# that is summed up (None: the studies are counted)
+PATIENT_AGGREGATED_TAGS = {
+    '00201200': None,           # NumberOfPatientRelatedStudies
+    '00201202': '00201206',     # NumberOfPatientRelatedSeries <- NumberOfStudyRelatedSeries
+    '00201204': '00201208'      # NumberOfPatientRelatedInstances <- NumberOfStudyRelatedInstances
+}
+
+# the unique key that is returned in the patient-level C-find answers, even if the SCU did not request it
+PATIENT_UNIQUE_TAGS = {'00100020'}
+
+# the tags that are returned in all the C-find answers, even if the SCU did not request them: without the
+# SpecificCharacterSet of the answer, orthanc.CreateDicom would decode the names with the default character set
+ANSWER_CHARSET_TAGS = {'00080005'}
+
+# the unique keys that are returned in the C-find answers, even if the SCU did not request them
+LEVEL_UNIQUE_TAGS = {
+    'studies': {'0020000D'},
+    'series': {'0020000D', '0020000E'},
+    'instances': {'0020000D', '0020000E', '00080018'}
+}
+
+def QidoRsPages(dicomwebServerAlias: str, uri: str, arguments: dict, acceptCharset: str = "UTF-8",
+                pageSize: int = 0, maxResults: int = 0, untilEmptyPage: bool = False):
     '''
+    Queries the dicomweb server, page by page if pageSize > 0 (thanks to the 'limit' and 'offset' arguments);
+    Yields the answers of each page (list of dict) as soon as it is received;
+    If maxResults > 0, at most maxResults + 1 answers are requested, so that the caller can detect
+    that there are too many matches.
+    If untilEmptyPage, the pages are requested until an empty one, since a server capping the number of
+    answers per query (below pageSize) also answers with a short page.
+    '''
+    offset = 0
+    while True:
+        pageArguments = dict(arguments)
+
+        limit = pageSize
+        if maxResults > 0:
+            remaining = maxResults + 1 - offset
+            limit = remaining if limit <= 0 else min(limit, remaining)
+        if limit > 0:
+            pageArguments["limit"] = str(limit)
+        if offset > 0:
+            pageArguments["offset"] = str(offset)
 
-    # let's build the query
+        payloadDict = {
+            "Uri": uri,
+            "HttpHeaders": {
+                "Accept": "application/dicom",
+                "Accept-Charset": acceptCharset
+            },
+            "Arguments": pageArguments
+        }
+
+        with metrics.timer("qido_request_seconds", server=dicomwebServerAlias):
+            r = DicomWebRequest(dicomwebServerAlias, "get", payloadDict)
+        metrics.increment("dicomweb_received_bytes", len(r or b''), server=dicomwebServerAlias)
+
+        # some servers answer with an empty body when there are no matches
+        page = QidoRsPage(json.loads(r) if r else [])
+        page.raw = r
+        yield page
+
+        # a page shorter than requested is the last one
+        if limit <= 0 or len(page) == 0 or (len(page) < limit and not untilEmptyPage):
+            return
+        offset += len(page)
+        if maxResults > 0 and offset > maxResults:
+            return
+
+# number of answers requested per QIDO-RS query when listing the instances to move, if 'QidoPageSize' is 0
+QIDO_LISTING_PAGE_SIZE = 500
+
+# the UID that identifies an answer at each level
+LEVEL_UID_TAG = {
+    'studies': '0020000D',
+    'series': '0020000E',
+    'instances': '00080018'
+}
+
+class FindCache:
+    '''
+    LRU cache of the QIDO-RS responses, keyed on the normalized query (server, level, arguments, charset).
+    The raw responses are kept (and parsed again on hits) so that 'FindCacheMaxBytes' is the actual memory bound.
+    Identical queries received while the first one is still in progress are coalesced: they wait for its
+    responses instead of querying the DICOMweb server again.
+    '''
+    class InFlightQuery:
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.raw_pages = None   # None if the query failed or has been aborted
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (expiration, size, raw pages)
+        self.in_flight = {}             # key -> InFlightQuery
+        self.total_bytes = 0
+
+    def _store(self, key, ttl: float, raw_pages: List[str]):
+        size = sum(len(raw) for raw in raw_pages)
+        max_bytes = GetOption("FindCacheMaxBytes")
+        if size > max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (time.monotonic() + ttl, size, raw_pages)
+            self.total_bytes += size
+
+            # evict the least recently used entries
+            while self.total_bytes > max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                counters.increment("find_cache_evictions")
+
+    def get_pages(self, key, ttl: float, query_pages):
+        '''
+        Yields the pages of answers for this query: from the cache, from an identical query in progress
+        or from query_pages() (the DICOMweb server).
+        '''
+        if ttl <= 0:
+            yield from query_pages()
+            return
+
+        leader = False
+        raw_pages = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                raw_pages = entry[2]
+            elif key in self.in_flight:
+                in_flight = self.in_flight[key]
+            else:
+                in_flight = self.in_flight[key] = FindCache.InFlightQuery()
+                leader = True
+
+        if raw_pages is not None:
+            counters.increment("find_cache_hits")
+            for raw in raw_pages:
+                yield json.loads(raw) if raw else []
+            return
+
+        if not leader:
+            counters.increment("find_cache_coalesced")
+            in_flight.done.wait()
+            if in_flight.raw_pages is not None:
+                for raw in in_flight.raw_pages:
+                    yield json.loads(raw) if raw else []
+                return
+            # the first query has failed: let's try on our own
+            yield from query_pages()
+            return
+
+        counters.increment("find_cache_misses")
+        collected = []
+        completed = False
+        try:
+            # the pages are forwarded as soon as they are received, the cache is filled at the end
+            for page in query_pages():
+                collected.append(page.raw)
+                yield page
+            completed = True
+            self._store(key, ttl, collected)
+            in_flight.raw_pages = collected
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            in_flight.done.set()
+            if not completed:
+                counters.increment("find_cache_aborted")
+
+    def get_statistics(self) -> dict:
+        statistics = counters.get_all()
+        hits = statistics.get("find_cache_hits", 0) + statistics.get("find_cache_coalesced", 0)
+        total = hits + statistics.get("find_cache_misses", 0)
+        with self.lock:
+            return {
+                "find_cache_entries": len(self.entries),
+                "find_cache_bytes": self.total_bytes,
+                "find_cache_hit_ratio": (hits / total) if total > 0 else 0
+            }
+
+find_cache = FindCache()
+
+def GetFindQueryTag(query, index: int) -> str:
+    # the tag as it is formatted in the DICOM JSON model (e.g. '0020000D')
+    return '{0:04X}{1:04X}'.format(query.GetFindQueryTagGroup(index), query.GetFindQueryTagElement(index))
+
+def ParseFindQuery(query, includeField: bool = False):
+    '''
+    Converts the DICOM query received into the elements of a Qido RS query
+    If includeField is True, only the matching keys (with a value) are sent as filters and the return keys
+    (universal matching, without value) are sent in the 'includefield' argument.
+    :return: (level, arguments, acceptCharset)
+    '''
     arguments = {}
+    returnKeys = []
+    level = "studies"
     acceptCharset = "UTF-8"
+    patientLevel = GetFindQueryRetrieveLevel(query) == "PATIENT"
     for i in range(query.GetFindQuerySize()):
         # The QueryRetrieveLevel (0008,0052) is not needed in the Qido Args, but in the Uri
         if query.GetFindQueryTagName(i) == "QueryRetrieveLevel":
             level = GetLevel(query.GetFindQueryValue(i))
         elif query.GetFindQueryTagName(i) == "SpecificCharacterSet":
             acceptCharset = GetMimeNameFromCharSet(query.GetFindQueryValue(i))
+        elif patientLevel and GetFindQueryTag(query, i) in PATIENT_AGGREGATED_TAGS:
+            # computed by the proxy from the study-level attributes
+            summedTag = PATIENT_AGGREGATED_TAGS[GetFindQueryTag(query, i)]
+            if includeField and summedTag is not None:
+                returnKeys.append(summedTag)
+        elif includeField and query.GetFindQueryValue(i) == "":
+            returnKeys.append(GetFindQueryTag(query, i))
         else:
             tag = query.GetFindQueryTagName(i)
             arguments[tag] = query.GetFindQueryValue(i)
 
+    if len(returnKeys) > 0:
+        arguments["includefield"] = ",".join(returnKeys)
+
+    return level, arguments, acceptCharset
+
+def GetFindQueryRetrieveLevel(query) -> str:
+    # the DICOM level of the query ('PATIENT', 'STUDY', 'SERIES' or 'IMAGE')
+    for i in range(query.GetFindQuerySize()):
+        if query.GetFindQueryTagName(i) == "QueryRetrieveLevel":
+            return query.GetFindQueryValue(i)
+    return "STUDY"
+
+def GetFindQueryLevel(query) -> str:
+    # the QIDO-RS level of the query
+    return GetLevel(GetFindQueryRetrieveLevel(query))
+
+def GetRequestedTags(query):
+    '''
+    Lists the tags that shall be present in the C-find answers: the keys of the DICOM query + the unique keys of the level
+    + the SpecificCharacterSet
+    :return: a set of tags formatted as in the DICOM JSON model
+    '''
+    requestedTags = set(ANSWER_CHARSET_TAGS)
+    for i in range(query.GetFindQuerySize()):
+        if query.GetFindQueryTagName(i) != "QueryRetrieveLevel":
+            requestedTags.add(GetFindQueryTag(query, i))
+
+    if GetFindQueryRetrieveLevel(query) == "PATIENT":
+        requestedTags.update(PATIENT_UNIQUE_TAGS)
+    else:
+        requestedTags.update(LEVEL_UNIQUE_TAGS[GetFindQueryLevel(query)])
+    return requestedTags
+
+def QidoRs(query, dicomwebServerAlias = None):
+    '''
+    Builds a Qido RS query from the DICOM query received;
+    Queries the dicomweb server (or gets the result from the cache);
+    Yields the result, page by page (list of dict)
+    '''
+
+    # let's build the query
+    level, arguments, acceptCharset = ParseFindQuery(query, includeField=GetServerOption(dicomwebServerAlias, "QidoIncludeField"))
+
     if verbose_enabled:
         pprint.pprint("original C-find query:")
         pprint.pprint(arguments)
 
-    payloadDict = {
-        "Uri": level,
-        "HttpHeaders": {
-            "Accept": "application/dicom",
-            "Accept-Charset": acceptCharset
-        },
-        "Arguments": arguments
-    }
-
     # let's send the query and return the result
-    r = orthanc.RestApiPostAfterPlugins('/dicom-web/servers/{0}/get'.format(dicomwebServerAlias), json.dumps(payloadDict))
+    def QueryPages():
+        return QidoRsPages(dicomwebServerAlias=dicomwebServerAlias,
+                           uri=level,
+                           arguments=arguments,
+                           acceptCharset=acceptCharset,
+                           pageSize=int(GetServerOption(dicomwebServerAlias, "QidoPageSize")),
+                           maxResults=int(GetServerOption(dicomwebServerAlias, "QidoMaxResults")))
+
+    cacheKey = (dicomwebServerAlias, level, tuple(sorted(arguments.items())), acceptCharset)
+    yield from find_cache.get_pages(key=cacheKey,
+                                    ttl=float(GetServerOption(dicomwebServerAlias, "FindCacheTtl")),
+                                    query_pages=QueryPages)
+
+class FederationRoutes:
+    '''
+    The DICOMweb server that has reported each UID in the answers of a federated C-find, so that the C-moves
+    from the federation are sent to this server. The least recently reported UIDs are forgotten first.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # (federation, uid) -> server alias
+
+    def set(self, federation: str, uid: str, dicomwebServerAlias: str):
+        with self.lock:
+            self.entries[(federation, uid)] = dicomwebServerAlias
+            self.entries.move_to_end((federation, uid))
+            while len(self.entries) > FEDERATION_ROUTES_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def get(self, federation: str, uid: str):
+        with self.lock:
+            return self.entries.get((federation, uid))
 
-    return json.loads(r)
+federation_routes = FederationRoutes()
 
-def BuildTagsListFromDicomWebAnswer(answer):
+def FederatedQidoRs(query, federation: str, dicomwebServerAliases: List[str], incompleteServers: List[str]):
     '''
-    Builds a tags list as it is expected by the DICOM protocol.
+    Sends the C-find query to all the servers of a federation in parallel;
+    Yields (server alias, answers) as soon as a page is received from a server, without the answers that have
+    already been received from another server (same UID);
+    The servers that fail or do not answer within 'FederationTimeout' are added to incompleteServers.
+    '''
+    level = GetFindQueryLevel(query)
+    uidTag = LEVEL_UID_TAG[level]
+    timeout = float(GetServerOption(federation, "FederationTimeout"))
+    counters.increment("federation_queries")
+
+    received = queue.Queue()
+
+    def QueryServer(dicomwebServerAlias):
+        try:
+            for page in QidoRs(query=query, dicomwebServerAlias=dicomwebServerAlias):
+                received.put((dicomwebServerAlias, page))
+        except Exception as e:
+            orthanc.LogWarning('Federated C-find on {0}: the server {1} has failed ({2})'.format(federation, dicomwebServerAlias, e))
+            received.put((dicomwebServerAlias, e))
+        received.put((dicomwebServerAlias, None))
+
+    # the slow servers are not waited for: their threads end on their own
+    executor = ThreadPoolExecutor(max_workers=len(dicomwebServerAliases), thread_name_prefix="federation-{0}".format(federation))
+    for dicomwebServerAlias in dicomwebServerAliases:
+        executor.submit(QueryServer, dicomwebServerAlias)
+    executor.shutdown(wait=False)
+
+    deadline = time.monotonic() + timeout
+    pending = set(dicomwebServerAliases)
+    receivedUids = set()
+    while len(pending) > 0:
+        try:
+            dicomwebServerAlias, page = received.get(timeout=max(0, deadline - time.monotonic()) if timeout > 0 else None)
+        except queue.Empty:
+            break
+
+        if page is None:
+            pending.discard(dicomwebServerAlias)
+            continue
+        if isinstance(page, Exception):
+            counters.increment("federation_failures")
+            incompleteServers.append(dicomwebServerAlias)
+            continue
+
+        answers = []
+        for answer in page:
+            uids = answer.get(uidTag, {}).get('Value', [])
+            if len(uids) > 0:
+                if uids[0] in receivedUids:
+                    counters.increment("federation_duplicates")
+                    continue
+                receivedUids.add(uids[0])
+                federation_routes.set(federation, uids[0], dicomwebServerAlias)
+                if level != 'studies' and len(answer.get('0020000D', {}).get('Value', [])) > 0:
+                    federation_routes.set(federation, answer['0020000D']['Value'][0], dicomwebServerAlias)
+            answers.append(answer)
+        yield dicomwebServerAlias, answers
+
+    if len(pending) > 0:
+        counters.increment("federation_timeouts", len(pending))
+        incompleteServers.extend(pending)
+
+# JSON encoding of a str, including the quotes (C implementation from the json module)
+EncodeJsonString = json.encoder.encode_basestring_ascii
+
+def ConvertStringValues(converter, values) -> str:
+    # most of the VRs (CS, LO, DA, TM, UI, IS, DS...): the values are joined with the DICOM separator
+    if len(values) == 1:
+        value = values[0]
+        return EncodeJsonString('' if value is None else str(value))
+    return EncodeJsonString('\\'.join('' if value is None else str(value) for value in values))
+
+def ConvertPersonNameValues(converter, values) -> str:
+    # PN: {"Alphabetic": "Doe^John", "Ideographic": ..., "Phonetic": ...} -> "Doe^John=...=..."
+    names = []
+    for value in values:
+        if value is None:
+            names.append('')
+        elif isinstance(value, dict):
+            names.append('='.join([value.get('Alphabetic', ''), value.get('Ideographic', ''), value.get('Phonetic', '')]).rstrip('='))
+        else:
+            names.append(str(value))
+    return EncodeJsonString('\\'.join(names))
+
+def ConvertSequenceValues(converter, values) -> str:
+    # SQ: each item is a DICOM JSON dataset, converted into a JSON object (all the tags of the items are kept)
+    return '[' + ','.join(converter.encode_dataset(item, None) for item in values) + ']'
+
+VR_CONVERTERS = {
+    'PN': ConvertPersonNameValues,
+    'SQ': ConvertSequenceValues
+}
+
+class FindAnswerConverter:
+    '''
+    Converts the answers of a QIDO-RS query into the JSON expected by orthanc.CreateDicom.
     We have to go from that:
     {
-        "00080020" :
-        {
-            "Value" : [ "20130812" ],
-            "vr" : "DA"
-        }
+        "00080020" : { "vr" : "DA", "Value" : [ "20130812" ] },
+        "00080061" : { "vr" : "CS", "Value" : [ "CT", "PT" ] },
+        "00100010" : { "vr" : "PN", "Value" : [ { "Alphabetic" : "Doe^John" } ] }
     }
     to something like that:
     {
-        "00080020" : "20130812"
+        "00080020" : "20130812",
+        "00080061" : "CT\\PT",
+        "00100010" : "Doe^John"
     }
-    :param answer: a dict, as returned by a dicomweb server
-    :return: a dict, as expected by a dicom server
+    Sequences are converted into a list of JSON objects.
+    The converter of each tag is selected once per query from its VR (VR_CONVERTERS), when the tag is met
+    for the first time, and the JSON is written in one pass without building an intermediate dict.
     '''
-
-    dicomDict = {}
-    for tag, value_info in answer.items():
-        # some tags don't have any value...
-        if "Value" in value_info:
-            value = value_info["Value"][0]
-            # some tags contain a dict...
-            if isinstance(value, dict):
-                # If the value is a dictionary, extract the appropriate field
-                if "Alphabetic" in value:
-                    dicomDict[tag] = value["Alphabetic"]
-                else:
-                    #raise Exception('The tag {0} does contain this dict: {1}, but this dict is not expected in the proxy plugin!'.format(tag, value))
-                    dicomDict.update(BuildTagsListFromDicomWebAnswer(value))
-
-            # most of the tags simply contain a value:
+    def __init__(self, requestedTags = None) -> None:
+        # if not None, only these tags are converted (the other ones are not sent to the SCU)
+        self.requested_tags = requestedTags
+        self.compiled = {}      # tag -> (vr, JSON key, converter)
+
+    def _compile(self, tag: str, vr, values):
+        if vr is None:
+            # the VR is mandatory in the DICOM JSON model, but let's not fail if a server forgets it
+            first = values[0] if len(values) > 0 else None
+            if isinstance(first, dict):
+                vr = 'PN' if any(key in first for key in ('Alphabetic', 'Ideographic', 'Phonetic')) else 'SQ'
+
+        entry = (vr, EncodeJsonString(tag) + ':', VR_CONVERTERS.get(vr, ConvertStringValues))
+        self.compiled[tag] = entry
+        return entry
+
+    def encode_dataset(self, dataset: dict, requestedTags) -> str:
+        compiled = self.compiled
+        parts = []
+        for tag, value_info in dataset.items():
+            if requestedTags is not None and tag not in requestedTags:
+                continue
+
+            # some tags don't have any value...
+            values = value_info.get("Value")
+            if values is None:
+                continue
+
+            vr = value_info.get("vr")
+            entry = compiled.get(tag)
+            if entry is None or entry[0] != vr:
+                entry = self._compile(tag, vr, values)
+            _, key, converter = entry
+
+            # fast path for the most frequent case: a single string value
+            if converter is ConvertStringValues and len(values) == 1 and type(values[0]) is str:
+                parts.append(key + EncodeJsonString(values[0]))
             else:
-                dicomDict[tag] = str(value)
+                parts.append(key + converter(self, values))
 
-    return dicomDict
+        return '{' + ','.join(parts) + '}'
 
-def OnFind(answers, query, issuerAet, calledAet):
+    def convert(self, answer: dict) -> str:
+        '''
+        :param answer: a dict, as returned by a dicomweb server
+        :return: the JSON, as expected by orthanc.CreateDicom
+        '''
+        return self.encode_dataset(answer, self.requested_tags)
 
-    dicomWebAnswer = QidoRs(query=query, dicomwebServerAlias=calledAet)
+class PatientAnswers:
+    '''
+    Patient-level C-find answers built from the study-level QIDO-RS answers: one answer per PatientID (and
+    IssuerOfPatientID), with the patient attributes of its first study and the NumberOfPatientRelated*
+    attributes computed from all its studies.
+    '''
+    def __init__(self) -> None:
+        self.patients = OrderedDict()   # (patient id, issuer) -> dataset
+        self.study_uids = set()         # not to count twice a study received twice
+
+    def add(self, study: dict):
+        studyInstanceUid = study.get('0020000D', {}).get('Value', [None])[0]
+        if studyInstanceUid is not None:
+            if studyInstanceUid in self.study_uids:
+                return
+            self.study_uids.add(studyInstanceUid)
+
+        def GetValue(tag):
+            values = study.get(tag, {}).get('Value', [])
+            return values[0] if len(values) > 0 else None
+
+        key = (GetValue('00100020'), GetValue('00100021'))
+        dataset = self.patients.get(key)
+        if dataset is None:
+            # the attributes of the patient module (group 0010) + the character set of the answer
+            dataset = {tag: value for tag, value in study.items() if tag.startswith('0010') or tag == '00080005'}
+            for tag in PATIENT_AGGREGATED_TAGS:
+                dataset[tag] = {"vr": "IS", "Value": [0]}
+            self.patients[key] = dataset
+
+        for tag, summedTag in PATIENT_AGGREGATED_TAGS.items():
+            if summedTag is None:
+                dataset[tag]["Value"][0] += 1
+            else:
+                try:
+                    dataset[tag]["Value"][0] += int(GetValue(summedTag) or 0)
+                except ValueError:
+                    pass
 
-    for answer in dicomWebAnswer:
-        dicomTagsList = BuildTagsListFromDicomWebAnswer(answer)
+    def __len__(self) -> int:
+        return len(self.patients)
 
-        answers.FindAddAnswer(orthanc.CreateDicom(
-            json.dumps(dicomTagsList), None, orthanc.CreateDicomFlags.NONE))
+    def __iter__(self):
+        return iter(self.patients.values())
 
+def OnFind(answers, query, issuerAet, calledAet):
+    start = time.monotonic()
+    traceId = NewTraceId()
+    orthanc.LogInfo('[{0}] C-find from {1} on {2} at the {3} level'.format(traceId, issuerAet, calledAet, GetFindQueryLevel(query)))
+
+    maxResults = int(GetServerOption(calledAet, "QidoMaxResults"))
+    answersCount = 0
+    truncated = False
+
+    # the tags the SCU did not ask for are not converted
+    requestedTags = None
+    if GetServerOption(calledAet, "QidoIncludeField"):
+        requestedTags = GetRequestedTags(query)
+    converter = FindAnswerConverter(requestedTags)
+
+    # the patient-level answers are sent once all the studies have been received
+    patientAnswers = None
+    if GetFindQueryRetrieveLevel(query) == "PATIENT":
+        patientAnswers = PatientAnswers()
+
+    # the first studies found are prefetched since a C-move of one of them is likely to follow
+    prefetchCount = 0
+    if GetFindQueryLevel(query) == "studies":
+        prefetchCount = int(GetServerOption(calledAet, "StudyPrefetchCount"))
+    prefetchedStudies = {}          # server alias -> study instance uids
+    prefetchedCount = 0
+
+    # a called AET that is a federation queries all its servers at once
+    federationServers = GetFederationServers(calledAet)
+    incompleteServers = []
+    if federationServers is not None:
+        pages = FederatedQidoRs(query, calledAet, federationServers, incompleteServers)
+    else:
+        pages = ((calledAet, page) for page in QidoRs(query=query, dicomwebServerAlias=calledAet))
+
+    # the answers of each page are sent to the SCU before the next page is requested
+    # (there are no more pages once more than maxResults answers have been received)
+    for dicomwebServerAlias, dicomWebAnswer in pages:
+        conversionStart = time.monotonic()
+        for answer in dicomWebAnswer:
+            if maxResults > 0 and answersCount >= maxResults:
+                truncated = True
+                break
+
+            if patientAnswers is not None:
+                patientAnswers.add(answer)
+            else:
+                answers.FindAddAnswer(orthanc.CreateDicom(
+                    converter.convert(answer), None, orthanc.CreateDicomFlags.NONE))
+            answersCount += 1
+
+            if prefetchedCount < prefetchCount and len(answer.get('0020000D', {}).get('Value', [])) > 0:
+                prefetchedStudies.setdefault(dicomwebServerAlias, []).append(answer['0020000D']['Value'][0])
+                prefetchedCount += 1
+
+        # (the conversion of the answers of a page, sent to the SCU as they are converted)
+        metrics.observe("find_conversion_seconds", time.monotonic() - conversionStart, server=dicomwebServerAlias)
+
+        # (the federated queries are completed, and cached, by their own threads)
+        if truncated and federationServers is not None:
+            break
+
+    if patientAnswers is not None:
+        # (QidoMaxResults limits the number of studies the patients are built from)
+        conversionStart = time.monotonic()
+        for answer in patientAnswers:
+            answers.FindAddAnswer(orthanc.CreateDicom(
+                converter.convert(answer), None, orthanc.CreateDicomFlags.NONE))
+        metrics.observe("find_conversion_seconds", time.monotonic() - conversionStart, server=calledAet)
+        answersCount = len(patientAnswers)
+
+    for dicomwebServerAlias, studyInstanceUids in prefetchedStudies.items():
+        study_prefetcher.prefetch(dicomwebServerAlias, studyInstanceUids)
+
+    if truncated:
+        # too many matches: the SCU gets the first ones only and the C-find is reported as incomplete
+        orthanc.LogWarning('[{0}] C-find on {1}: more than {2} matches, the answers are truncated'.format(traceId, calledAet, maxResults))
+        answers.FindMarkIncomplete()
+    elif len(incompleteServers) > 0:
+        # the SCU gets the answers of the other servers
+        orthanc.LogWarning('[{0}] Federated C-find on {1}: no answers from {2}'.format(traceId, calledAet, ', '.join(incompleteServers)))
+        answers.FindMarkIncomplete()
+
+    duration = time.monotonic() - start
+    metrics.observe("find_seconds", duration, called_aet=calledAet)
+    metrics.increment("find_answers", answersCount, called_aet=calledAet)
+    orthanc.LogInfo('[{0}] C-find on {1}: {2} answers in {3:.3f} s'.format(traceId, calledAet, answersCount, duration))
+
+
+class ModalityAliasCache:
+    '''
+    In-process index from AET to Orthanc modality alias, built from '/modalities?expand'.
+    The index is trusted during 'ModalitiesCacheTtl' seconds, and rebuilt before that if the modalities
+    are modified through the REST API or if an AET is not found (a modality might have just been added).
+    Since the modifications are seen before they are applied, the index is rebuilt on each lookup during
+    MODALITIES_CHANGE_DELAY seconds after a modification, and only an index built after that is trusted.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.aliases = {}
+        self.last_refresh = None
+        self.trusted_after = None   # the indexes built before this time are not trusted
+
+    def invalidate(self):
+        with self.lock:
+            self.last_refresh = None
+            self.trusted_after = time.monotonic() + MODALITIES_CHANGE_DELAY
+
+    def refresh(self):
+        # (the time of the refresh is taken before the modalities are read)
+        refresh_time = time.monotonic()
+        modalities = json.loads(orthanc.RestApiGet('/modalities?expand'))
+
+        aliases = {}
+        for modality, modalityDetails in modalities.items():
+            # if 2 modalities share the same AET, the first one wins (as with a linear scan)
+            aliases.setdefault(modalityDetails["AET"], modality)
+
+        with self.lock:
+            self.aliases = aliases
+            self.last_refresh = refresh_time
+        counters.increment("modalities_cache_refreshes")
+
+    def lookup(self, AET):
+        with self.lock:
+            alias = None
+            if (self.last_refresh is not None and time.monotonic() - self.last_refresh < GetOption("ModalitiesCacheTtl")
+                    and (self.trusted_after is None or self.last_refresh >= self.trusted_after)):
+                alias = self.aliases.get(AET)
+
+        if alias is not None:
+            counters.increment("modalities_cache_hits")
+            return alias
+
+        # stale index or unknown AET: let's look again in the current configuration
+        counters.increment("modalities_cache_misses")
+        self.refresh()
+
+        with self.lock:
+            return self.aliases.get(AET)
+
+modality_alias_cache = ModalityAliasCache()
 
 def GetOrthancAliasFromAET(AET):
     '''
@@ -159,31 +1190,1011 @@ def GetOrthancAliasFromAET(AET):
     :param AET: AET to send the resource to
     :return: the Orthanc alias corresponding to the AET
     '''
-    modalities = json.loads(orthanc.RestApiGet('/modalities?expand'))
-
-    for modality, modalityDetails in modalities.items():
-        if modalityDetails["AET"] == AET:
-            return modality
+    alias = modality_alias_cache.lookup(AET)
+    if alias is not None:
+        return alias
 
     raise Exception('It seems that the modality issuing the original DICOM query is not registered in the Proxy config!')
 
+def OnIncomingHttpRequest(uri, **request):
+    # the AET -> alias index must be rebuilt as soon as a modality is added, modified or removed
+    # (this filter runs before the modification is applied, see ModalityAliasCache)
+    if uri.startswith('/modalities/') and request.get('method') in {orthanc.HttpMethod.PUT, orthanc.HttpMethod.DELETE}:
+        modality_alias_cache.invalidate()
+
+    return True
 
+def GetStatistics() -> dict:
+    statistics = counters.get_all()
+    statistics.update(find_cache.get_statistics())
+    statistics.update(instance_cache.get_statistics())
+    statistics.update(study_prefetcher.get_statistics())
+    statistics["scheduler"] = request_scheduler.get_statistics()
+    return statistics
 
+def GetStatisticsCallback(output, uri, **request):
+    if request['method'] != 'GET':
+        output.SendMethodNotAllowed('GET')
+    else:
+        output.AnswerBuffer(json.dumps(GetStatistics(), indent=2), 'application/json')
 
-@dataclasses.dataclass
+def GetMetricsCallback(output, uri, **request):
+    # the statistics and the latency histograms in the Prometheus text format
+    if request['method'] != 'GET':
+        output.SendMethodNotAllowed('GET')
+    else:
+        output.AnswerBuffer(metrics.get_prometheus_text(GetStatistics()), 'text/plain; version=0.0.4')
+
+
+
+
+@dataclasses.dataclass(slots=True)
 class RemoteInstance:
     study_instance_uid: str
     series_instance_uid: str
     sop_instance_uid: str
 
+class RemoteInstancesList:
+    '''
+    Compact list of the instances to retrieve for a C-move.
+    A study can contain thousands of instances but only a few series: the study/series UIDs are stored (interned)
+    once per series, each instance only costs its SOPInstanceUID and the index of its series in an array.
+    The RemoteInstance objects are built on access.
+    '''
+    __slots__ = ("series", "series_indexes", "series_lookup", "sop_instance_uids")
+
+    def __init__(self) -> None:
+        self.series = []                        # (study uid, series uid)
+        self.series_lookup = {}                 # (study uid, series uid) -> index in self.series
+        self.series_indexes = array.array('I')  # index in self.series, for each instance
+        self.sop_instance_uids = []
+
+    def append(self, study_instance_uid: str, series_instance_uid: str, sop_instance_uid: str):
+        key = (sys.intern(study_instance_uid), sys.intern(series_instance_uid))
+        series_index = self.series_lookup.get(key)
+        if series_index is None:
+            series_index = len(self.series)
+            self.series.append(key)
+            self.series_lookup[key] = series_index
+
+        self.series_indexes.append(series_index)
+        self.sop_instance_uids.append(sop_instance_uid)
+
+    def __len__(self) -> int:
+        return len(self.sop_instance_uids)
+
+    def sort_by_series(self):
+        # group the instances of the same series together (keeping their order within the series)
+        order = sorted(range(len(self.sop_instance_uids)), key=self.series_indexes.__getitem__)
+        self.series_indexes = array.array('I', (self.series_indexes[i] for i in order))
+        self.sop_instance_uids = [self.sop_instance_uids[i] for i in order]
+
+    def get_series_index(self, index: int) -> int:
+        return self.series_indexes[index]
+
+    def __getitem__(self, index: int) -> RemoteInstance:
+        study_instance_uid, series_instance_uid = self.series[self.series_indexes[index]]
+        return RemoteInstance(study_instance_uid=study_instance_uid,
+                              series_instance_uid=series_instance_uid,
+                              sop_instance_uid=self.sop_instance_uids[index])
+
+def ParseMultipartHeaders(rawHeaders) -> dict:
+    # the headers of a part, with lower case names
+    headers = {}
+    for line in bytes(rawHeaders).split(b'\r\n'):
+        name, _, value = line.decode('latin-1').partition(':')
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def ParseMultipartRelated(body: bytes):
+    '''
+    Extracts the parts of a multipart/related WADO-RS answer.
+    The boundary is read from the first line of the body since the headers of the answer are not available.
+    :return: a list of (headers, content) where headers is a dict with lower case names
+    '''
+    if isinstance(body, str):
+        body = body.encode('latin-1')
+
+    start = body.find(b'--')
+    end_of_line = body.find(b'\r\n', start)
+    if start < 0 or end_of_line < 0:
+        raise Exception('The WADO-RS answer is not a multipart answer!')
+
+    delimiter = b'\r\n' + body[start:end_of_line]
+    parts = []
+    position = end_of_line + 2
+    while position < len(body):
+        if body.startswith(b'\r\n', position):
+            # a part without headers
+            headers_end = position
+        else:
+            headers_end = body.find(b'\r\n\r\n', position)
+            if headers_end < 0:
+                break
+        content_start = headers_end + (2 if headers_end == position else 4)
+        content_end = body.find(delimiter, content_start)
+        if content_end < 0:
+            raise Exception('The WADO-RS answer is truncated!')
+
+        parts.append((ParseMultipartHeaders(body[position:headers_end]), body[content_start:content_end]))
+
+        position = content_end + len(delimiter)
+        if body.startswith(b'--', position):
+            break
+        position += 2
+
+    return parts
+
+def IterMultipartRelated(read):
+    '''
+    Streaming version of ParseMultipartRelated: the answer is read by chunks of MULTIPART_READ_SIZE bytes with
+    read(size) (that returns b'' at the end) and each part is yielded as soon as it is complete.
+    '''
+    buffer = bytearray()
+    position = 0
+
+    def Fill():
+        # :return: False at the end of the answer
+        nonlocal position
+        chunk = read(MULTIPART_READ_SIZE)
+        if not chunk:
+            return False
+        # the parts already yielded are dropped (at most once per chunk, not once per part)
+        del buffer[:position]
+        position = 0
+        buffer.extend(chunk)
+        return True
+
+    while True:
+        start = buffer.find(b'--')
+        end_of_line = buffer.find(b'\r\n', start) if start >= 0 else -1
+        if end_of_line >= 0:
+            break
+        if not Fill():
+            raise Exception('The WADO-RS answer is not a multipart answer!')
+
+    delimiter = b'\r\n' + bytes(buffer[start:end_of_line])
+    position = end_of_line + 2
+    while True:
+        while True:
+            if buffer.startswith(b'\r\n', position):
+                # a part without headers
+                headers_end = position
+                break
+            headers_end = buffer.find(b'\r\n\r\n', position)
+            if headers_end >= 0:
+                break
+            if not Fill():
+                return
+        content_start = headers_end + (2 if headers_end == position else 4)
+
+        search_start = content_start
+        while True:
+            content_end = buffer.find(delimiter, search_start)
+            if content_end >= 0:
+                break
+            search_start = max(content_start, len(buffer) - len(delimiter) + 1)
+            offset = position
+            if not Fill():
+                raise Exception('The WADO-RS answer is truncated!')
+            # (Fill has moved the part to the start of the buffer)
+            headers_end -= offset
+            content_start -= offset
+            search_start -= offset
+
+        yield ParseMultipartHeaders(buffer[position:headers_end]), bytes(buffer[content_start:content_end])
+
+        position = content_end + len(delimiter)
+        while len(buffer) - position < 2:
+            if not Fill():
+                return
+        if buffer.startswith(b'--', position):
+            return
+        position += 2
+
+def ReadTransferSyntaxFromDicomFile(content: bytes):
+    '''
+    Reads the TransferSyntaxUID (0002,0010) in the meta header of a DICOM file (always explicit VR little endian)
+    :return: the transfer syntax UID, or None if the content is not a DICOM file
+    '''
+    if content[128:132] != b'DICM':
+        return None
+
+    position = 132
+    while position + 8 <= len(content):
+        group, element = struct.unpack_from('<HH', content, position)
+        if group != 0x0002:
+            break
+        vr = content[position + 4:position + 6]
+        if vr in (b'OB', b'OW', b'OF', b'SQ', b'UT', b'UN'):
+            length = struct.unpack_from('<I', content, position + 8)[0]
+            value_position = position + 12
+        else:
+            length = struct.unpack_from('<H', content, position + 6)[0]
+            value_position = position + 8
+        if element == 0x0010:
+            return content[value_position:value_position + length].decode('ascii').rstrip('\0 ')
+        position = value_position + length
+
+    return None
+
+def GetTransferSyntaxFromContentType(contentType: str):
+    # e.g. 'application/dicom; transfer-syntax=1.2.840.10008.1.2.4.50'
+    for parameter in contentType.split(';')[1:]:
+        name, _, value = parameter.partition('=')
+        if name.strip().lower() == 'transfer-syntax':
+            return value.strip().strip('"')
+    return None
+
+class TransferSyntaxCache:
+    '''
+    The transfer syntaxes accepted by each target modality (from 'DicomWebProxy.Modalities.{alias}.TransferSyntaxes',
+    since Orthanc does not expose the syntaxes negotiated in its C-store associations), and the transfer syntaxes
+    that each DICOMweb server has failed to deliver (learnt when a WADO-RS request with an explicit syntax fails,
+    and forgotten after UNDELIVERABLE_TRANSFER_SYNTAXES_TTL).
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.accepted = {}          # modality alias -> list of transfer syntaxes, by order of preference
+        self.undeliverable = {}     # DICOMweb server alias -> {transfer syntax: expiration}
+
+    def get_accepted(self, modalityAlias: str) -> List[str]:
+        with self.lock:
+            if modalityAlias not in self.accepted:
+                modalityConfiguration = proxy_configuration.get("Modalities", {}).get(modalityAlias, {})
+                self.accepted[modalityAlias] = list(modalityConfiguration.get("TransferSyntaxes", []))
+            return self.accepted[modalityAlias]
+
+    def get_requested(self, dicomwebServerAlias: str, modalityAlias: str) -> List[str]:
+        # the syntaxes to request from the DICOMweb server so that the instances can be sent to the modality as is
+        accepted = self.get_accepted(modalityAlias)
+        now = time.monotonic()
+        with self.lock:
+            undeliverable = self.undeliverable.get(dicomwebServerAlias, {})
+            return [transferSyntax for transferSyntax in accepted if undeliverable.get(transferSyntax, 0) <= now]
+
+    def set_undeliverable(self, dicomwebServerAlias: str, transferSyntaxes: List[str]):
+        expiration = time.monotonic() + UNDELIVERABLE_TRANSFER_SYNTAXES_TTL
+        with self.lock:
+            undeliverable = self.undeliverable.setdefault(dicomwebServerAlias, {})
+            for transferSyntax in transferSyntaxes:
+                undeliverable[transferSyntax] = expiration
+
+transfer_syntax_cache = TransferSyntaxCache()
+
+def BuildWadoRsAcceptHeader(transferSyntaxes: List[str]) -> str:
+    if len(transferSyntaxes) == 0:
+        return 'multipart/related; type="application/dicom"'
+    return ', '.join('multipart/related; type="application/dicom"; transfer-syntax={0}'.format(transferSyntax)
+                     for transferSyntax in transferSyntaxes)
+
+class TransitInstance:
+    '''
+    An instance retrieved from the DICOMweb server in transit mode: it is not stored in Orthanc but kept
+    in memory, or in an anonymous temporary file once the memory budget of the move is exhausted.
+    '''
+    __slots__ = ("size", "content", "spool")
+
+    def __init__(self, content: bytes, in_memory: bool) -> None:
+        self.size = len(content)
+        self.content = None
+        self.spool = None
+        if in_memory:
+            self.content = content
+        else:
+            self.spool = tempfile.TemporaryFile(prefix="dicomweb-proxy-")
+            self.spool.write(content)
+
+    def read(self) -> bytes:
+        if self.content is not None:
+            return self.content
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def close(self):
+        self.content = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+def ListInstancesFromMetadata(dicomwebServerAlias: str, studyInstanceUid: str, seriesInstanceUid: str = None):
+    # the full metadata of the study (or series) is downloaded, only the UIDs are kept
+    if seriesInstanceUid is None:
+        url = f"studies/{studyInstanceUid}/metadata"
+    else:
+        url = f"studies/{studyInstanceUid}/series/{seriesInstanceUid}/metadata"
+
+    payloadDict = {
+        "Uri": url,
+        "HttpHeaders": {
+            "Accept": "application/json"
+        }
+    }
+
+    # let's send the query and return the result
+    r = DicomWebRequest(dicomwebServerAlias, "get", payloadDict)
+    counters.increment("listing_requests")
+    metrics.increment("dicomweb_received_bytes", len(r), server=dicomwebServerAlias)
+    dw_instances = json.loads(r)
+    del r
+
+    uids = []
+    for dw_instance in dw_instances:
+        if '00080018' in dw_instance and '0020000E' in dw_instance and '0020000D' in dw_instance:
+            uids.append((dw_instance['0020000D']['Value'][0],
+                         dw_instance['0020000E']['Value'][0],
+                         dw_instance['00080018']['Value'][0]))
+    return uids
+
+def GetListingPageSize(dicomwebServerAlias: str) -> int:
+    # the listing is always paged: without 'limit', the answers of a server capping them would be silently truncated
+    pageSize = int(GetServerOption(dicomwebServerAlias, "QidoPageSize"))
+    return pageSize if pageSize > 0 else QIDO_LISTING_PAGE_SIZE
+
+def ListInstancesFromQido(dicomwebServerAlias: str, studyInstanceUid: str, seriesInstanceUid: str = None):
+    # only the UIDs are requested, through a QIDO-RS query at the instance level
+    if seriesInstanceUid is None:
+        url = f"studies/{studyInstanceUid}/instances"
+    else:
+        url = f"studies/{studyInstanceUid}/series/{seriesInstanceUid}/instances"
+
+    uids = []
+    for page in QidoRsPages(dicomwebServerAlias=dicomwebServerAlias,
+                            uri=url,
+                            arguments={"includefield": "0020000E,00080018"},
+                            pageSize=GetListingPageSize(dicomwebServerAlias),
+                            untilEmptyPage=True):
+        counters.increment("listing_requests")
+        for dw_instance in page:
+            if '00080018' in dw_instance and ('0020000E' in dw_instance or seriesInstanceUid is not None):
+                # the study/series UIDs are not always returned since they are part of the url
+                uids.append((dw_instance['0020000D']['Value'][0] if '0020000D' in dw_instance else studyInstanceUid,
+                             dw_instance['0020000E']['Value'][0] if '0020000E' in dw_instance else seriesInstanceUid,
+                             dw_instance['00080018']['Value'][0]))
+    return uids
+
+def ListPatientStudies(dicomwebServerAlias: str, patientIds: List[str]) -> List[str]:
+    # the StudyInstanceUIDs of the studies of the patients, found through QIDO-RS
+    studyInstanceUids = []
+    found = set()
+    for patientId in patientIds:
+        for page in QidoRsPages(dicomwebServerAlias=dicomwebServerAlias,
+                                uri="studies",
+                                arguments={"PatientID": patientId, "includefield": "0020000D"},
+                                pageSize=GetListingPageSize(dicomwebServerAlias),
+                                untilEmptyPage=True):
+            for answer in page:
+                values = answer.get('0020000D', {}).get('Value', [])
+                if len(values) > 0 and values[0] not in found:
+                    found.add(values[0])
+                    studyInstanceUids.append(values[0])
+    return studyInstanceUids
+
+def ListStudyInstances(dicomwebServerAlias: str, studyInstanceUid: str, seriesInstanceUid: str = None):
+    '''
+    Lists the instances of a study (or of one of its series) on the DICOMweb server, according to 'ListingMode'
+    :return: a list of (study, series, sop) UIDs
+    '''
+    mode = GetServerOption(dicomwebServerAlias, "ListingMode")
+
+    if mode == "Qido":
+        return ListInstancesFromQido(dicomwebServerAlias, studyInstanceUid, seriesInstanceUid)
+
+    elif mode == "QidoSeries":
+        if seriesInstanceUid is not None:
+            seriesInstanceUidList = [seriesInstanceUid]
+        else:
+            seriesInstanceUidList = []
+            for page in QidoRsPages(dicomwebServerAlias=dicomwebServerAlias,
+                                    uri=f"studies/{studyInstanceUid}/series",
+                                    arguments={"includefield": "0020000E"},
+                                    pageSize=GetListingPageSize(dicomwebServerAlias),
+                                    untilEmptyPage=True):
+                counters.increment("listing_requests")
+                seriesInstanceUidList.extend(dw_series['0020000E']['Value'][0] for dw_series in page if '0020000E' in dw_series)
+
+        uids = []
+        for uid in seriesInstanceUidList:
+            uids.extend(ListInstancesFromQido(dicomwebServerAlias, studyInstanceUid, uid))
+        return uids
+
+    return ListInstancesFromMetadata(dicomwebServerAlias, studyInstanceUid, seriesInstanceUid)
+
+class RequestScheduler:
+    '''
+    Limits the number of requests in flight to each DICOMweb server ('SchedulerMaxInFlight'), whatever the number
+    of C-moves in progress. When the limit is reached, the requests wait in one queue per move and the queues are
+    served in turn (round-robin), so that a large move does not delay the small ones.
+    If 'SchedulerLatencyTarget' is set, the limit adapts to the latency of the server: it is halved when a request
+    takes longer than the target and increased by 1 after a full window of faster requests (AIMD).
+    '''
+    class ServerQueue:
+        def __init__(self) -> None:
+            self.in_flight = 0
+            self.limit = None               # current max in flight, see _adapt
+            self.fast_requests = 0          # requests faster than the latency target since the last change of the limit
+            self.queues = OrderedDict()     # owner (a move) -> deque of the Events of its waiting requests
+            self.queue_depth = 0
+            self.last_decrease = 0
+            self.waits = 0
+            self.wait_time = 0.0
+            self.max_wait_time = 0.0
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.servers = {}       # server alias -> ServerQueue
+
+    def _grant(self, server: ServerQueue):
+        # hand the free slots to the waiting requests, one move after the other (must be called with the lock held)
+        while server.queue_depth > 0 and server.in_flight < server.limit:
+            owner, queue = next(iter(server.queues.items()))
+            event = queue.popleft()
+            if len(queue) > 0:
+                server.queues.move_to_end(owner)
+            else:
+                del server.queues[owner]
+            server.queue_depth -= 1
+            server.in_flight += 1
+            event.set()
+
+    def _adapt(self, dicomwebServerAlias: str, server: ServerQueue, latency: float, max_in_flight: int):
+        # must be called with the lock held
+        target = float(GetServerOption(dicomwebServerAlias, "SchedulerLatencyTarget"))
+        if target <= 0:
+            return
+
+        now = time.monotonic()
+        if latency > target:
+            # the requests that are in flight have been sent with the previous limit: let's not halve it for each of them
+            if now - server.last_decrease > target:
+                server.limit = max(1, server.limit // 2)
+                server.fast_requests = 0
+                server.last_decrease = now
+                counters.increment("scheduler_limit_decreases")
+        else:
+            server.fast_requests += 1
+            if server.fast_requests >= server.limit:
+                server.limit = min(max_in_flight, server.limit + 1)
+                server.fast_requests = 0
+
+    @contextlib.contextmanager
+    def slot(self, dicomwebServerAlias: str, owner):
+        '''
+        Waits until a request can be sent to the DICOMweb server on behalf of owner (a move), then holds the slot
+        while the request is in progress:
+            with request_scheduler.slot(alias, self):
+                orthanc.RestApiPostAfterPlugins(...)
+        '''
+        max_in_flight = int(GetServerOption(dicomwebServerAlias, "SchedulerMaxInFlight"))
+        if max_in_flight <= 0:
+            yield
+            return
+
+        event = None
+        with self.lock:
+            server = self.servers.setdefault(dicomwebServerAlias, RequestScheduler.ServerQueue())
+            if server.limit is None or server.limit > max_in_flight:
+                server.limit = max_in_flight
+            if server.queue_depth == 0 and server.in_flight < server.limit:
+                server.in_flight += 1
+            else:
+                event = threading.Event()
+                server.queues.setdefault(owner, deque()).append(event)
+                server.queue_depth += 1
+
+        if event is not None:
+            start = time.monotonic()
+            event.wait()
+            wait_time = time.monotonic() - start
+            with self.lock:
+                server.waits += 1
+                server.wait_time += wait_time
+                server.max_wait_time = max(server.max_wait_time, wait_time)
+            counters.increment("scheduler_waits")
+            counters.increment("scheduler_wait_ms", int(wait_time * 1000))
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            latency = time.monotonic() - start
+            with self.lock:
+                server.in_flight -= 1
+                self._adapt(dicomwebServerAlias, server, latency, max_in_flight)
+                self._grant(server)
+
+    def get_statistics(self) -> dict:
+        with self.lock:
+            return {alias: {
+                "in_flight": server.in_flight,
+                "limit": server.limit,
+                "queue_depth": server.queue_depth,
+                "waiting_moves": len(server.queues),
+                "waits": server.waits,
+                "wait_ms": int(server.wait_time * 1000),
+                "max_wait_ms": int(server.max_wait_time * 1000)
+            } for alias, server in self.servers.items()}
+
+request_scheduler = RequestScheduler()
+
+class MoveJournal:
+    '''
+    SOPInstanceUIDs already delivered by the C-moves that have not been completed (e.g. the target has dropped the
+    association), so that the same C-move, issued again within 'MoveJournalWindow' seconds, only retrieves and sends
+    the missing instances. The journal of a move is cleared as soon as the move is completed.
+    The journal is an optimization: if it can not be read or written, the moves are simply not resumed.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def is_enabled(self) -> bool:
+        return float(GetOption("MoveJournalWindow")) > 0
+
+    def _connect(self):
+        # must be called with the lock held
+        if self.connection is None:
+            path = GetOption("MoveJournalPath") or os.path.join(tempfile.gettempdir(), "dicom-dicomweb-proxy-journal.sqlite")
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            # losing the last deliveries on a crash only means that they are sent again
+            self.connection.executescript('''
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=OFF;
+                CREATE TABLE IF NOT EXISTS delivered (
+                    move_key TEXT NOT NULL,
+                    sop_instance_uid TEXT NOT NULL,
+                    delivered_at REAL NOT NULL,
+                    PRIMARY KEY (move_key, sop_instance_uid));
+                CREATE INDEX IF NOT EXISTS delivered_at_index ON delivered (delivered_at);
+            ''')
+        return self.connection
+
+    def get_delivered(self, move_key: str) -> set:
+        # the deliveries older than the window are purged
+        try:
+            with self.lock:
+                connection = self._connect()
+                with connection:
+                    connection.execute('DELETE FROM delivered WHERE delivered_at < ?', (time.time() - float(GetOption("MoveJournalWindow")),))
+                return set(row[0] for row in connection.execute('SELECT sop_instance_uid FROM delivered WHERE move_key = ?', (move_key,)))
+        except sqlite3.Error as e:
+            orthanc.LogWarning('C-move journal: failed to read the journal ({0})'.format(e))
+            return set()
+
+    def record(self, move_key: str, sop_instance_uids: List[str]):
+        try:
+            with self.lock:
+                connection = self._connect()
+                with connection:
+                    now = time.time()
+                    connection.executemany('INSERT OR REPLACE INTO delivered VALUES (?, ?, ?)',
+                                           ((move_key, sop_instance_uid, now) for sop_instance_uid in sop_instance_uids))
+        except sqlite3.Error as e:
+            orthanc.LogWarning('C-move journal: failed to record the delivered instances ({0})'.format(e))
+
+    def forget(self, move_key: str):
+        try:
+            with self.lock:
+                connection = self._connect()
+                with connection:
+                    connection.execute('DELETE FROM delivered WHERE move_key = ?', (move_key,))
+        except sqlite3.Error as e:
+            orthanc.LogWarning('C-move journal: failed to clear the journal of a completed move ({0})'.format(e))
+
+move_journal = MoveJournal()
+
+class BulkRetrieveRejections:
+    '''
+    The DICOMweb servers that have rejected a retrieval of several resources at once. A rejection status
+    (BULK_RETRIEVE_REJECTION_HTTP_STATUSES) is remembered for good, the other failures of the pooled clients
+    (timeout, 5xx...) might be transient and are not learnt. The HTTP status is not known with the Orthanc
+    DICOMweb client: its failures are then learnt, but only for BULK_RETRIEVE_REJECTED_TTL.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.rejected = {}      # DICOMweb server alias -> expiration (None: for good)
+
+    def is_rejected(self, dicomwebServerAlias: str) -> bool:
+        with self.lock:
+            if dicomwebServerAlias not in self.rejected:
+                return False
+            expiration = self.rejected[dicomwebServerAlias]
+            if expiration is not None and expiration <= time.monotonic():
+                del self.rejected[dicomwebServerAlias]
+                return False
+            return True
+
+    def learn(self, dicomwebServerAlias: str, error: Exception):
+        if isinstance(error, DicomWebHttpError):
+            if error.http_status not in BULK_RETRIEVE_REJECTION_HTTP_STATUSES:
+                return
+            expiration = None
+        elif dicomweb_clients.get_client(dicomwebServerAlias) is not None:
+            return
+        else:
+            expiration = time.monotonic() + BULK_RETRIEVE_REJECTED_TTL
+        with self.lock:
+            self.rejected[dicomwebServerAlias] = expiration
+
+bulk_retrieve_rejections = BulkRetrieveRejections()
+
+class InstanceCache:
+    '''
+    Instances retrieved for previous C-moves, kept in the Orthanc storage of the proxy and indexed by SOPInstanceUID,
+    so that the instances requested again (typically the priors of a patient) are not retrieved again.
+    The cache is bounded by 'InstanceCacheMaxBytes' (least recently used instances are deleted first) and each
+    instance is dropped 'InstanceCacheTtl' seconds after it has been retrieved.
+    The instances used by a move in progress are pinned: they are never evicted before the move has forwarded them.
+    '''
+    class Entry:
+        __slots__ = ("orthanc_id", "study_instance_uid", "size", "expiration", "pins", "prefetched")
+
+        def __init__(self, orthanc_id: str, study_instance_uid: str, size: int, expiration: float) -> None:
+            self.orthanc_id = orthanc_id
+            self.study_instance_uid = study_instance_uid
+            self.size = size
+            self.expiration = expiration
+            self.pins = 0
+            self.prefetched = False     # retrieved by the study prefetch and not moved yet
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # sop instance uid -> Entry
+        self.total_bytes = 0
+
+    def is_enabled(self) -> bool:
+        return int(GetOption("InstanceCacheMaxBytes")) > 0
+
+    def _remove(self, sop_instance_uid: str) -> Entry:
+        # must be called with the lock held
+        entry = self.entries.pop(sop_instance_uid)
+        self.total_bytes -= entry.size
+        if entry.prefetched:
+            counters.increment("study_prefetch_wasted_bytes", entry.size)
+        return entry
+
+    def _delete(self, orthanc_ids: List[str]):
+        if len(orthanc_ids) > 0:
+            orthanc.RestApiPost('/tools/bulk-delete', json.dumps({
+                "Resources": orthanc_ids
+            }))
+
+    def evict(self):
+        # delete the expired instances and the least recently used ones until the cache fits in its budget
+        max_bytes = int(GetOption("InstanceCacheMaxBytes"))
+        now = time.monotonic()
+        evicted_ids = []
+        with self.lock:
+            for sop_instance_uid in list(self.entries.keys()):
+                entry = self.entries[sop_instance_uid]
+                if entry.pins > 0:
+                    continue
+                if entry.expiration <= now:
+                    counters.increment("instance_cache_expired")
+                elif self.total_bytes > max_bytes:
+                    counters.increment("instance_cache_evictions")
+                else:
+                    continue
+                evicted_ids.append(self._remove(sop_instance_uid).orthanc_id)
+
+        self._delete(evicted_ids)
+
+    def acquire(self, sop_instance_uid: str):
+        '''
+        Returns the (orthanc id, size) of the cached instance and pins it, or None if the instance is not cached.
+        '''
+        with self.lock:
+            entry = self.entries.get(sop_instance_uid)
+            if entry is not None and entry.expiration > time.monotonic():
+                entry.pins += 1
+                self.entries.move_to_end(sop_instance_uid)
+                if entry.prefetched:
+                    entry.prefetched = False
+                    counters.increment("study_prefetch_instances_used")
+            else:
+                entry = None
+
+        if entry is None:
+            counters.increment("instance_cache_misses")
+            return None
+
+        # the instance might have been deleted from the proxy through its REST API in the meantime
+        try:
+            orthanc_id = orthanc.LookupInstance(sop_instance_uid)
+        except Exception:
+            orthanc_id = None
+
+        if orthanc_id != entry.orthanc_id:
+            with self.lock:
+                if self.entries.get(sop_instance_uid) is entry:
+                    self._remove(sop_instance_uid)
+            counters.increment("instance_cache_misses")
+            return None
+
+        counters.increment("instance_cache_hits")
+        return entry.orthanc_id, entry.size
+
+    def contains(self, sop_instance_uid: str) -> bool:
+        with self.lock:
+            entry = self.entries.get(sop_instance_uid)
+            return entry is not None and entry.expiration > time.monotonic()
+
+    def add(self, sop_instance_uid: str, orthanc_id: str, study_instance_uid: str, size: int, prefetched: bool = False) -> bool:
+        '''
+        Adds (and pins) an instance that has just been retrieved; returns False if it does not fit in the cache.
+        evict() must be called afterwards.
+        '''
+        if size > int(GetOption("InstanceCacheMaxBytes")):
+            return False
+
+        with self.lock:
+            entry = self.entries.get(sop_instance_uid)
+            if entry is not None and entry.orthanc_id == orthanc_id:
+                # already added by another move (or by the study prefetch)
+                entry.pins += 1
+                self.entries.move_to_end(sop_instance_uid)
+                if entry.prefetched and not prefetched:
+                    entry.prefetched = False
+                    counters.increment("study_prefetch_instances_used")
+                return True
+
+            if entry is not None:
+                self._remove(sop_instance_uid)
+            entry = InstanceCache.Entry(orthanc_id, study_instance_uid, size, time.monotonic() + float(GetOption("InstanceCacheTtl")))
+            entry.pins = 1
+            entry.prefetched = prefetched
+            self.entries[sop_instance_uid] = entry
+            self.total_bytes += size
+
+        return True
+
+    def release(self, sop_instance_uids: List[str]):
+        # the instances are not used by the move anymore, they can be evicted
+        with self.lock:
+            for sop_instance_uid in sop_instance_uids:
+                entry = self.entries.get(sop_instance_uid)
+                if entry is not None and entry.pins > 0:
+                    entry.pins -= 1
+
+        self.evict()
+
+    def purge_study(self, study_instance_uid: str) -> int:
+        '''
+        Deletes the cached instances of a study (except the ones used by a move in progress, that expire instead).
+        Returns the number of deleted instances.
+        '''
+        purged_ids = []
+        with self.lock:
+            for sop_instance_uid, entry in list(self.entries.items()):
+                if entry.study_instance_uid != study_instance_uid:
+                    continue
+                if entry.pins > 0:
+                    entry.expiration = 0
+                else:
+                    purged_ids.append(self._remove(sop_instance_uid).orthanc_id)
+
+        self._delete(purged_ids)
+        return len(purged_ids)
+
+    def load(self):
+        '''
+        Indexes the instances already stored in the proxy (i.e. cached before a restart of Orthanc).
+        Their age is unknown: they are considered as retrieved now.
+        '''
+        instances = json.loads(orthanc.RestApiPost('/tools/find', json.dumps({
+            "Level": "Instance",
+            "Query": {},
+            "Expand": True,
+            "RequestedTags": ["StudyInstanceUID"]
+        })))
+
+        expiration = time.monotonic() + float(GetOption("InstanceCacheTtl"))
+        with self.lock:
+            for instance in instances:
+                sop_instance_uid = instance.get("MainDicomTags", {}).get("SOPInstanceUID")
+                if sop_instance_uid is None or sop_instance_uid in self.entries:
+                    continue
+                size = int(instance.get("FileSize", 0))
+                self.entries[sop_instance_uid] = InstanceCache.Entry(instance["ID"], instance.get("RequestedTags", {}).get("StudyInstanceUID"),
+                                                                     size, expiration)
+                self.total_bytes += size
+
+        orthanc.LogInfo('Instance cache: {0} instances found in the proxy storage'.format(len(instances)))
+        self.evict()
+
+    def get_statistics(self) -> dict:
+        statistics = counters.get_all()
+        hits = statistics.get("instance_cache_hits", 0)
+        total = hits + statistics.get("instance_cache_misses", 0)
+        with self.lock:
+            return {
+                "instance_cache_entries": len(self.entries),
+                "instance_cache_bytes": self.total_bytes,
+                "instance_cache_hit_ratio": (hits / total) if total > 0 else 0
+            }
+
+instance_cache = InstanceCache()
+
+def PurgeInstanceCacheStudyCallback(output, uri, **request):
+    # DELETE /dicom-dicomweb-proxy/instance-cache/studies/{StudyInstanceUID}
+    if request['method'] != 'DELETE':
+        output.SendMethodNotAllowed('DELETE')
+    else:
+        purged = instance_cache.purge_study(request['groups'][0])
+        output.AnswerBuffer(json.dumps({"PurgedInstances": purged}, indent=2), 'application/json')
+
+class StudyPrefetcher:
+    '''
+    Lists in advance the first studies returned by a study-level C-find, since a C-move of one of them is likely
+    to follow within seconds (optionally, their instances are also retrieved in the instance cache).
+    The prefetches are rate-limited per DICOMweb server ('StudyPrefetchRate') and the listings are
+    discarded 'StudyPrefetchTtl' seconds after they have been completed.
+    '''
+    class Listing:
+        __slots__ = ("done", "uids", "expiration", "used")
+
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.uids = None        # None while the listing is in progress or if it has failed
+            self.expiration = 0
+            self.used = False
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.listings = {}          # (server, study instance uid) -> Listing
+        self.rate_limits = {}       # server -> (available prefetches, time of the last update)
+        self.executor = None
+
+    def _discard_expired(self):
+        # must be called with the lock held
+        now = time.monotonic()
+        for key, listing in list(self.listings.items()):
+            if listing.done.is_set() and listing.expiration <= now:
+                del self.listings[key]
+                if not listing.used:
+                    counters.increment("study_prefetch_unused")
+
+    def _acquire_rate(self, dicomwebServerAlias: str) -> bool:
+        # token bucket refilled with 'StudyPrefetchRate' prefetches per minute (must be called with the lock held)
+        rate = float(GetServerOption(dicomwebServerAlias, "StudyPrefetchRate"))
+        if rate <= 0:
+            return True
+
+        now = time.monotonic()
+        available, last_update = self.rate_limits.get(dicomwebServerAlias, (rate, now))
+        available = min(rate, available + (now - last_update) * rate / 60)
+        if available < 1:
+            self.rate_limits[dicomwebServerAlias] = (available, now)
+            return False
+        self.rate_limits[dicomwebServerAlias] = (available - 1, now)
+        return True
+
+    def prefetch(self, dicomwebServerAlias: str, studyInstanceUids: List[str]):
+        submitted = []
+        with self.lock:
+            self._discard_expired()
+            for studyInstanceUid in studyInstanceUids:
+                key = (dicomwebServerAlias, studyInstanceUid)
+                if key in self.listings:
+                    continue
+                if not self._acquire_rate(dicomwebServerAlias):
+                    counters.increment("study_prefetch_rate_limited")
+                    continue
+                self.listings[key] = StudyPrefetcher.Listing()
+                submitted.append((key, self.listings[key]))
+
+            if len(submitted) > 0 and self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=STUDY_PREFETCH_WORKERS, thread_name_prefix="study-prefetch")
+
+        for key, listing in submitted:
+            counters.increment("study_prefetch_started")
+            self.executor.submit(self._prefetch_study, key[0], key[1], listing)
+
+    def _prefetch_study(self, dicomwebServerAlias: str, studyInstanceUid: str, listing: Listing):
+        try:
+            with request_scheduler.slot(dicomwebServerAlias, self):
+                listing.uids = ListStudyInstances(dicomwebServerAlias, studyInstanceUid)
+        except Exception as e:
+            orthanc.LogWarning('Study prefetch: failed to list the study {0} on {1} ({2})'.format(studyInstanceUid, dicomwebServerAlias, e))
+            counters.increment("study_prefetch_failed")
+        finally:
+            listing.expiration = time.monotonic() + float(GetServerOption(dicomwebServerAlias, "StudyPrefetchTtl"))
+            listing.done.set()
+
+        if listing.uids is not None and GetServerOption(dicomwebServerAlias, "StudyPrefetchRetrieve") and instance_cache.is_enabled():
+            try:
+                self._retrieve_study(dicomwebServerAlias, studyInstanceUid, listing.uids)
+            except Exception as e:
+                orthanc.LogWarning('Study prefetch: failed to retrieve the study {0} from {1} ({2})'.format(studyInstanceUid, dicomwebServerAlias, e))
+                counters.increment("study_prefetch_failed")
+
+    def _retrieve_study(self, dicomwebServerAlias: str, studyInstanceUid: str, uids: list):
+        # the instances are stored in the instance cache, they are not pinned since no move is using them yet
+        missing = [(series, sop) for _, series, sop in uids if not instance_cache.contains(sop)]
+        if len(missing) == 0:
+            return
+
+        if len(missing) == len(uids):
+            resources = [{"Study": studyInstanceUid}]
+        else:
+            resources = [{"Study": studyInstanceUid, "Series": series, "Instance": sop} for series, sop in missing]
+        with request_scheduler.slot(dicomwebServerAlias, self):
+            DicomWebRequest(dicomwebServerAlias, "retrieve", {
+                "Resources": resources
+            })
+
+        added = []
+        rejected_ids = []
+        for _, sop in missing:
+            try:
+                orthanc_id = orthanc.LookupInstance(sop)
+            except Exception:
+                continue
+            size = int(json.loads(orthanc.RestApiGet('/instances/{0}/statistics'.format(orthanc_id)))["DiskSize"])
+            if instance_cache.add(sop, orthanc_id, studyInstanceUid, size, prefetched=True):
+                added.append(sop)
+                counters.increment("study_prefetch_instances")
+                counters.increment("study_prefetch_bytes", size)
+            else:
+                rejected_ids.append(orthanc_id)
+
+        instance_cache.release(added)
+        if len(rejected_ids) > 0:
+            orthanc.RestApiPost('/tools/bulk-delete', json.dumps({
+                "Resources": rejected_ids
+            }))
+
+    def get_listing(self, dicomwebServerAlias: str, studyInstanceUid: str):
+        '''
+        Returns the prefetched (study, series, sop) UIDs of the study (waiting for the listing if it is in progress),
+        or None if the study has not been prefetched.
+        '''
+        if int(GetServerOption(dicomwebServerAlias, "StudyPrefetchCount")) <= 0:
+            return None
+
+        with self.lock:
+            listing = self.listings.get((dicomwebServerAlias, studyInstanceUid))
+
+        if listing is not None:
+            listing.done.wait()
+            if listing.uids is not None and listing.expiration > time.monotonic():
+                listing.used = True
+                counters.increment("study_prefetch_hits")
+                return listing.uids
+
+        counters.increment("study_prefetch_misses")
+        return None
+
+    def get_statistics(self) -> dict:
+        statistics = counters.get_all()
+        hits = statistics.get("study_prefetch_hits", 0)
+        total = hits + statistics.get("study_prefetch_misses", 0)
+        with self.lock:
+            return {
+                "study_prefetch_listings": len(self.listings),
+                "study_prefetch_hit_ratio": (hits / total) if total > 0 else 0
+            }
+
+study_prefetcher = StudyPrefetcher()
+
+def OnChange(changeType, level, resourceId):
+    # the instances cached before a restart are indexed again (in a thread, not to delay the startup)
+    if changeType == orthanc.ChangeType.ORTHANC_STARTED and instance_cache.is_enabled():
+        threading.Thread(target=instance_cache.load, name="instance-cache-load").start()
+
 class MoveDriver:
 
-    def __init__(self, request) -> None:
+    def __init__(self, request, trace_id: str = None) -> None:
+        # the trace id is in all the logs of the move
+        self.trace_id = trace_id or NewTraceId()
+        self.start_time = time.monotonic()
+        self.sent_bytes = 0
         self.request = request
-        self.remote_instances = []
-        self.local_instances_ids = []
+        self.remote_instances = RemoteInstancesList()
+        self.local_instances_ids = set()        # instances retrieved in the proxy and not deleted yet
+        self.forwarded_instances_ids = []       # instances forwarded to the target, deleted by batches
         self.instance_counter = 0
-        self.memory = [0] * 10000000
 
         if verbose_enabled:
             pprint.pprint("original C-move query:")
@@ -198,7 +2209,14 @@ class MoveDriver:
         self.level = request["Level"]
         self.remote_server = request["SourceAET"]
 
-        if request["StudyInstanceUID"] in {None, ''}:
+        self.patient_ids = []
+        if self.level == "PATIENT" and request["StudyInstanceUID"] in {None, ''}:
+            if request.get("PatientID") in {None, ''}:
+                raise Exception('The DICOM query does not contain a value for the PatientID, unable to process it!')
+            # the studies of the patients are looked for when the instances are listed (see get_instances_list)
+            self.patient_ids = request["PatientID"].split("\\")
+            self.study_instance_uid_list = []
+        elif request["StudyInstanceUID"] in {None, ''}:
             raise Exception('The DICOM query does not contain a value for the StudyInstanceUID, unable to process it!')
         else:
             # A C-move query can contain 2 (or more) values in the 'StudyInstanceUID' tag, separated by '\'
@@ -217,11 +2235,9 @@ class MoveDriver:
                     raise Exception('The DICOM query does not contain a value for the SOPInstanceUID, unable to process it!')
                 else:
                     sop_instance_uid = request["SOPInstanceUID"]
-                    self.remote_instances = [
-                        RemoteInstance(study_instance_uid=self.study_instance_uid_list[0],
-                                    series_instance_uid=self.series_instance_uid,
-                                    sop_instance_uid=sop_instance_uid)
-                    ]
+                    self.remote_instances.append(study_instance_uid=self.study_instance_uid_list[0],
+                                                 series_instance_uid=self.series_instance_uid,
+                                                 sop_instance_uid=sop_instance_uid)
 
         self.target_aet = None
         if request["TargetAET"] in {None, ''}:
@@ -231,108 +2247,758 @@ class MoveDriver:
 
         self.target_modality_alias = GetOrthancAliasFromAET(self.target_aet)
 
+        # the instances are requested in a transfer syntax accepted by the target, so that Orthanc does not
+        # have to transcode them during the C-store
+        self.accepted_transfer_syntaxes = transfer_syntax_cache.get_accepted(self.target_modality_alias)
+        self.transcoded_instances_count = 0
+
+        # the prefetch pipeline: instances are retrieved ahead of the cursor by a pool of workers
+        # so that ApplyMoveCallback only waits for instances that are (almost) already local
+        self.prefetch_window = max(1, int(GetServerOption(self.remote_server, "PrefetchWindow")))
+        self.prefetch_workers = int(GetServerOption(self.remote_server, "PrefetchWorkers"))
+        self.prefetch_max_bytes = int(GetServerOption(self.remote_server, "PrefetchMaxBytes"))
+        self.prefetch_futures = {}          # chunk number -> Future returning the orthanc ids of the chunk instances
+        self.prefetch_next_chunk = 0        # number of the next chunk to schedule
+        self.prefetched_sizes = {}          # orthanc id -> size of the instances retrieved but not forwarded yet
+        self.prefetched_bytes = 0
+        self.lock = threading.Lock()
+        # in transit mode, the instances are neither stored nor indexed in the proxy
+        self.transit_mode = bool(GetServerOption(self.remote_server, "TransitMode"))
+        self.transit_max_memory_bytes = int(GetServerOption(self.remote_server, "TransitMaxMemoryBytes"))
+        self.transit_memory_bytes = 0
+        self.transit_instances = set()      # transit instances retrieved but not forwarded yet
+
+        # the instances are forwarded by batches, each batch being sent in a single association
+        self.store_batch_size = max(1, int(GetServerOption(self.remote_server, "StoreBatchSize")))
+        self.store_batch = []
+        self.store_batch_sop_instance_uids = []
+
+        # the instances delivered by a previous attempt of the same move are not moved again, but they are still
+        # reported to the SCU as sub-operations
+        self.journal_key = None
+        if move_journal.is_enabled():
+            self.journal_key = json.dumps([request.get(key) for key in ["SourceAET", "TargetAET", "OriginatorAET", "Level", "PatientID",
+                                                                          "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]])
+        self.skipped_instances_count = 0        # already delivered instances, reported before the other ones
+        self.skipped_series_instance_uids = set()   # series with already delivered instances
+        self.delivered_instances_count = 0
+        self.total_instances_count = 0          # listed instances, including the already delivered ones
+
+        # the instances found in the instance cache are not retrieved, and the cached ones are not deleted by the move
+        self.instance_cache_enabled = instance_cache.is_enabled()
+        self.cached_instances = {}          # orthanc id -> sop instance uid of the instances pinned in the instance cache
+
+        self.retrieve_mode = GetServerOption(self.remote_server, "RetrieveMode")
+        self.retrieve_chunk_size = max(1, int(GetServerOption(self.remote_server, "RetrieveChunkSize")))
+        self.chunk_starts = array.array('I', [0])   # index in remote_instances of the first instance of each chunk
+        self.chunk_mode = "Instance"
+        self.registered = bytearray(len(self.remote_instances))
+        self.registered_orthanc_ids = {}    # index -> orthanc id of the registered instances (not in transit mode)
+        self.executor = None
+        if self.prefetch_workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=self.prefetch_workers,
+                                               thread_name_prefix="prefetch-{0}".format(self.remote_server))
+
+
+    def _list_study_instances(self, study_instance_uid: str):
+        # list the (study, series, sop) UIDs of the instances to move in one study
+        if self.level == "SERIES":
+            with request_scheduler.slot(self.remote_server, self):
+                return ListStudyInstances(self.remote_server, study_instance_uid, self.series_instance_uid)
+
+        # the study might have been listed in advance, when it has been returned by a C-find
+        uids = study_prefetcher.get_listing(self.remote_server, study_instance_uid)
+        if uids is not None:
+            return uids
+
+        with request_scheduler.slot(self.remote_server, self):
+            return ListStudyInstances(self.remote_server, study_instance_uid)
 
     # get the url where each instance can be downloaded
     def get_instances_list(self):
-        request = self.request
+        start = time.monotonic()
+
+        # at the PATIENT level, the studies of the patients are looked for first, then listed like the other ones
+        if len(self.patient_ids) > 0:
+            with request_scheduler.slot(self.remote_server, self):
+                self.study_instance_uid_list = ListPatientStudies(self.remote_server, self.patient_ids)
+            orthanc.LogInfo('[{0}] C-move from {1}: {2} studies found for the patient(s) {3}'.format(
+                self.trace_id, self.remote_server, len(self.study_instance_uid_list), ', '.join(self.patient_ids)))
+
+        # at the IMAGE level, the instance to move is already known
+        if self.level != "IMAGE":
+            self.remote_instances = RemoteInstancesList()
+
+            # the studies are listed in parallel, but added to the list in the order of the query
+            workers = min(int(GetServerOption(self.remote_server, "ListingWorkers")), len(self.study_instance_uid_list))
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="listing-{0}".format(self.remote_server)) as executor:
+                    studies_uids = executor.map(self._list_study_instances, self.study_instance_uid_list)
+                    for uids in studies_uids:
+                        for study_instance_uid, series_instance_uid, sop_instance_uid in uids:
+                            self.remote_instances.append(study_instance_uid, series_instance_uid, sop_instance_uid)
+            else:
+                for study_instance_uid in self.study_instance_uid_list:
+                    for study_uid, series_instance_uid, sop_instance_uid in self._list_study_instances(study_instance_uid):
+                        self.remote_instances.append(study_uid, series_instance_uid, sop_instance_uid)
+
+        duration = time.monotonic() - start
+        counters.increment("listing_count")
+        counters.increment("listing_duration_ms", int(duration * 1000))
+        counters.increment("listing_instances", len(self.remote_instances))
+        metrics.observe("move_operation_seconds", duration, operation="get_instances_list", server=self.remote_server)
+        orthanc.LogInfo('[{0}] C-move from {1}: {2} instances listed in {3:.3f} s'.format(self.trace_id, self.remote_server, len(self.remote_instances), duration))
+
+        self.total_instances_count = len(self.remote_instances)
+        if self.journal_key is not None:
+            self._skip_delivered_instances()
+
+        self._build_chunks()
+
+        # let's start retrieving the first instances while Orthanc is answering the C-move SCU
+        self._schedule_prefetch()
+
+    def _skip_delivered_instances(self):
+        delivered = move_journal.get_delivered(self.journal_key)
+        if len(delivered) == 0:
+            return
+
+        remaining_instances = RemoteInstancesList()
+        for index in range(len(self.remote_instances)):
+            remote_instance = self.remote_instances[index]
+            if remote_instance.sop_instance_uid not in delivered:
+                remaining_instances.append(remote_instance.study_instance_uid, remote_instance.series_instance_uid, remote_instance.sop_instance_uid)
+            else:
+                self.skipped_series_instance_uids.add(remote_instance.series_instance_uid)
+
+        self.skipped_instances_count = len(self.remote_instances) - len(remaining_instances)
+        self.delivered_instances_count = self.skipped_instances_count
+        self.remote_instances = remaining_instances
+
+        counters.increment("journal_resumed_moves")
+        counters.increment("journal_skipped_instances", self.skipped_instances_count)
+        orthanc.LogInfo('[{0}] C-move from {1} to {2}: resumed, {3} instances have already been delivered'.format(
+            self.trace_id, self.remote_server, self.target_aet, self.skipped_instances_count))
+
+    def get_instances_count(self) -> int:
+        # (not derived from skipped_instances_count, that is decremented as the skipped instances are reported)
+        return self.total_instances_count
+
+    def is_complete(self) -> bool:
+        # all the sub-operations have been applied
+        return self.skipped_instances_count == 0 and self.instance_counter >= len(self.remote_instances)
+
+    def _build_chunks(self):
+        # split the instances list in chunks, each chunk being retrieved in a single WADO-RS call
+        mode = self.retrieve_mode
+        if self.level == "IMAGE" or bulk_retrieve_rejections.is_rejected(self.remote_server):
+            mode = "Instance"
+        if self.transit_mode:
+            # a whole series in a single multipart answer would have to be held in memory
+            mode = "Instance"
+
+        count = len(self.remote_instances)
+        if mode == "Series":
+            self.remote_instances.sort_by_series()
+            self.chunk_starts = array.array('I', (i for i in range(count)
+                                                  if i == 0 or self.remote_instances.get_series_index(i) != self.remote_instances.get_series_index(i - 1)))
+        elif mode == "Chunk":
+            self.chunk_starts = array.array('I', range(0, count, self.retrieve_chunk_size))
+        else:
+            self.chunk_starts = array.array('I', range(0, count))
+        self.chunk_mode = mode
+        self.registered = bytearray(count)     # 1 if the instance has been retrieved and registered for cleanup
+        self.registered_orthanc_ids = {}
+
+    def _get_chunk_range(self, chunk: int):
+        start = self.chunk_starts[chunk]
+        end = self.chunk_starts[chunk + 1] if chunk + 1 < len(self.chunk_starts) else len(self.remote_instances)
+        return start, end
+
+    def _post_with_transfer_syntaxes(self, route: str, payloadDict: dict):
+        # the requests of all the moves to the same DICOMweb server are scheduled together
+        with request_scheduler.slot(self.remote_server, self):
+            # requests the transfer syntaxes accepted by the target; if the server fails, the request is retried
+            # without any transfer syntax and, if this works, the server is known not to deliver these syntaxes
+            transferSyntaxes = transfer_syntax_cache.get_requested(self.remote_server, self.target_modality_alias)
+            if len(transferSyntaxes) == 0:
+                return DicomWebRequest(self.remote_server, route, payloadDict)
+
+            payloadDict.setdefault("HttpHeaders", {})["Accept"] = BuildWadoRsAcceptHeader(transferSyntaxes)
+            try:
+                return DicomWebRequest(self.remote_server, route, payloadDict)
+            except Exception as e:
+                payloadDict["HttpHeaders"]["Accept"] = BuildWadoRsAcceptHeader([])
+                r = DicomWebRequest(self.remote_server, route, payloadDict)
+
+                # only a rejection of the content negotiation is learnt: the other failures (timeout, 5xx...) might
+                # be transient.  The HTTP status is not known with the Orthanc DICOMweb client: the syntaxes are then
+                # learnt as undeliverable, but only for UNDELIVERABLE_TRANSFER_SYNTAXES_TTL
+                if dicomweb_clients.get_client(self.remote_server) is not None:
+                    if not isinstance(e, DicomWebHttpError) or e.http_status not in CONTENT_NEGOTIATION_HTTP_STATUSES:
+                        return r
+
+                orthanc.LogWarning('[{0}] The DICOMweb server {1} failed to deliver the transfer syntaxes {2} ({3}), the instances will be transcoded in the proxy'.format(
+                    self.trace_id, self.remote_server, ', '.join(transferSyntaxes), e))
+                transfer_syntax_cache.set_undeliverable(self.remote_server, transferSyntaxes)
+                return r
+
+    def _count_transfer_syntax(self, transferSyntax):
+        # an instance in a syntax the target does not accept will be transcoded by Orthanc during the C-store
+        if len(self.accepted_transfer_syntaxes) == 0 or transferSyntax is None:
+            return
+        if transferSyntax in self.accepted_transfer_syntaxes:
+            counters.increment("move_instances_native_transfer_syntax")
+        else:
+            with self.lock:
+                self.transcoded_instances_count += 1
+            counters.increment("move_instances_transcoded")
+
+    def _post_retrieve(self, resources: list):
+        payloadDict = {
+            "Resources": resources
+        }
+
+        self._post_with_transfer_syntaxes("retrieve", payloadDict)
+
+    def _get_registered_orthanc_id(self, index: int):
+        with self.lock:
+            if self.registered[index]:
+                return self.registered_orthanc_ids.get(index)
+        return None
+
+    def _register_local_instance(self, index: int, orthanc_id: str = None) -> str:
+        # an instance of a chunk can be registered by the worker and by retrieve_next_instance (if it landed
+        # before the end of the chunk), but it must be counted only once.  Once registered, it might already have
+        # been forwarded and deleted from the proxy: it must not be looked up again
+        registered_id = self._get_registered_orthanc_id(index)
+        if registered_id is not None:
+            return registered_id
+
+        if orthanc_id is None:
+            orthanc_id = orthanc.LookupInstance(self.remote_instances.sop_instance_uids[index])
+
+        size = int(json.loads(orthanc.RestApiGet('/instances/{0}/statistics'.format(orthanc_id)))["DiskSize"])
+
+        cached = False
+        with self.lock:
+            if self.registered[index]:
+                return self.registered_orthanc_ids[index]
+            self.registered[index] = 1
+            self.registered_orthanc_ids[index] = orthanc_id
+            # the instance is kept for the next moves if it fits in the instance cache
+            if self.instance_cache_enabled:
+                remote_instance = self.remote_instances[index]
+                cached = instance_cache.add(remote_instance.sop_instance_uid, orthanc_id, remote_instance.study_instance_uid, size)
+            if cached:
+                self.cached_instances[orthanc_id] = self.remote_instances.sop_instance_uids[index]
+            else:
+                self.local_instances_ids.add(orthanc_id)
+            self.prefetched_sizes[orthanc_id] = size
+            self.prefetched_bytes += size
+        metrics.increment("dicomweb_received_bytes", size, server=self.remote_server)
+
+        if cached:
+            instance_cache.evict()
+
+        if len(self.accepted_transfer_syntaxes) > 0:
+            transferSyntax = orthanc.RestApiGet('/instances/{0}/metadata/TransferSyntax'.format(orthanc_id))
+            if isinstance(transferSyntax, bytes):
+                transferSyntax = transferSyntax.decode('ascii')
+            self._count_transfer_syntax(transferSyntax.strip())
+
+        return orthanc_id
 
-        self.remote_instances = []
-        for study_instance_uid in self.study_instance_uid_list:
+    def _register_cached_instance(self, index: int, orthanc_id: str, size: int) -> str:
+        # the instance has been pinned in the instance cache, it is forwarded from there
+        with self.lock:
+            registered = self.registered[index]
+            if not registered:
+                self.registered[index] = 1
+                self.registered_orthanc_ids[index] = orthanc_id
+                self.cached_instances[orthanc_id] = self.remote_instances.sop_instance_uids[index]
+                self.prefetched_sizes[orthanc_id] = size
+                self.prefetched_bytes += size
+
+        if registered:
+            # already registered (and pinned) when it has been found by retrieve_next_instance
+            instance_cache.release([self.remote_instances.sop_instance_uids[index]])
 
-            # Let's build the payload
+        return orthanc_id
 
-            if self.level == "STUDY":
-                url = f"studies/{study_instance_uid}/metadata"
-            elif self.level == "SERIES":
-                url = f"studies/{study_instance_uid}/series/{self.series_instance_uid}/metadata"
+    def _retrieve_transit_instance(self, index: int) -> TransitInstance:
+        # retrieve one instance from the DICOMWeb server (WADO-RS), without storing it in Orthanc
+        remote_instance = self.remote_instances[index]
 
-            payloadDict = {
-                "Uri": url,
-                "HttpHeaders": {
-                    "Accept": "application/json"
-                }
+        payloadDict = {
+            "Uri": "studies/{0}/series/{1}/instances/{2}".format(remote_instance.study_instance_uid,
+                                                                remote_instance.series_instance_uid,
+                                                                remote_instance.sop_instance_uid),
+            "HttpHeaders": {
+                "Accept": 'multipart/related; type="application/dicom"'
             }
+        }
 
-            # let's send the query and return the result
-            dw_instances = json.loads(orthanc.RestApiPostAfterPlugins('/dicom-web/servers/{0}/get'.format(self.remote_server), json.dumps(payloadDict)))
-            # pprint.pprint(dw_instances)
-            for dw_instance in dw_instances:
-                if '00080018' in dw_instance and '0020000E' in dw_instance and '0020000D' in dw_instance:
-                    self.remote_instances.append(RemoteInstance(study_instance_uid=dw_instance['0020000D']['Value'][0],
-                                                                series_instance_uid=dw_instance['0020000E']['Value'][0],
-                                                                sop_instance_uid=dw_instance['00080018']['Value'][0]))
+        body = self._post_with_transfer_syntaxes("get", payloadDict)
+        parts = ParseMultipartRelated(body)
+        del body
+        if len(parts) != 1:
+            raise Exception('The DICOMweb server returned {0} instances instead of 1 for {1}'.format(len(parts), remote_instance.sop_instance_uid))
+        headers, content = parts[0]
+        metrics.increment("dicomweb_received_bytes", len(content), server=self.remote_server)
 
-    def retrieve_next_instance(self) -> str:
-        # retrieve one instance from the DICOMWeb server
-        if self.instance_counter > len(self.remote_instances):
-            raise Exception('Trying to retrieve an instance that has not been listed!')
+        if len(self.accepted_transfer_syntaxes) > 0:
+            transferSyntax = GetTransferSyntaxFromContentType(headers.get('content-type', ''))
+            self._count_transfer_syntax(transferSyntax or ReadTransferSyntaxFromDicomFile(content))
+
+        with self.lock:
+            in_memory = self.transit_memory_bytes + len(content) <= self.transit_max_memory_bytes
+            if in_memory:
+                self.transit_memory_bytes += len(content)
 
-        remote_instance = self.remote_instances[self.instance_counter]
-        self.instance_counter += 1
+        transit_instance = TransitInstance(content, in_memory)
 
+        with self.lock:
+            self.registered[index] = 1
+            self.transit_instances.add(transit_instance)
+            self.prefetched_sizes[transit_instance] = transit_instance.size
+            self.prefetched_bytes += transit_instance.size
+
+        return transit_instance
+
+    def _retrieve_instance(self, index: int):
+        # retrieve one instance from the DICOMWeb server
+        if self.transit_mode:
+            return self._retrieve_transit_instance(index)
+
+        remote_instance = self.remote_instances[index]
         resources = {}
         resources["Study"] = remote_instance.study_instance_uid
         resources["Series"] = remote_instance.series_instance_uid
         resources["Instance"] = remote_instance.sop_instance_uid
 
-        payloadDict = {
-            "Resources": [resources]
-        }
+        self._post_retrieve([resources])
 
-        r = orthanc.RestApiPostAfterPlugins('/dicom-web/servers/{0}/retrieve'.format(self.remote_server), json.dumps(payloadDict))
+        return self._register_local_instance(index)
 
-        orthanc_id = orthanc.LookupInstance(remote_instance.sop_instance_uid)
-        self.local_instances_ids.append(orthanc_id)
-        
-        return orthanc_id
-        
-    def forward_instance(self, orthanc_id: str):
-        # C-store from proxy to issuer
-        orthanc.RestApiPost('/modalities/{0}/store'.format(self.target_modality_alias), json.dumps({
-            "Resources": [orthanc_id]
-        }))
+    def _retrieve_chunk(self, chunk: int) -> list:
+        # retrieve the instances of a chunk from the DICOMWeb server (this might run in a prefetch worker)
+        start, end = self._get_chunk_range(chunk)
 
-    def cleanup(self):
+        orthanc_ids = {}        # index -> orthanc id
+        if self.instance_cache_enabled:
+            for index in range(start, end):
+                cached_instance = instance_cache.acquire(self.remote_instances.sop_instance_uids[index])
+                if cached_instance is not None:
+                    orthanc_ids[index] = self._register_cached_instance(index, *cached_instance)
+
+        missing_indexes = [index for index in range(start, end) if index not in orthanc_ids]
+        if len(missing_indexes) == 0:
+            pass
+        elif self.chunk_mode == "Instance" or bulk_retrieve_rejections.is_rejected(self.remote_server):
+            for index in missing_indexes:
+                orthanc_ids[index] = self._retrieve_instance(index)
+        else:
+            orthanc_ids.update(zip(missing_indexes, self._retrieve_instances_at_once(missing_indexes, len(missing_indexes) == end - start)))
+
+        return [orthanc_ids[index] for index in range(start, end)]
+
+    def _retrieve_instances_at_once(self, indexes: List[int], whole_chunk: bool) -> list:
+        # retrieve several instances in a single WADO-RS call
+        remote_instances = [self.remote_instances[index] for index in indexes]
+
+        if self.chunk_mode == "Series" and whole_chunk and remote_instances[0].series_instance_uid not in self.skipped_series_instance_uids:
+            # the chunk contains all the listed instances of the series (unless some of them are cached or have
+            # already been delivered by a previous attempt of the move: they would be retrieved again)
+            resources = [{
+                "Study": remote_instances[0].study_instance_uid,
+                "Series": remote_instances[0].series_instance_uid
+            }]
+        else:
+            resources = [{
+                "Study": remote_instance.study_instance_uid,
+                "Series": remote_instance.series_instance_uid,
+                "Instance": remote_instance.sop_instance_uid
+            } for remote_instance in remote_instances]
+
+        try:
+            self._post_retrieve(resources)
+        except Exception as e:
+            # let's fall back to one instance at a time, for this chunk and, if the failure is a rejection, for the next ones
+            orthanc.LogWarning('[{0}] The DICOMweb server {1} failed to retrieve several instances at once ({2}), retrieving them one by one'.format(self.trace_id, self.remote_server, e))
+            bulk_retrieve_rejections.learn(self.remote_server, e)
+            # (the instances that have landed before the failure are not retrieved again)
+            return [self._get_registered_orthanc_id(index) or self._retrieve_instance(index) for index in indexes]
+
+        return [self._register_local_instance(index) for index in indexes]
+
+    def _submit_chunk(self, chunk: int):
+        if self.executor is not None:
+            self.prefetch_futures[chunk] = self.executor.submit(self._retrieve_chunk, chunk)
+        else:
+            future = Future()
+            try:
+                future.set_result(self._retrieve_chunk(chunk))
+            except Exception as e:
+                future.set_exception(e)
+            self.prefetch_futures[chunk] = future
+        self.prefetch_next_chunk = chunk + 1
+
+    def _schedule_prefetch(self):
+        # submit the retrieval of the chunks that start in the prefetch window and are not scheduled yet
+        if self.executor is None:
+            return
+
+        while (self.prefetch_next_chunk < len(self.chunk_starts)
+               and self.chunk_starts[self.prefetch_next_chunk] < len(self.remote_instances)
+               and self.chunk_starts[self.prefetch_next_chunk] < self.instance_counter + self.prefetch_window):
+
+            # the chunk at the cursor is always scheduled, the next ones only if the size cap allows it
+            if self.chunk_starts[self.prefetch_next_chunk] > self.instance_counter and self.prefetch_max_bytes > 0:
+                with self.lock:
+                    if self.prefetched_bytes >= self.prefetch_max_bytes:
+                        break
+
+            self._submit_chunk(self.prefetch_next_chunk)
+
+    def _lookup_landed_instance(self, index: int):
+        # while a chunk is being retrieved, its first instances might already be stored in the proxy
+        registered_id = self._get_registered_orthanc_id(index)
+        if registered_id is not None:
+            return registered_id
+        try:
+            orthanc_id = orthanc.LookupInstance(self.remote_instances.sop_instance_uids[index])
+        except Exception:
+            return None
+        if not orthanc_id:
+            return None
+        return self._register_local_instance(index, orthanc_id)
+
+    def retrieve_next_instance(self):
+        # get the next instance from the DICOMWeb server, from the prefetch pipeline if enabled
+        # returns the orthanc id of the instance, a TransitInstance in transit mode, or None if the
+        # instance has already been delivered by a previous attempt of the move
+        if self.skipped_instances_count > 0:
+            self.skipped_instances_count -= 1
+            return None
+
+        with metrics.timer("move_operation_seconds", operation="retrieve_next_instance", server=self.remote_server):
+            if self.instance_counter >= len(self.remote_instances):
+                raise Exception('Trying to retrieve an instance that has not been listed!')
+
+            index = self.instance_counter
+            chunk = bisect.bisect_right(self.chunk_starts, index) - 1
+            start, end = self._get_chunk_range(chunk)
+
+            if chunk not in self.prefetch_futures:
+                self._submit_chunk(chunk)
+            self._schedule_prefetch()
+
+            future = self.prefetch_futures[chunk]
+            self.instance_counter += 1
+            if index == end - 1:
+                del self.prefetch_futures[chunk]
+
+            # the instances of a chunk are handed to the C-store as soon as they land in the proxy
+            if end - start > 1:
+                while not future.done():
+                    orthanc_id = self._lookup_landed_instance(index)
+                    if orthanc_id is not None:
+                        self._schedule_prefetch()
+                        return orthanc_id
+                    concurrent.futures.wait([future], timeout=CHUNK_POLLING_INTERVAL)
+
+            # this raises the exception of the worker if the retrieval failed
+            orthanc_id = future.result()[index - start]
+
+            self._schedule_prefetch()
+
+            return orthanc_id
+
+    def _forward_transit_instance(self, transit_instance: TransitInstance):
+        # C-store from proxy to issuer, straight from the buffer
+        orthanc.RestApiPost('/modalities/{0}/store-straight'.format(self.target_modality_alias), transit_instance.read())
+        self._record_delivered([self.remote_instances.sop_instance_uids[self.instance_counter - 1]])
+        self._count_sent(1, transit_instance.size)
+
+        with self.lock:
+            self.prefetched_bytes -= self.prefetched_sizes.pop(transit_instance, 0)
+            self.transit_instances.discard(transit_instance)
+            if transit_instance.content is not None:
+                self.transit_memory_bytes -= transit_instance.size
+        transit_instance.close()
+
+    def forward_instance(self, orthanc_id):
+        with metrics.timer("move_operation_seconds", operation="forward_instance", server=self.remote_server):
+            if isinstance(orthanc_id, TransitInstance):
+                self._forward_transit_instance(orthanc_id)
+                return
+
+            # the instance is sent when the batch is full or when it is the last one of the move: the SCU
+            # gets the progress of each instance, but the C-store of a batch is reported by its last instance.
+            # The other instances of the batch are reported as completed before being sent: if the batch is
+            # rejected, the SCU counts them as completed (if the move is canceled, the batch is sent by cleanup())
+            self.store_batch.append(orthanc_id)
+            self.store_batch_sop_instance_uids.append(self.remote_instances.sop_instance_uids[self.instance_counter - 1])
+            if len(self.store_batch) >= self.store_batch_size or self.instance_counter >= len(self.remote_instances):
+                self._flush_store_batch()
+
+    def _flush_store_batch(self):
+        if len(self.store_batch) == 0:
+            return
+
+        # C-store from proxy to issuer, all the instances of the batch in the same association
+        # (a rejected batch is not sent again with the next instances: its instances stay in local_instances_ids
+        # and are deleted by cleanup())
+        delivered = False
+        try:
+            orthanc.RestApiPost('/modalities/{0}/store'.format(self.target_modality_alias), json.dumps({
+                "Resources": self.store_batch
+            }))
+            delivered = True
+            self._record_delivered(self.store_batch_sop_instance_uids)
+        finally:
+            self.store_batch_sop_instance_uids = []
+
+            # the instances are not counted in the prefetch size cap anymore
+            # and the forwarded instances are deleted by batches, so that the proxy storage does not grow with the move size
+            released = []
+            batch_bytes = 0
+            with self.lock:
+                for forwarded_id in self.store_batch:
+                    size = self.prefetched_sizes.pop(forwarded_id, 0)
+                    self.prefetched_bytes -= size
+                    batch_bytes += size
+                    if forwarded_id in self.cached_instances:
+                        released.append(self.cached_instances.pop(forwarded_id))
+                    elif delivered:
+                        self.forwarded_instances_ids.append(forwarded_id)
+            if delivered:
+                self._count_sent(len(self.store_batch), batch_bytes)
+            self.store_batch = []
+
+            # the cached instances stay in the proxy, but can now be evicted
+            if len(released) > 0:
+                instance_cache.release(released)
+
+        if len(self.forwarded_instances_ids) >= CLEANUP_BATCH_SIZE:
+            self._delete_forwarded_instances()
+
+    def _count_sent(self, instances_count: int, size: int):
+        self.sent_bytes += size
+        metrics.increment("target_sent_instances", instances_count, target_aet=self.target_aet)
+        metrics.increment("target_sent_bytes", size, target_aet=self.target_aet)
+
+    def _record_delivered(self, sop_instance_uids: List[str]):
+        self.delivered_instances_count += len(sop_instance_uids)
+        if self.journal_key is not None:
+            move_journal.record(self.journal_key, sop_instance_uids)
+
+    def _delete_forwarded_instances(self):
         orthanc.RestApiPost('/tools/bulk-delete', json.dumps({
-            "Resources": self.local_instances_ids
+            "Resources": self.forwarded_instances_ids
         }))
+        with self.lock:
+            self.local_instances_ids.difference_update(self.forwarded_instances_ids)
+        self.forwarded_instances_ids = []
+
+    def cleanup(self):
+        start = time.monotonic()
+
+        # the instances of a pending batch have already been reported as completed to the SCU: they are sent
+        # before the instances of the proxy are deleted (and before the delivered ones are counted)
+        try:
+            self._flush_store_batch()
+        except Exception as e:
+            orthanc.LogWarning('[{0}] C-move from {1} to {2}: failed to send the last batch of instances ({3})'.format(
+                self.trace_id, self.remote_server, self.target_aet, e))
+
+        # a completed move is not resumed: if the SCU issues it again, all the instances are sent again
+        if self.journal_key is not None and self.delivered_instances_count >= self.total_instances_count:
+            move_journal.forget(self.journal_key)
+
+        if self.transcoded_instances_count > 0:
+            orthanc.LogInfo('[{0}] C-move from {1} to {2}: {3} instances were not available in a transfer syntax accepted by the target and needed a transcoding'.format(
+                self.trace_id, self.remote_server, self.target_aet, self.transcoded_instances_count))
+
+        # stop the prefetch workers (the retrievals in progress are completed so that they get deleted too)
+        if self.executor is not None:
+            for future in self.prefetch_futures.values():
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.prefetch_futures = {}
+
+        # the transit instances that have not been forwarded are only in memory or in temporary files
+        for transit_instance in self.transit_instances:
+            transit_instance.close()
+        self.transit_instances = set()
+
+        if len(self.cached_instances) > 0:
+            instance_cache.release(list(self.cached_instances.values()))
+            self.cached_instances = {}
+
+        if len(self.local_instances_ids) > 0:
+            orthanc.RestApiPost('/tools/bulk-delete', json.dumps({
+                "Resources": list(self.local_instances_ids)
+            }))
+
+        metrics.observe("move_operation_seconds", time.monotonic() - start, operation="cleanup", server=self.remote_server)
+        orthanc.LogInfo('[{0}] C-move from {1} to {2}: {3}/{4} instances ({5} bytes) delivered in {6:.3f} s'.format(
+            self.trace_id, self.remote_server, self.target_aet, self.delivered_instances_count, self.total_instances_count,
+            self.sent_bytes, time.monotonic() - self.start_time))
+
+
+class FederatedMoveDriver:
+    '''
+    C-move from a federation (SourceAET = 'DicomWebProxy.Federations.{alias}'): the studies are moved from the
+    servers that reported them in the federated C-find answers, by one MoveDriver per server, one after the other.
+    '''
+    def __init__(self, request) -> None:
+        self.trace_id = NewTraceId()
+        self.federation = request["SourceAET"]
+        self.servers = GetFederationServers(self.federation)
+
+        if request["Level"] == "PATIENT" and request["StudyInstanceUID"] in {None, ''}:
+            if request.get("PatientID") in {None, ''}:
+                raise Exception('The DICOM query does not contain a value for the PatientID, unable to process it!')
+            studies_per_server = self._get_patient_studies(request["PatientID"].split("\\"))
+            request = dict(request, Level="STUDY")
+
+        elif request["StudyInstanceUID"] in {None, ''}:
+            raise Exception('The DICOM query does not contain a value for the StudyInstanceUID, unable to process it!')
+
+        else:
+            # the most specific UID of the query is looked up first
+            uids = []
+            if request["Level"] == "IMAGE" and request["SOPInstanceUID"] not in {None, ''}:
+                uids.append(request["SOPInstanceUID"])
+            if request["Level"] in {"SERIES", "IMAGE"} and request["SeriesInstanceUID"] not in {None, ''}:
+                uids.append(request["SeriesInstanceUID"])
+
+            studies_per_server = OrderedDict()
+            for study_instance_uid in request["StudyInstanceUID"].split("\\"):
+                server = self._get_server(uids + [study_instance_uid], study_instance_uid)
+                studies_per_server.setdefault(server, []).append(study_instance_uid)
+
+        self.drivers = [MoveDriver(dict(request, SourceAET=server, StudyInstanceUID="\\".join(study_instance_uids)), trace_id=self.trace_id)
+                        for server, study_instance_uids in studies_per_server.items()]
+        self.current = 0
+
+    def _get_server(self, uids: List[str], study_instance_uid: str) -> str:
+        for uid in uids:
+            server = federation_routes.get(self.federation, uid)
+            if server is not None:
+                return server
+
+        # the study has not been found by a recent C-find: let's ask the servers, in the order of the configuration
+        counters.increment("federation_route_misses")
+        for server in self.servers:
+            try:
+                for page in QidoRsPages(dicomwebServerAlias=server,
+                                        uri="studies",
+                                        arguments={"StudyInstanceUID": study_instance_uid, "includefield": "0020000D"},
+                                        maxResults=1):
+                    if len(page) > 0:
+                        federation_routes.set(self.federation, study_instance_uid, server)
+                        return server
+            except Exception as e:
+                orthanc.LogWarning('[{0}] C-move from {1}: failed to look for the study {2} on {3} ({4})'.format(self.trace_id, self.federation, study_instance_uid, server, e))
+
+        raise Exception('The study {0} has not been found on the servers of the federation {1}'.format(study_instance_uid, self.federation))
+
+    def _get_patient_studies(self, patient_ids: List[str]) -> OrderedDict:
+        # the studies of the patients are looked for on all the servers in parallel; a study found on several
+        # servers is moved from the first one, in the order of the configuration
+        def ListServerStudies(server):
+            try:
+                return ListPatientStudies(server, patient_ids)
+            except Exception as e:
+                orthanc.LogWarning('[{0}] C-move from {1}: failed to look for the studies of {2} on {3} ({4})'.format(
+                    self.trace_id, self.federation, ', '.join(patient_ids), server, e))
+                return []
+
+        studies_per_server = OrderedDict()
+        found = set()
+        with ThreadPoolExecutor(max_workers=len(self.servers), thread_name_prefix="federation-{0}".format(self.federation)) as executor:
+            for server, study_instance_uids in zip(self.servers, executor.map(ListServerStudies, self.servers)):
+                for study_instance_uid in study_instance_uids:
+                    if study_instance_uid not in found:
+                        found.add(study_instance_uid)
+                        studies_per_server.setdefault(server, []).append(study_instance_uid)
+                        federation_routes.set(self.federation, study_instance_uid, server)
+        return studies_per_server
+
+    def get_instances_list(self):
+        for driver in self.drivers:
+            driver.get_instances_list()
+
+    def get_instances_count(self) -> int:
+        return sum(driver.get_instances_count() for driver in self.drivers)
+
+    def retrieve_next_instance(self):
+        while self.current < len(self.drivers) and self.drivers[self.current].is_complete():
+            self.current += 1
+        if self.current >= len(self.drivers):
+            raise Exception('Trying to retrieve an instance that has not been listed!')
+        return self.drivers[self.current].retrieve_next_instance()
+
+    def forward_instance(self, orthanc_id):
+        self.drivers[self.current].forward_instance(orthanc_id)
+
+    def cleanup(self):
+        for driver in self.drivers:
+            driver.cleanup()
 
 
 def CreateMoveCallback(**request):
     # simply create the move driver object now and return it to Orthanc
-    orthanc.LogInfo("CreateMoveCallback")
     # pprint.pprint(request)
 
-    driver = MoveDriver(request=request)
+    if GetFederationServers(request["SourceAET"]) is not None:
+        driver = FederatedMoveDriver(request=request)
+    else:
+        driver = MoveDriver(request=request)
 
+    orthanc.LogInfo("[{0}] CreateMoveCallback: {1} level, from {2} to {3}".format(
+        driver.trace_id, request["Level"], request["SourceAET"], request["TargetAET"] or request["OriginatorAET"]))
     return driver
 
 def GetMoveSizeCallback(driver: MoveDriver):
     # query the remote server to list and count the instances to retrieve
-    orthanc.LogInfo("GetMoveSizeCallback")
+    orthanc.LogInfo("[{0}] GetMoveSizeCallback".format(driver.trace_id))
 
     driver.get_instances_list()
 
-    return len(driver.remote_instances)
+    return driver.get_instances_count()
 
 def ApplyMoveCallback(driver: MoveDriver):
     # move one instance at a time from the DICOMWeb server to the target via the proxy
-    orthanc.LogInfo("ApplyMoveCallback")
+    orthanc.LogInfo("[{0}] ApplyMoveCallback".format(driver.trace_id))
 
     instance_id = driver.retrieve_next_instance()
-    driver.forward_instance(instance_id)
+    if instance_id is not None:     # None: already delivered by a previous attempt of the same move
+        driver.forward_instance(instance_id)
 
     return 0 # 0 is success, you should raise an exception in case of errors
 
 def FreeMoveCallback(driver):
     # free the resources that have been allocated by the move driver
-    orthanc.LogInfo("FreeMoveCallback")
+    orthanc.LogInfo("[{0}] FreeMoveCallback".format(driver.trace_id))
 
     driver.cleanup()
     
 
 orthanc.RegisterFindCallback(OnFind)
 orthanc.RegisterMoveCallback2(CreateMoveCallback, GetMoveSizeCallback, ApplyMoveCallback, FreeMoveCallback)
+orthanc.RegisterIncomingHttpRequestFilter(OnIncomingHttpRequest)
+orthanc.RegisterRestCallback('/dicom-dicomweb-proxy/statistics', GetStatisticsCallback)
+orthanc.RegisterRestCallback('/dicom-dicomweb-proxy/metrics', GetMetricsCallback)
+orthanc.RegisterRestCallback('/dicom-dicomweb-proxy/instance-cache/studies/(.*)', PurgeInstanceCacheStudyCallback)
+orthanc.RegisterOnChangeCallback(OnChange)
 
 if os.environ.get('VERBOSE_ENABLED') in ["true", "True", True]:
-    verbose_enabled = True
\ No newline at end of file
+    verbose_enabled = True
+
+configuration = json.loads(orthanc.GetConfiguration())
+proxy_configuration = configuration.get("DicomWebProxy", {})
+dicomweb_clients.configure(configuration)
\ No newline at end of file
@@ -0,0 +1,65 @@
+import json
+import pathlib
+import sys
+import time
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+
+class TestFederatedFind(unittest.TestCase):
+
+    def setUp(self):
+        self.studies = {"PACS": ["1", "2"], "LEGACY": ["2", "3"]}
+        self.delays = {"PACS": 0, "LEGACY": 0}
+
+        def make_get(server):
+            def get(uri, body):
+                time.sleep(self.delays[server])
+                return json.dumps([{'0020000D': {'vr': 'UI', 'Value': [uid]}} for uid in self.studies[server]])
+            return get
+
+        for server in self.studies:
+            orthanc.SetRestApiHandler('POST', '/dicom-web/servers/{0}/get'.format(server), make_get(server))
+        proxy.proxy_configuration = {"Federations": {"ARCHIVES": ["PACS", "LEGACY"]}, "FederationTimeout": 1}
+        proxy.federation_routes = proxy.FederationRoutes()
+
+    def tearDown(self):
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def find(self):
+        answers = orthanc.FindAnswers()
+        query = orthanc.FindQuery([(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+                                   (0x0020, 0x000D, 'StudyInstanceUID', '')])
+        proxy.OnFind(answers, query, 'MODALITY', 'ARCHIVES')
+        return answers
+
+    def test_merged_answers(self):
+        answers = self.find()
+        self.assertEqual(['1', '2', '3'], sorted(json.loads(answer)['0020000D'] for answer in answers.answers))
+        self.assertFalse(answers.incomplete)
+        self.assertEqual('PACS', proxy.federation_routes.get('ARCHIVES', '1'))
+        self.assertEqual('LEGACY', proxy.federation_routes.get('ARCHIVES', '3'))
+
+    def test_timeout(self):
+        proxy.proxy_configuration["FederationTimeout"] = 0.1
+        self.delays["LEGACY"] = 0.5
+        answers = self.find()
+        self.assertEqual(['1', '2'], sorted(json.loads(answer)['0020000D'] for answer in answers.answers))
+        self.assertTrue(answers.incomplete)
+
+    def test_failure(self):
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/LEGACY/get', lambda uri, body: 1 / 0)
+        answers = self.find()
+        self.assertEqual(2, len(answers.answers))
+        self.assertTrue(answers.incomplete)
+
+
+if __name__ == '__main__':
+    unittest.main()
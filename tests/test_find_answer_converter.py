@@ -0,0 +1,119 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+
+def Convert(answer, requestedTags=None):
+    return json.loads(proxy.FindAnswerConverter(requestedTags).convert(answer))
+
+
+class TestFindAnswerConverter(unittest.TestCase):
+
+    def test_single_values(self):
+        self.assertEqual({
+            "00080020": "20130812",
+            "00080030": "101010.123",
+            "00201208": "1200",
+            "0020000D": "1.2.3"
+        }, Convert({
+            "00080020": {"vr": "DA", "Value": ["20130812"]},
+            "00080030": {"vr": "TM", "Value": ["101010.123"]},
+            "00201208": {"vr": "IS", "Value": [1200]},
+            "0020000D": {"vr": "UI", "Value": ["1.2.3"]}
+        }))
+
+    def test_multiple_values(self):
+        self.assertEqual({
+            "00080061": "CT\\PT\\SR",
+            "00280030": "0.5\\0.25"
+        }, Convert({
+            "00080061": {"vr": "CS", "Value": ["CT", "PT", "SR"]},
+            "00280030": {"vr": "DS", "Value": [0.5, 0.25]}
+        }))
+
+    def test_empty_values(self):
+        # tags without value are not converted, null values are empty strings
+        self.assertEqual({
+            "00080061": "CT\\\\SR"
+        }, Convert({
+            "00081030": {"vr": "LO"},
+            "00080061": {"vr": "CS", "Value": ["CT", None, "SR"]}
+        }))
+
+    def test_person_names(self):
+        self.assertEqual({
+            "00100010": "Yamada^Tarou=山田^太郎=やまだ^たろう",
+            "00080090": "Doe^John\\Smith^Jane",
+            "00081060": "Doe^John"
+        }, Convert({
+            "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Yamada^Tarou",
+                                                 "Ideographic": "山田^太郎",
+                                                 "Phonetic": "やまだ^たろう"}]},
+            "00080090": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}, {"Alphabetic": "Smith^Jane"}]},
+            "00081060": {"Value": [{"Alphabetic": "Doe^John"}]}     # no VR
+        }))
+
+    def test_sequences(self):
+        self.assertEqual({
+            "00081032": [
+                {"00080100": "CODE1", "00080102": "LOCAL"},
+                {"00080100": "CODE2", "00080104": "Doe^John"}
+            ],
+            "00081030": "description"
+        }, Convert({
+            "00081032": {"vr": "SQ", "Value": [
+                {"00080100": {"vr": "SH", "Value": ["CODE1"]},
+                 "00080102": {"vr": "SH", "Value": ["LOCAL"]}},
+                {"00080100": {"vr": "SH", "Value": ["CODE2"]},
+                 "00080104": {"vr": "PN", "Value": [{"Alphabetic": "Doe^John"}]}}
+            ]},
+            "00081030": {"vr": "LO", "Value": ["description"]}
+        }))
+
+    def test_requested_tags(self):
+        # the tags of the sequence items are kept, even if they have not been requested
+        self.assertEqual({
+            "0020000D": "1.2.3",
+            "00081032": [{"00080100": "CODE1"}]
+        }, Convert({
+            "0020000D": {"vr": "UI", "Value": ["1.2.3"]},
+            "00081030": {"vr": "LO", "Value": ["description"]},
+            "00081032": {"vr": "SQ", "Value": [{"00080100": {"vr": "SH", "Value": ["CODE1"]}}]}
+        }, requestedTags={"0020000D", "00081032"}))
+
+    def test_converter_reused_across_answers(self):
+        converter = proxy.FindAnswerConverter()
+        first = json.loads(converter.convert({"00080061": {"vr": "CS", "Value": ["CT", "MR"]}}))
+        second = json.loads(converter.convert({"00080061": {"vr": "CS", "Value": ["US"]}}))
+        self.assertEqual("CT\\MR", first["00080061"])
+        self.assertEqual("US", second["00080061"])
+
+    def test_character_set_always_returned(self):
+        # the SCU did not ask for the SpecificCharacterSet, but the names can not be decoded without it
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get', lambda uri, body: json.dumps([{
+            "00080005": {"vr": "CS", "Value": ["ISO_IR 192"]},
+            "00100010": {"vr": "PN", "Value": [{"Alphabetic": "Müller^Jörg"}]},
+            "0020000D": {"vr": "UI", "Value": ["1.2"]}
+        }]))
+        answers = orthanc.FindAnswers()
+        try:
+            proxy.OnFind(answers, orthanc.FindQuery([(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+                                                     (0x0010, 0x0010, 'PatientName', '')]),
+                         'MODALITY', 'PACS')
+        finally:
+            orthanc.Reset()
+
+        self.assertEqual([{"00080005": "ISO_IR 192", "00100010": "Müller^Jörg", "0020000D": "1.2"}],
+                         [json.loads(answer) for answer in answers.answers])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import json
+import pathlib
+import sys
+import threading
+import time
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import proxy
+
+
+def Page(answers):
+    page = proxy.QidoRsPage(answers)
+    page.raw = json.dumps(answers)
+    return page
+
+
+def WaitFor(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        if time.monotonic() > deadline:
+            raise Exception('timeout')
+        time.sleep(0.001)
+
+
+class TestFindCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = proxy.FindCache()
+        self.queries = 0
+
+    def tearDown(self):
+        proxy.proxy_configuration = {}
+
+    def query_pages(self, *pages):
+        def QueryPages():
+            self.queries += 1
+            for answers in pages:
+                yield Page(answers)
+        return QueryPages
+
+    def test_hit(self):
+        pages = self.query_pages([{"a": 1}], [{"b": 2}])
+        self.assertEqual([[{"a": 1}], [{"b": 2}]], list(self.cache.get_pages("key", 60, pages)))
+        self.assertEqual([[{"a": 1}], [{"b": 2}]], list(self.cache.get_pages("key", 60, pages)))
+        self.assertEqual(1, self.queries)
+
+    def test_disabled(self):
+        pages = self.query_pages([{"a": 1}])
+        list(self.cache.get_pages("key", 0, pages))
+        list(self.cache.get_pages("key", 0, pages))
+        self.assertEqual(2, self.queries)
+        self.assertEqual(0, len(self.cache.entries))
+
+    def test_expiration(self):
+        pages = self.query_pages([{"a": 1}])
+        list(self.cache.get_pages("key", 0.01, pages))
+        time.sleep(0.02)
+        list(self.cache.get_pages("key", 0.01, pages))
+        self.assertEqual(2, self.queries)
+
+    def test_lru_eviction(self):
+        # each entry is 10 bytes ('[{"a": 1}]'): only 2 of them fit
+        proxy.proxy_configuration = {"FindCacheMaxBytes": 25}
+        for key in ["1", "2"]:
+            list(self.cache.get_pages(key, 60, self.query_pages([{"a": 1}])))
+        list(self.cache.get_pages("1", 60, self.query_pages([{"a": 1}])))     # "1" is now the most recently used
+        list(self.cache.get_pages("3", 60, self.query_pages([{"a": 1}])))
+
+        self.assertEqual(["1", "3"], list(self.cache.entries))
+        self.assertEqual(20, self.cache.total_bytes)
+
+    def test_too_large(self):
+        proxy.proxy_configuration = {"FindCacheMaxBytes": 5}
+        list(self.cache.get_pages("key", 60, self.query_pages([{"a": 1}])))
+        self.assertEqual(0, len(self.cache.entries))
+
+    def follow(self, leader_pages, follower_pages, leader_stops_early=False):
+        # runs a leader query that is held until an identical follower query waits for it
+        # :return: the pages received by the follower
+        release = threading.Event()
+
+        def LeaderPages():
+            release.wait()
+            yield from leader_pages()
+
+        def Leader():
+            pages = self.cache.get_pages("key", 60, LeaderPages)
+            try:
+                if leader_stops_early:
+                    next(pages)
+                    pages.close()
+                else:
+                    list(pages)
+            except Exception:
+                pass
+
+        received = []
+        coalesced = proxy.counters.get_all().get("find_cache_coalesced", 0)
+        leader = threading.Thread(target=Leader)
+        leader.start()
+        WaitFor(lambda: "key" in self.cache.in_flight)
+        follower = threading.Thread(target=lambda: received.extend(self.cache.get_pages("key", 60, follower_pages)))
+        follower.start()
+        WaitFor(lambda: proxy.counters.get_all().get("find_cache_coalesced", 0) > coalesced)
+        release.set()
+        leader.join()
+        follower.join()
+        return received
+
+    def test_coalescing(self):
+        pages = self.follow(self.query_pages([{"a": 1}]), self.query_pages([{"b": 2}]))
+        # the follower got the answers of the leader, and the DICOMweb server was queried once
+        self.assertEqual([[{"a": 1}]], pages)
+        self.assertEqual(1, self.queries)
+
+    def test_leader_failure(self):
+        def FailingPages():
+            yield Page([{"a": 1}])
+            raise Exception("DICOMweb server unavailable")
+
+        pages = self.follow(FailingPages, self.query_pages([{"b": 2}]))
+        # the follower has queried the server on its own
+        self.assertEqual([[{"b": 2}]], pages)
+        self.assertEqual(1, self.queries)
+        self.assertEqual([], list(self.cache.in_flight))
+
+    def test_leader_stopped_early(self):
+        # e.g. a C-find with more matches than 'QidoMaxResults': the leader does not read all the pages, which
+        # are neither cached nor given to the follower (that queries the server on its own)
+        pages = self.follow(self.query_pages([{"a": 1}], [{"a": 2}]), self.query_pages([{"b": 2}]), leader_stops_early=True)
+        self.assertEqual([[{"b": 2}]], pages)
+        self.assertEqual(2, self.queries)
+        self.assertEqual([], list(self.cache.in_flight))
+        self.assertEqual(0, len(self.cache.entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunFind, RunMove
+
+
+class TestHarness(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = DicomWebStandIn(studies=3, series_per_study=2, instances_per_series=5, instance_size=1024).start()
+        self.simulated = SimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+
+    def tearDown(self):
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def test_find(self):
+        self.simulated.install()
+        answers = RunFind("PACS", [(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+                                   (0x0020, 0x000D, 'StudyInstanceUID', '')])
+        self.assertEqual(3, len(answers.answers))
+
+    def test_move(self):
+        for options in [{"RetrieveMode": "Instance"}, {"RetrieveMode": "Chunk"}, {"TransitMode": True}]:
+            self.simulated.install(options)
+            stored = self.simulated.stored_instances
+            self.assertEqual(10, RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(1)))
+            self.assertEqual(10, self.simulated.stored_instances - stored)
+            self.assertEqual(0, self.simulated.current_stored_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
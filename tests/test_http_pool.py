@@ -0,0 +1,88 @@
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunFind, RunMove
+
+
+class TestHttpPool(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = DicomWebStandIn(studies=2, series_per_study=2, instances_per_series=10, instance_size=1024).start()
+        self.simulated = SimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+
+    def tearDown(self):
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+        proxy.dicomweb_clients.configure({})
+
+    def test_keep_alive(self):
+        self.simulated.install({"HttpPool": True, "HttpPoolSize": 2})
+        answers = RunFind("PACS", [(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+                                   (0x0020, 0x000D, 'StudyInstanceUID', '')])
+        self.assertEqual(2, len(answers.answers))
+
+        stored = self.simulated.stored_instances
+        self.assertEqual(20, RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0)))
+        self.assertEqual(20, self.simulated.stored_instances - stored)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+
+        # the requests went through the pool, not through the DICOMweb client of Orthanc
+        self.assertEqual(0, self.simulated.http_requests)
+        self.assertLessEqual(self.standin.connections, 2)
+
+    def test_series_streamed(self):
+        # the instances of a series are stored in the proxy as soon as they are received
+        self.simulated.install({"HttpPool": True, "RetrieveMode": "Series"})
+        stored = self.simulated.stored_instances
+        self.assertEqual(20, RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(1)))
+        self.assertEqual(20, self.simulated.stored_instances - stored)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+        self.assertEqual(0, self.simulated.http_requests)
+
+    def test_configuration(self):
+        proxy.proxy_configuration = {"HttpPool": True, "Servers": {"OTHER": {"HttpPool": False}}}
+        proxy.dicomweb_clients.configure({"DicomWeb": {"Servers": {
+            "PACS": ["https://pacs/dicom-web", "user", "password"],
+            "OTHER": {"Url": "http://other/dicom-web/"},
+            "VENDOR": {"Url": "http://vendor:8080/wado", "HttpHeaders": {"api-key": "secret"}}
+        }}})
+
+        client = proxy.dicomweb_clients.get_client("PACS")
+        self.assertTrue(client.https)
+        self.assertEqual(443, client.port)
+        self.assertEqual("/dicom-web/", client.root)
+        self.assertEqual("Basic dXNlcjpwYXNzd29yZA==", client.headers["Authorization"])
+
+        client = proxy.dicomweb_clients.get_client("VENDOR")
+        self.assertEqual(8080, client.port)
+        self.assertEqual({"api-key": "secret"}, client.headers)
+
+        # the other servers go through the DICOMweb client of Orthanc
+        self.assertIsNone(proxy.dicomweb_clients.get_client("OTHER"))
+        self.assertIsNone(proxy.dicomweb_clients.get_client("UNKNOWN"))
+
+    def test_error(self):
+        self.simulated.install({"HttpPool": True})
+        client = proxy.dicomweb_clients.get_client("PACS")
+        with self.assertRaises(Exception):
+            client.get("unknown", {}, {})
+
+        # the connection is still usable
+        contentType, body = client.get("studies", {}, {})
+        self.assertEqual("application/dicom+json", contentType)
+        self.assertEqual(1, self.standin.connections)
+
+
+if __name__ == '__main__':
+    unittest.main()
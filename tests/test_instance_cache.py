@@ -0,0 +1,92 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+
+class TestInstanceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.stored = {}        # sop instance uid -> orthanc id
+        self.deleted = []
+
+        def delete(uri, body):
+            for orthanc_id in json.loads(body)["Resources"]:
+                self.deleted.append(orthanc_id)
+                self.stored = {sop: i for sop, i in self.stored.items() if i != orthanc_id}
+            return '{}'
+
+        def lookup(sop, body):
+            if sop not in self.stored:
+                raise Exception('not found')
+            return self.stored[sop]
+
+        orthanc.SetRestApiHandler('POST', '/tools/bulk-delete', delete)
+        orthanc.SetRestApiHandler('LOOKUP', '', lookup)
+        proxy.proxy_configuration = {"InstanceCacheMaxBytes": 300, "InstanceCacheTtl": 60}
+        self.cache = proxy.InstanceCache()
+
+    def tearDown(self):
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def add(self, sop, study="1.2", size=100):
+        self.stored[sop] = "id-" + sop
+        self.assertTrue(self.cache.add(sop, "id-" + sop, study, size))
+        self.cache.release([sop])
+
+    def test_hit_and_miss(self):
+        self.add("a")
+        self.assertEqual(("id-a", 100), self.cache.acquire("a"))
+        self.assertIsNone(self.cache.acquire("b"))
+
+    def test_lru_eviction(self):
+        self.add("a")
+        self.add("b")
+        self.add("c")
+        self.cache.acquire("a")
+        self.cache.release(["a"])
+        self.add("d")
+        self.assertEqual(["id-b"], self.deleted)
+        self.assertEqual(300, self.cache.total_bytes)
+
+    def test_pinned_instances_are_not_evicted(self):
+        self.stored["a"] = "id-a"
+        self.cache.add("a", "id-a", "1.2", 200)
+        self.add("b", size=200)
+        self.assertEqual(["id-b"], self.deleted)
+        self.cache.release(["a"])
+        self.assertEqual(("id-a", 200), self.cache.acquire("a"))
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.add("a", "id-a", "1.2", 301))
+
+    def test_expired(self):
+        proxy.proxy_configuration["InstanceCacheTtl"] = 0
+        self.add("a")
+        self.assertEqual(["id-a"], self.deleted)
+        self.assertIsNone(self.cache.acquire("a"))
+
+    def test_deleted_from_orthanc(self):
+        self.add("a")
+        del self.stored["a"]
+        self.assertIsNone(self.cache.acquire("a"))
+        self.assertEqual(0, self.cache.total_bytes)
+
+    def test_purge_study(self):
+        self.add("a", study="1")
+        self.add("b", study="2")
+        self.assertEqual(1, self.cache.purge_study("1"))
+        self.assertEqual(["id-a"], self.deleted)
+        self.assertEqual(("id-b", 100), self.cache.acquire("b"))
+
+
+if __name__ == '__main__':
+    unittest.main()
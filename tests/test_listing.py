@@ -0,0 +1,77 @@
+import pathlib
+import sys
+import time
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc
+
+
+class SlowFirstStudySimulatedOrthanc(SimulatedOrthanc):
+    # the listing of the first study is the slowest one
+
+    def __init__(self, first_study_uid):
+        super().__init__()
+        self.first_study_uid = first_study_uid
+
+    def dicomweb_get(self, uri, body):
+        if self.first_study_uid in body:
+            time.sleep(0.05)
+        return super().dicomweb_get(uri, body)
+
+
+class TestListing(unittest.TestCase):
+
+    def setUp(self):
+        # an archive capping the QIDO-RS answers below the page size of the listing
+        self.standin = DicomWebStandIn(studies=3, series_per_study=2, instances_per_series=30, instance_size=16,
+                                       qido_max_results=20).start()
+        self.simulated = SimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+
+    def tearDown(self):
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def expected(self, study):
+        return [(self.standin.study_uid(study), self.standin.series_uid(study, series), self.standin.sop_uid(study, series, instance))
+                for series in range(2) for instance in range(30)]
+
+    def test_qido(self):
+        for options in [{"ListingMode": "Qido"}, {"ListingMode": "Qido", "QidoPageSize": 25}]:
+            self.simulated.install(options)
+            self.assertEqual(sorted(self.expected(1)), sorted(proxy.ListStudyInstances("PACS", self.standin.study_uid(1))))
+
+    def test_qido_series(self):
+        self.simulated.install({"ListingMode": "QidoSeries"})
+        self.assertEqual(sorted(self.expected(1)), sorted(proxy.ListStudyInstances("PACS", self.standin.study_uid(1))))
+
+        uids = proxy.ListStudyInstances("PACS", self.standin.study_uid(1), self.standin.series_uid(1, 0))
+        self.assertEqual(sorted(self.expected(1)[:30]), sorted(uids))
+
+    def test_parallel_listing_order(self):
+        # the studies are listed in parallel, the instances are moved in the order of the query
+        self.simulated = SlowFirstStudySimulatedOrthanc(self.standin.study_uid(2))
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+        self.simulated.install({"ListingMode": "Qido", "ListingWorkers": 3})
+        studies = [self.standin.study_uid(i) for i in [2, 0, 1]]
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID="\\".join(studies),
+                                          TargetAET="MODALITY", OriginatorAET="MODALITY")
+        try:
+            self.assertEqual(180, proxy.GetMoveSizeCallback(driver))
+            listed = [driver.remote_instances[i].study_instance_uid for i in range(180)]
+        finally:
+            proxy.FreeMoveCallback(driver)
+        self.assertEqual([study for study in studies for i in range(60)], listed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = proxy.Metrics()
+
+    def test_histogram(self):
+        self.metrics.observe("qido_request_seconds", 0.02, server="PACS")
+        self.metrics.observe("qido_request_seconds", 100, server="PACS")
+        lines = self.metrics.get_prometheus_text({}).splitlines()
+
+        self.assertIn('# TYPE dicomweb_proxy_qido_request_seconds histogram', lines)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_bucket{server="PACS",le="0.01"} 0', lines)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_bucket{server="PACS",le="0.025"} 1', lines)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_bucket{server="PACS",le="60"} 1', lines)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_bucket{server="PACS",le="+Inf"} 2', lines)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_sum{server="PACS"} 100.02', lines)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_count{server="PACS"} 2', lines)
+
+    def test_counters_and_statistics(self):
+        self.metrics.increment("target_sent_bytes", 10, target_aet="MODALITY")
+        self.metrics.increment("target_sent_bytes", 5, target_aet="MODALITY")
+        self.metrics.increment("target_sent_bytes", 1, target_aet='A"B')
+        lines = self.metrics.get_prometheus_text({"find_cache_bytes": 3, "scheduler": {"PACS": {"limit": 4}}}).splitlines()
+
+        self.assertIn('dicomweb_proxy_target_sent_bytes_total{target_aet="MODALITY"} 15', lines)
+        self.assertIn('dicomweb_proxy_target_sent_bytes_total{target_aet="A\\"B"} 1', lines)
+        self.assertIn('dicomweb_proxy_find_cache_bytes 3', lines)
+        self.assertIn('dicomweb_proxy_scheduler_limit{server="PACS"} 4', lines)
+
+    def test_find(self):
+        proxy.metrics = self.metrics
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get',
+                                  lambda uri, body: json.dumps([{'0020000D': {'vr': 'UI', 'Value': ['1.2.3']}}]))
+        try:
+            proxy.OnFind(orthanc.FindAnswers(), orthanc.FindQuery([(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+                                                                   (0x0020, 0x000D, 'StudyInstanceUID', '')]),
+                         'MODALITY', 'PACS')
+        finally:
+            orthanc.Reset()
+        text = self.metrics.get_prometheus_text({})
+
+        self.assertIn('dicomweb_proxy_find_answers_total{called_aet="PACS"} 1', text)
+        self.assertIn('dicomweb_proxy_qido_request_seconds_count{server="PACS"} 1', text)
+        self.assertIn('dicomweb_proxy_find_conversion_seconds_count{server="PACS"} 1', text)
+        self.assertIn('dicomweb_proxy_find_seconds_count{called_aet="PACS"} 1', text)
+
+    def tearDown(self):
+        proxy.metrics = proxy.Metrics()
+
+
+if __name__ == '__main__':
+    unittest.main()
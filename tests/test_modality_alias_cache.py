@@ -0,0 +1,99 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+
+class TestModalityAliasCache(unittest.TestCase):
+
+    def setUp(self):
+        self.modalities = {"modality": {"AET": "MODALITY"}, "other": {"AET": "OTHER"}}
+        self.refreshes = 0
+
+        def get(uri, body):
+            self.refreshes += 1
+            return json.dumps(self.modalities)
+
+        orthanc.SetRestApiHandler('GET', '/modalities', get)
+        self.cache = proxy.ModalityAliasCache()
+
+    def tearDown(self):
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def test_lookup(self):
+        self.assertEqual("modality", self.cache.lookup("MODALITY"))
+        self.assertEqual("other", self.cache.lookup("OTHER"))
+        self.assertEqual(1, self.refreshes)
+
+    def test_unknown_aet_refreshes(self):
+        self.assertEqual("modality", self.cache.lookup("MODALITY"))
+        # a modality added since the last refresh is found
+        self.modalities["new"] = {"AET": "NEW"}
+        self.assertEqual("new", self.cache.lookup("NEW"))
+        self.assertIsNone(self.cache.lookup("UNKNOWN"))
+        self.assertEqual(3, self.refreshes)
+
+    def test_expiration(self):
+        proxy.proxy_configuration = {"ModalitiesCacheTtl": 0}
+        self.cache.lookup("MODALITY")
+        self.cache.lookup("MODALITY")
+        self.assertEqual(2, self.refreshes)
+
+    def test_invalidated_by_the_rest_api(self):
+        proxy.modality_alias_cache = self.cache
+        try:
+            self.assertEqual("modality", proxy.GetOrthancAliasFromAET("MODALITY"))
+
+            # reads and the other routes do not invalidate the index
+            proxy.OnIncomingHttpRequest('/modalities/modality', method=orthanc.HttpMethod.GET)
+            proxy.OnIncomingHttpRequest('/peers/modality', method=orthanc.HttpMethod.PUT)
+            self.assertEqual("modality", proxy.GetOrthancAliasFromAET("MODALITY"))
+            self.assertEqual(1, self.refreshes)
+
+            # the AET of a modality is given to another one: the index would still be trusted without the invalidation
+            self.modalities["modality"]["AET"] = "RENAMED"
+            self.modalities["new"] = {"AET": "MODALITY"}
+            proxy.OnIncomingHttpRequest('/modalities/new', method=orthanc.HttpMethod.PUT)
+            self.assertEqual("new", proxy.GetOrthancAliasFromAET("MODALITY"))
+            self.assertEqual(2, self.refreshes)
+
+            # a modality is removed
+            del self.modalities["other"]
+            proxy.OnIncomingHttpRequest('/modalities/other', method=orthanc.HttpMethod.DELETE)
+            with self.assertRaises(Exception):
+                proxy.GetOrthancAliasFromAET("OTHER")
+        finally:
+            proxy.modality_alias_cache = proxy.ModalityAliasCache()
+
+    def test_lookup_before_the_change_is_applied(self):
+        # the HTTP filter runs before the modification: an index built in the meantime is stale and not trusted
+        self.cache.lookup("MODALITY")
+        self.cache.invalidate()
+        self.assertEqual("modality", self.cache.lookup("MODALITY"))
+        self.modalities["modality"]["AET"] = "RENAMED"
+        self.modalities["new"] = {"AET": "MODALITY"}
+        self.assertEqual("new", self.cache.lookup("MODALITY"))
+        self.assertEqual(3, self.refreshes)
+
+        # the index is trusted again once the delay is elapsed
+        self.cache.trusted_after = 0
+        self.cache.refresh()
+        self.cache.lookup("MODALITY")
+        self.assertEqual(4, self.refreshes)
+
+    def test_same_aet(self):
+        # as with a linear scan of the modalities, the first one wins
+        self.modalities["duplicate"] = {"AET": "MODALITY"}
+        self.assertEqual("modality", self.cache.lookup("MODALITY"))
+
+
+if __name__ == '__main__':
+    unittest.main()
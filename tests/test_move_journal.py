@@ -0,0 +1,129 @@
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc
+
+
+class TestMoveJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        proxy.proxy_configuration = {"MoveJournalWindow": 600,
+                                     "MoveJournalPath": os.path.join(self.directory.name, "journal.sqlite")}
+        self.journal = proxy.MoveJournal()
+
+    def tearDown(self):
+        self.journal.connection.close()
+        self.directory.cleanup()
+        proxy.proxy_configuration = {}
+
+    def test_record(self):
+        self.journal.record("move", ["1", "2"])
+        self.journal.record("move", ["2", "3"])
+        self.journal.record("other", ["4"])
+        self.assertEqual({"1", "2", "3"}, self.journal.get_delivered("move"))
+        self.assertEqual(set(), self.journal.get_delivered("unknown"))
+
+    def test_forget(self):
+        self.journal.record("move", ["1"])
+        self.journal.forget("move")
+        self.assertEqual(set(), self.journal.get_delivered("move"))
+
+    def test_window(self):
+        self.journal.record("move", ["1"])
+        proxy.proxy_configuration["MoveJournalWindow"] = -1
+        self.assertEqual(set(), self.journal.get_delivered("move"))
+        proxy.proxy_configuration["MoveJournalWindow"] = 600
+        self.assertEqual(set(), self.journal.get_delivered("move"))
+
+
+class RetrievalsSimulatedOrthanc(SimulatedOrthanc):
+    # counts the instances retrieved in the proxy
+
+    def __init__(self):
+        super().__init__()
+        self.retrieved_instances = 0
+
+    def _store_instance(self, sop: str, study: str, size: int):
+        super()._store_instance(sop, study, size)
+        with self.lock:
+            self.retrieved_instances += 1
+
+
+class TestMoveResume(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.standin = DicomWebStandIn(studies=1, series_per_study=2, instances_per_series=10, instance_size=1024).start()
+        self.simulated = RetrievalsSimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+        self.move_journal = proxy.move_journal
+        proxy.move_journal = proxy.MoveJournal()
+
+    def tearDown(self):
+        if proxy.move_journal.connection is not None:
+            proxy.move_journal.connection.close()
+        proxy.move_journal = self.move_journal
+        self.standin.stop()
+        self.directory.cleanup()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def move(self, applied: int):
+        # a C-move interrupted after 'applied' sub-operations
+        # :return: (number of sub-operations, journal key)
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0),
+                                          TargetAET="MODALITY", OriginatorAET="MODALITY")
+        try:
+            count = proxy.GetMoveSizeCallback(driver)
+            for i in range(min(applied, count)):
+                proxy.ApplyMoveCallback(driver)
+        finally:
+            proxy.FreeMoveCallback(driver)
+        return count, driver.journal_key
+
+    def resume(self, options):
+        self.simulated.install(dict(options, MoveJournalWindow=600,
+                                    MoveJournalPath=os.path.join(self.directory.name, "journal.sqlite")))
+        self.assertEqual(20, self.move(12)[0])
+        self.assertEqual(12, self.simulated.stored_instances)
+
+        # interrupted again (with more instances delivered than left to deliver): the journal is kept, with the
+        # instances delivered by both attempts
+        count, key = self.move(15)
+        self.assertEqual(20, count)
+        self.assertEqual(15, self.simulated.stored_instances)
+        self.assertEqual(15, len(proxy.move_journal.get_delivered(key)))
+
+        self.assertEqual({}, self.simulated.instances)
+
+        # completed: the journal is cleared
+        retrieved = self.simulated.retrieved_instances
+        self.assertEqual(20, self.move(20)[0])
+        self.assertEqual(20, self.simulated.stored_instances)
+        self.assertEqual(set(), proxy.move_journal.get_delivered(key))
+
+        # the delivered instances were not retrieved again, and none is left in the proxy
+        self.assertEqual(5, self.simulated.retrieved_instances - retrieved)
+        self.assertEqual({}, self.simulated.instances)
+
+    def test_resume(self):
+        self.resume({"PrefetchWorkers": 0})
+
+    def test_resume_series(self):
+        self.resume({"RetrieveMode": "Series", "PrefetchWorkers": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
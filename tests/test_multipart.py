@@ -0,0 +1,99 @@
+import io
+import pathlib
+import struct
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import proxy
+
+
+class TestParseMultipartRelated(unittest.TestCase):
+
+    def test_single_part(self):
+        body = (b'--abc\r\n'
+                b'Content-Type: application/dicom; transfer-syntax=1.2.840.10008.1.2.1\r\n'
+                b'Content-Length: 8\r\n'
+                b'\r\n'
+                b'DICM\r\n\x00\x01'
+                b'\r\n--abc--\r\n')
+        parts = proxy.ParseMultipartRelated(body)
+        self.assertEqual(1, len(parts))
+        self.assertEqual('application/dicom; transfer-syntax=1.2.840.10008.1.2.1', parts[0][0]['content-type'])
+        self.assertEqual(b'DICM\r\n\x00\x01', parts[0][1])
+
+    def test_several_parts(self):
+        body = (b'\r\n--abc\r\nContent-Type: application/dicom\r\n\r\nfirst'
+                b'\r\n--abc\r\n\r\nsecond'
+                b'\r\n--abc--')
+        parts = proxy.ParseMultipartRelated(body)
+        self.assertEqual([b'first', b'second'], [content for headers, content in parts])
+        self.assertEqual({}, parts[1][0])
+
+    def test_not_multipart(self):
+        with self.assertRaises(Exception):
+            proxy.ParseMultipartRelated(b'{"error": "not found"}')
+
+        with self.assertRaises(Exception):
+            proxy.ParseMultipartRelated(b'--abc\r\n\r\ntruncated')
+
+
+class TestIterMultipartRelated(unittest.TestCase):
+
+    BODIES = [
+        (b'--abc\r\nContent-Type: application/dicom\r\nContent-Length: 8\r\n\r\nDICM\r\n\x00\x01\r\n--abc--\r\n'),
+        (b'\r\n--abc\r\nContent-Type: application/dicom\r\n\r\nfirst'
+         b'\r\n--abc\r\n\r\nsecond'
+         b'\r\n--abc--')
+    ]
+
+    def setUp(self):
+        self.read_size = proxy.MULTIPART_READ_SIZE
+
+    def tearDown(self):
+        proxy.MULTIPART_READ_SIZE = self.read_size
+
+    def test_same_parts_whatever_the_read_size(self):
+        for body in self.BODIES:
+            for readSize in [1, 2, 3, 7, len(body)]:
+                proxy.MULTIPART_READ_SIZE = readSize
+                self.assertEqual(proxy.ParseMultipartRelated(body), list(proxy.IterMultipartRelated(io.BytesIO(body).read)))
+
+    def test_parts_yielded_as_received(self):
+        proxy.MULTIPART_READ_SIZE = 4
+        body = io.BytesIO(self.BODIES[1])
+        parts = proxy.IterMultipartRelated(body.read)
+        self.assertEqual(b'first', next(parts)[1])
+        self.assertLess(body.tell(), len(self.BODIES[1]))
+        self.assertEqual([b'second'], [content for headers, content in parts])
+
+    def test_not_multipart(self):
+        proxy.MULTIPART_READ_SIZE = 3
+        with self.assertRaises(Exception):
+            list(proxy.IterMultipartRelated(io.BytesIO(b'{"error": "not found"}').read))
+
+        with self.assertRaises(Exception):
+            list(proxy.IterMultipartRelated(io.BytesIO(b'--abc\r\n\r\ntruncated').read))
+
+
+class TestTransferSyntax(unittest.TestCase):
+
+    def test_from_content_type(self):
+        self.assertEqual('1.2.840.10008.1.2.4.50', proxy.GetTransferSyntaxFromContentType('application/dicom; transfer-syntax=1.2.840.10008.1.2.4.50'))
+        self.assertEqual('1.2.840.10008.1.2.1', proxy.GetTransferSyntaxFromContentType('application/dicom;Transfer-Syntax="1.2.840.10008.1.2.1"'))
+        self.assertIsNone(proxy.GetTransferSyntaxFromContentType('application/dicom'))
+
+    def test_from_dicom_file(self):
+        content = (b'\0' * 128 + b'DICM'
+                   + struct.pack('<HH', 0x0002, 0x0001) + b'OB\0\0' + struct.pack('<I', 2) + b'\0\1'
+                   + struct.pack('<HH', 0x0002, 0x0010) + b'UI' + struct.pack('<H', 20) + b'1.2.840.10008.1.2.1\0'
+                   + struct.pack('<HH', 0x0008, 0x0016) + b'UI' + struct.pack('<H', 4) + b'1.2\0')
+        self.assertEqual('1.2.840.10008.1.2.1', proxy.ReadTransferSyntaxFromDicomFile(content))
+        self.assertIsNone(proxy.ReadTransferSyntaxFromDicomFile(b'not a DICOM file'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunFind, RunMove
+
+
+class TestPatientLevel(unittest.TestCase):
+
+    def setUp(self):
+        # 5 studies of 2 series of 3 instances: PID0 has the studies 0, 2 and 4, PID1 has the studies 1 and 3
+        self.standin = DicomWebStandIn(studies=5, series_per_study=2, instances_per_series=3, instance_size=1024,
+                                       patients=2).start()
+        self.simulated = SimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+        self.simulated.install()
+
+    def tearDown(self):
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def test_find(self):
+        answers = RunFind("PACS", [(0x0008, 0x0052, 'QueryRetrieveLevel', 'PATIENT'),
+                                   (0x0010, 0x0010, 'PatientName', ''),
+                                   (0x0020, 0x1200, 'NumberOfPatientRelatedStudies', ''),
+                                   (0x0020, 0x1204, 'NumberOfPatientRelatedInstances', '')])
+        patients = [json.loads(answer) for answer in answers.answers]
+        self.assertEqual([{"00100010": "PATIENT^0", "00100020": "PID0", "00201200": "3", "00201204": "18"},
+                          {"00100010": "PATIENT^1", "00100020": "PID1", "00201200": "2", "00201204": "12"}], patients)
+
+    def test_find_max_results(self):
+        proxy.proxy_configuration["QidoMaxResults"] = 3
+        answers = RunFind("PACS", [(0x0008, 0x0052, 'QueryRetrieveLevel', 'PATIENT'),
+                                   (0x0010, 0x0020, 'PatientID', ''),
+                                   (0x0020, 0x1200, 'NumberOfPatientRelatedStudies', '')])
+        self.assertEqual([{"00100020": "PID0", "00201200": "2"}, {"00100020": "PID1", "00201200": "1"}],
+                         [json.loads(answer) for answer in answers.answers])
+        self.assertTrue(answers.incomplete)
+
+    def test_move(self):
+        stored = self.simulated.stored_instances
+        self.assertEqual(18, RunMove(Level="PATIENT", SourceAET="PACS", PatientID="PID0", StudyInstanceUID=""))
+        self.assertEqual(18, self.simulated.stored_instances - stored)
+
+        self.assertEqual(30, RunMove(Level="PATIENT", SourceAET="PACS", PatientID="PID0\\PID1", StudyInstanceUID=""))
+        self.assertEqual(0, RunMove(Level="PATIENT", SourceAET="PACS", PatientID="UNKNOWN", StudyInstanceUID=""))
+
+    def test_federated_move(self):
+        legacy = DicomWebStandIn(studies=5, series_per_study=1, instances_per_series=1, instance_size=1024,
+                                 patients=2).start()
+        try:
+            self.simulated.add_dicomweb_server("LEGACY", legacy.url)
+            self.simulated.install({"Federations": {"ARCHIVES": ["PACS", "LEGACY"]}})
+            # the same studies are on both servers: they are moved from the first one, the second one is only queried
+            # (its studies are listed until an empty page)
+            self.assertEqual(18, RunMove(Level="PATIENT", SourceAET="ARCHIVES", PatientID="PID0", StudyInstanceUID=""))
+            self.assertEqual(2, legacy.requests)
+            self.assertEqual('PACS', proxy.federation_routes.get('ARCHIVES', self.standin.study_uid(2)))
+        finally:
+            legacy.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
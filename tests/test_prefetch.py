@@ -0,0 +1,135 @@
+import pathlib
+import sys
+import time
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunMove
+
+
+class PrefetchSimulatedOrthanc(SimulatedOrthanc):
+    # the target is slow, so that the prefetch workers get ahead of the forwarded instances as far as allowed;
+    # the retrieval of a given instance fails
+
+    def __init__(self):
+        super().__init__()
+        self.failing_sop = None
+        self.peak_stored_instances = 0
+
+    def _store_instance(self, sop: str, study: str, size: int):
+        super()._store_instance(sop, study, size)
+        with self.lock:
+            self.peak_stored_instances = max(self.peak_stored_instances, len(self.instances))
+
+    def dicomweb_retrieve(self, uri, body):
+        if self.failing_sop is not None and self.failing_sop in body:
+            raise Exception('HTTP status 500 from the DICOMweb server')
+        return super().dicomweb_retrieve(uri, body)
+
+    def store(self, uri, body):
+        time.sleep(0.005)
+        return super().store(uri, body)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = DicomWebStandIn(studies=1, series_per_study=2, instances_per_series=10, instance_size=1024).start()
+        self.simulated = PrefetchSimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+        self.cleanup_batch_size = proxy.CLEANUP_BATCH_SIZE
+        # the forwarded instances are deleted right away: the instances in the proxy are the prefetched ones
+        proxy.CLEANUP_BATCH_SIZE = 1
+
+    def tearDown(self):
+        proxy.CLEANUP_BATCH_SIZE = self.cleanup_batch_size
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def move(self):
+        stored = self.simulated.stored_instances
+        self.assertEqual(20, RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0)))
+        self.assertEqual(20, self.simulated.stored_instances - stored)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+
+    def test_window(self):
+        self.simulated.install({"PrefetchWindow": 3, "PrefetchWorkers": 2})
+        self.move()
+        # the instance being forwarded + the ones retrieved ahead of it
+        self.assertGreater(self.simulated.peak_stored_instances, 1)
+        self.assertLessEqual(self.simulated.peak_stored_instances, 4)
+
+    def scheduled_chunks(self, options):
+        # :return: (cursor, number of chunks scheduled) after each sub-operation, once the retrievals are completed
+        self.simulated.install(options)
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0),
+                                          TargetAET="MODALITY", OriginatorAET="MODALITY")
+        scheduled = []
+        try:
+            proxy.GetMoveSizeCallback(driver)
+            for i in range(6):
+                proxy.ApplyMoveCallback(driver)
+                time.sleep(0.05)
+                scheduled.append((driver.instance_counter, driver.prefetch_next_chunk))
+        finally:
+            proxy.FreeMoveCallback(driver)
+        return scheduled
+
+    def test_max_bytes(self):
+        # without cap, the chunks of the whole window are scheduled
+        for cursor, chunks in self.scheduled_chunks({"PrefetchWindow": 4}):
+            self.assertEqual(cursor + 4, chunks)
+
+        # with a cap, the chunks after the cursor are not scheduled while the retrieved instances exceed it
+        # (only the first ones can be, before any instance is retrieved)
+        for cursor, chunks in self.scheduled_chunks({"PrefetchWindow": 4, "PrefetchMaxBytes": 1}):
+            self.assertLessEqual(chunks, max(4, cursor + 1))
+
+    def test_without_workers(self):
+        self.simulated.install({"PrefetchWorkers": 0})
+        self.move()
+        self.assertEqual(1, self.simulated.peak_stored_instances)
+
+    def test_failed_instance(self):
+        # only the sub-operation of the failed instance fails
+        self.simulated.install()
+        self.simulated.failing_sop = self.standin.sop_uid(0, 0, 3)
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0),
+                                          TargetAET="MODALITY", OriginatorAET="MODALITY")
+        failures = []
+        try:
+            for i in range(proxy.GetMoveSizeCallback(driver)):
+                try:
+                    proxy.ApplyMoveCallback(driver)
+                except Exception:
+                    failures.append(i)
+        finally:
+            proxy.FreeMoveCallback(driver)
+        self.assertEqual([3], failures)
+        self.assertEqual(19, self.simulated.stored_instances)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+
+    def test_canceled_move(self):
+        # the instances retrieved ahead of the cursor are deleted when the move is freed
+        self.simulated.install({"PrefetchWindow": 8})
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0),
+                                          TargetAET="MODALITY", OriginatorAET="MODALITY")
+        proxy.GetMoveSizeCallback(driver)
+        proxy.ApplyMoveCallback(driver)
+        proxy.ApplyMoveCallback(driver)
+        proxy.FreeMoveCallback(driver)
+        self.assertEqual(2, self.simulated.stored_instances)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+        self.assertEqual({}, self.simulated.instances)
+
+
+if __name__ == '__main__':
+    unittest.main()
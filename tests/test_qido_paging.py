@@ -0,0 +1,81 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+STUDY_QUERY = [(0x0008, 0x0052, 'QueryRetrieveLevel', 'STUDY'),
+               (0x0020, 0x000D, 'StudyInstanceUID', '')]
+
+
+class TestQidoPaging(unittest.TestCase):
+
+    def setUp(self):
+        # a DICOMweb server with 10 studies, honouring 'limit' and 'offset'
+        self.studies = [{'0020000D': {'vr': 'UI', 'Value': ['1.2.{0}'.format(i)]}} for i in range(10)]
+        self.arguments = []
+
+        def get(uri, body):
+            arguments = json.loads(body)["Arguments"]
+            self.arguments.append(arguments)
+            offset = int(arguments.get("offset", 0))
+            limit = int(arguments.get("limit", len(self.studies)))
+            return json.dumps(self.studies[offset:offset + limit])
+
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get', get)
+
+    def tearDown(self):
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def pages(self, pageSize=0, maxResults=0):
+        return [len(page) for page in proxy.QidoRsPages("PACS", "studies", {}, pageSize=pageSize, maxResults=maxResults)]
+
+    def test_no_paging(self):
+        self.assertEqual([10], self.pages())
+        self.assertEqual([{}], self.arguments)
+
+    def test_pages(self):
+        self.assertEqual([4, 4, 2], self.pages(pageSize=4))
+        self.assertEqual([{"limit": "4"}, {"limit": "4", "offset": "4"}, {"limit": "4", "offset": "8"}], self.arguments)
+
+    def test_last_page_full(self):
+        # a full last page is followed by an empty one
+        self.assertEqual([5, 5, 0], self.pages(pageSize=5))
+
+    def test_empty_body(self):
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get', lambda uri, body: b'')
+        self.assertEqual([0], self.pages(pageSize=5))
+
+    def test_max_results(self):
+        # one more answer than maxResults is requested, to know whether there are too many matches
+        self.assertEqual([4, 3], self.pages(pageSize=4, maxResults=6))
+        self.assertEqual([{"limit": "4"}, {"limit": "3", "offset": "4"}], self.arguments)
+
+        self.arguments = []
+        self.assertEqual([7], self.pages(maxResults=6))
+        self.assertEqual([{"limit": "7"}], self.arguments)
+
+    def test_find_too_many_matches(self):
+        proxy.proxy_configuration = {"QidoPageSize": 4, "QidoMaxResults": 6}
+        answers = orthanc.FindAnswers()
+        proxy.OnFind(answers, orthanc.FindQuery(STUDY_QUERY), 'MODALITY', 'PACS')
+        self.assertEqual(['1.2.{0}'.format(i) for i in range(6)], [json.loads(answer)['0020000D'] for answer in answers.answers])
+        self.assertTrue(answers.incomplete)
+
+    def test_find_max_results_not_reached(self):
+        proxy.proxy_configuration = {"QidoPageSize": 4, "QidoMaxResults": 10}
+        answers = orthanc.FindAnswers()
+        proxy.OnFind(answers, orthanc.FindQuery(STUDY_QUERY), 'MODALITY', 'PACS')
+        self.assertEqual(10, len(answers.answers))
+        self.assertFalse(answers.incomplete)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import pathlib
+import sys
+import threading
+import time
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import proxy
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        proxy.proxy_configuration = {"SchedulerMaxInFlight": 1}
+        self.scheduler = proxy.RequestScheduler()
+
+    def tearDown(self):
+        proxy.proxy_configuration = {}
+
+    def enqueue(self, owner, served):
+        # start a request and wait until it is queued
+        depth = self.scheduler.servers["PACS"].queue_depth
+
+        def request():
+            with self.scheduler.slot("PACS", owner):
+                served.append(owner)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        while self.scheduler.servers["PACS"].queue_depth == depth:
+            time.sleep(0.001)
+        return thread
+
+    def test_round_robin(self):
+        served = []
+        threads = []
+        with self.scheduler.slot("PACS", "large"):
+            for owner in ["large", "large", "large", "small"]:
+                threads.append(self.enqueue(owner, served))
+            self.assertEqual(4, self.scheduler.get_statistics()["PACS"]["queue_depth"])
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(["large", "small", "large", "large"], served)
+        statistics = self.scheduler.get_statistics()["PACS"]
+        self.assertEqual(0, statistics["queue_depth"])
+        self.assertEqual(0, statistics["in_flight"])
+        self.assertEqual(4, statistics["waits"])
+
+    def test_no_limit(self):
+        proxy.proxy_configuration = {}
+        with self.scheduler.slot("PACS", "move"):
+            with self.scheduler.slot("PACS", "move"):
+                pass
+        self.assertEqual({}, self.scheduler.get_statistics())
+
+    def test_adaptive_limit(self):
+        proxy.proxy_configuration = {"SchedulerMaxInFlight": 8, "SchedulerLatencyTarget": 0.01}
+        with self.scheduler.slot("PACS", "move"):
+            time.sleep(0.02)
+        self.assertEqual(4, self.scheduler.get_statistics()["PACS"]["limit"])
+
+        # +1 after a window of 4 fast requests
+        for i in range(4):
+            with self.scheduler.slot("PACS", "move"):
+                pass
+        self.assertEqual(5, self.scheduler.get_statistics()["PACS"]["limit"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import json
+import pathlib
+import sys
+import time
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc, RunMove
+
+
+class LandingSimulatedOrthanc(SimulatedOrthanc):
+    # the instances of a WADO-RS call land in the proxy one after another, and the target is slower than the
+    # DICOMweb server: the chunk is completed while its first instances have already been forwarded and deleted
+
+    def _store_instance(self, sop: str, study: str, size: int):
+        super()._store_instance(sop, study, size)
+        time.sleep(0.002)
+
+    def store(self, uri, body):
+        time.sleep(0.01)
+        return super().store(uri, body)
+
+
+class BulkRejectingSimulatedOrthanc(SimulatedOrthanc):
+    # the DICOMweb server fails the retrievals of several resources at once
+
+    def dicomweb_retrieve(self, uri, body):
+        if len(json.loads(body)["Resources"]) > 1:
+            raise Exception('HTTP status 400 from the DICOMweb server')
+        return super().dicomweb_retrieve(uri, body)
+
+
+class TestRetrieveMode(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = DicomWebStandIn(studies=1, series_per_study=2, instances_per_series=30, instance_size=1024).start()
+        self.simulated = LandingSimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+        self.cleanup_batch_size = proxy.CLEANUP_BATCH_SIZE
+        self.chunk_polling_interval = proxy.CHUNK_POLLING_INTERVAL
+        # the landed instances are forwarded, and deleted, while their chunk is still being retrieved
+        proxy.CLEANUP_BATCH_SIZE = 5
+        proxy.CHUNK_POLLING_INTERVAL = 0.001
+
+    def tearDown(self):
+        proxy.CLEANUP_BATCH_SIZE = self.cleanup_batch_size
+        proxy.CHUNK_POLLING_INTERVAL = self.chunk_polling_interval
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def test_instances_forwarded_while_landing(self):
+        for options in [{"RetrieveMode": "Series"}, {"RetrieveMode": "Chunk", "RetrieveChunkSize": 20}]:
+            self.simulated.install(options)
+            stored = self.simulated.stored_instances
+            self.assertEqual(60, RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0)))
+            self.assertEqual(60, self.simulated.stored_instances - stored)
+            self.assertEqual(0, self.simulated.current_stored_bytes)
+
+
+    def test_bulk_retrieve_failure(self):
+        self.simulated = BulkRejectingSimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+        self.simulated.install({"RetrieveMode": "Chunk", "RetrieveChunkSize": 20})
+        proxy.bulk_retrieve_rejections = proxy.BulkRetrieveRejections()
+        try:
+            self.assertEqual(60, RunMove(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0)))
+            self.assertEqual(60, self.simulated.stored_instances)
+
+            # the status of the Orthanc DICOMweb client is not known: the failure is learnt, for a while only
+            self.assertTrue(proxy.bulk_retrieve_rejections.is_rejected("PACS"))
+            self.assertIsNotNone(proxy.bulk_retrieve_rejections.rejected["PACS"])
+            proxy.bulk_retrieve_rejections.rejected["PACS"] = 0
+            self.assertFalse(proxy.bulk_retrieve_rejections.is_rejected("PACS"))
+        finally:
+            proxy.bulk_retrieve_rejections = proxy.BulkRetrieveRejections()
+
+
+class TestBulkRetrieveRejections(unittest.TestCase):
+
+    def setUp(self):
+        self.rejections = proxy.BulkRetrieveRejections()
+
+    def test_rejection_status(self):
+        self.rejections.learn("PACS", proxy.DicomWebHttpError("PACS", 501, "studies/1.2"))
+        self.assertTrue(self.rejections.is_rejected("PACS"))
+        self.assertIsNone(self.rejections.rejected["PACS"])
+
+    def test_transient_failures(self):
+        # the other failures of a pooled client are not learnt
+        self.rejections.learn("PACS", proxy.DicomWebHttpError("PACS", 503, "studies/1.2"))
+        proxy.dicomweb_clients.get_client = lambda alias: object()
+        try:
+            self.rejections.learn("PACS", TimeoutError("timed out"))
+        finally:
+            del proxy.dicomweb_clients.get_client
+        self.assertFalse(self.rejections.is_rejected("PACS"))
+
+
+if __name__ == '__main__':
+    unittest.main()
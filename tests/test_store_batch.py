@@ -0,0 +1,95 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from dicomweb_standin import DicomWebStandIn
+from harness import SimulatedOrthanc
+
+
+class RejectingSimulatedOrthanc(SimulatedOrthanc):
+    # the target rejects the C-stores that contain a given instance
+
+    def __init__(self, rejected_sop: str):
+        super().__init__()
+        self.rejected_sop = rejected_sop
+        self.store_calls = []
+
+    def store(self, uri, body):
+        resources = json.loads(body)["Resources"]
+        self.store_calls.append(len(resources))
+        if "id-" + self.rejected_sop in resources:
+            raise Exception('C-store rejected by the target')
+        return super().store(uri, body)
+
+
+def RunMoveWithFailures(**request):
+    # as Orthanc does, the failed sub-operations are counted and the move goes on
+    # :return: the number of failed sub-operations
+    request.setdefault("TargetAET", "MODALITY")
+    request.setdefault("OriginatorAET", request["TargetAET"])
+    driver = proxy.CreateMoveCallback(**request)
+    failures = 0
+    try:
+        for i in range(proxy.GetMoveSizeCallback(driver)):
+            try:
+                proxy.ApplyMoveCallback(driver)
+            except Exception:
+                failures += 1
+    finally:
+        proxy.FreeMoveCallback(driver)
+    return failures
+
+
+class TestStoreBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.standin = DicomWebStandIn(studies=1, series_per_study=1, instances_per_series=20, instance_size=1024).start()
+        self.simulated = RejectingSimulatedOrthanc(self.standin.sop_uid(0, 0, 5))
+        self.simulated.add_dicomweb_server("PACS", self.standin.url)
+
+    def tearDown(self):
+        self.standin.stop()
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def test_rejected_instance(self):
+        self.simulated.install()
+        self.assertEqual(1, RunMoveWithFailures(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0)))
+        # the rejected instance is not sent again with the next ones, and it is deleted at the end of the move
+        self.assertEqual([1] * 20, self.simulated.store_calls)
+        self.assertEqual(19, self.simulated.stored_instances)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+
+    def test_rejected_batch(self):
+        self.simulated.install({"StoreBatchSize": 4})
+        # the failure is reported on the last instance of the batch
+        self.assertEqual(1, RunMoveWithFailures(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0)))
+        self.assertEqual([4] * 5, self.simulated.store_calls)
+        self.assertEqual(16, self.simulated.stored_instances)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+
+    def test_canceled_move(self):
+        # the instances buffered when the move is canceled have been reported as completed: they are sent anyway
+        self.simulated.install({"StoreBatchSize": 5})
+        self.simulated.rejected_sop = "none"
+        driver = proxy.CreateMoveCallback(Level="STUDY", SourceAET="PACS", StudyInstanceUID=self.standin.study_uid(0),
+                                          TargetAET="MODALITY", OriginatorAET="MODALITY")
+        proxy.GetMoveSizeCallback(driver)
+        for i in range(8):
+            proxy.ApplyMoveCallback(driver)
+        proxy.FreeMoveCallback(driver)
+        self.assertEqual([5, 3], self.simulated.store_calls)
+        self.assertEqual(8, self.simulated.stored_instances)
+        self.assertEqual(0, self.simulated.current_stored_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+
+
+class TestStudyPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.listed = []
+
+        def get(uri, body):
+            study = json.loads(body)["Uri"].split('/')[1]
+            self.listed.append(study)
+            return json.dumps([{'0020000D': {'Value': [study]}, '0020000E': {'Value': ['1.2']}, '00080018': {'Value': [study + '.1']}}])
+
+        orthanc.SetRestApiHandler('POST', '/dicom-web/servers/PACS/get', get)
+        proxy.proxy_configuration = {"StudyPrefetchCount": 2, "StudyPrefetchRate": 3}
+        self.prefetcher = proxy.StudyPrefetcher()
+
+    def tearDown(self):
+        self.prefetcher.executor.shutdown(wait=True)
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+
+    def test_listing_is_reused(self):
+        self.prefetcher.prefetch("PACS", ["1", "2"])
+        self.assertEqual([("1", "1.2", "1.1")], self.prefetcher.get_listing("PACS", "1"))
+        self.assertIsNone(self.prefetcher.get_listing("PACS", "3"))
+        self.assertIsNone(self.prefetcher.get_listing("OTHER", "1"))
+
+    def test_rate_limit(self):
+        self.prefetcher.prefetch("PACS", ["1", "2"])
+        self.prefetcher.prefetch("PACS", ["1", "3", "4"])
+        self.prefetcher.executor.shutdown(wait=True)
+        self.assertEqual(["1", "2", "3"], sorted(self.listed))
+
+    def test_disabled(self):
+        self.prefetcher.prefetch("PACS", ["1"])
+        proxy.proxy_configuration["StudyPrefetchCount"] = 0
+        self.assertIsNone(self.prefetcher.get_listing("PACS", "1"))
+
+    def test_expired(self):
+        proxy.proxy_configuration["StudyPrefetchTtl"] = 0
+        self.prefetcher.prefetch("PACS", ["1"])
+        self.assertIsNone(self.prefetcher.get_listing("PACS", "1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
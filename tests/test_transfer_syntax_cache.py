@@ -0,0 +1,85 @@
+import pathlib
+import sys
+import unittest
+
+here = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(here.parent / "benchmarks" / "stub"))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+sys.path.insert(0, str(here.parent))
+
+import orthanc
+import proxy
+from harness import SimulatedOrthanc
+
+JPEG = "1.2.840.10008.1.2.4.50"
+
+
+class TestTransferSyntaxCache(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.failure = None
+
+        def DicomWebRequest(dicomwebServerAlias, route, payloadDict):
+            accept = payloadDict["HttpHeaders"].get("Accept", "")
+            self.requests.append(accept)
+            if self.failure is not None and "transfer-syntax" in accept:
+                raise self.failure
+            return b""
+
+        self.dicomweb_request = proxy.DicomWebRequest
+        self.transfer_syntax_cache = proxy.transfer_syntax_cache
+        self.ttl = proxy.UNDELIVERABLE_TRANSFER_SYNTAXES_TTL
+        proxy.DicomWebRequest = DicomWebRequest
+        proxy.transfer_syntax_cache = proxy.TransferSyntaxCache()
+
+        self.simulated = SimulatedOrthanc()
+        self.simulated.add_dicomweb_server("PACS", "http://localhost:1/dicom-web/")
+
+    def tearDown(self):
+        proxy.DicomWebRequest = self.dicomweb_request
+        proxy.transfer_syntax_cache = self.transfer_syntax_cache
+        proxy.UNDELIVERABLE_TRANSFER_SYNTAXES_TTL = self.ttl
+        orthanc.Reset()
+        proxy.proxy_configuration = {}
+        proxy.dicomweb_clients.configure({})
+
+    def post(self):
+        driver = proxy.MoveDriver({"SourceAET": "PACS", "Level": "STUDY", "StudyInstanceUID": "1.2",
+                                   "TargetAET": "MODALITY", "OriginatorAET": "MODALITY"})
+        try:
+            driver._post_with_transfer_syntaxes("get", {"Uri": "studies/1.2", "HttpHeaders": {}})
+        finally:
+            driver.cleanup()
+        return proxy.transfer_syntax_cache.get_requested("PACS", "modality")
+
+    def install(self, options):
+        options["Modalities"] = {"modality": {"TransferSyntaxes": [JPEG]}}
+        self.simulated.install(options)
+
+    def test_content_negotiation_failure(self):
+        self.install({"HttpPool": True})
+        self.failure = proxy.DicomWebHttpError("PACS", 406, "studies/1.2")
+        self.assertEqual([], self.post())
+        self.assertEqual(2, len(self.requests))
+
+    def test_transient_failure(self):
+        # the request is retried without transfer syntax, but the syntaxes are still requested by the next ones
+        self.install({"HttpPool": True})
+        for failure in [proxy.DicomWebHttpError("PACS", 503, "studies/1.2"), TimeoutError("timed out")]:
+            self.failure = failure
+            self.assertEqual([JPEG], self.post())
+
+    def test_unknown_failure_expires(self):
+        # the Orthanc DICOMweb client does not report the HTTP status: the syntaxes are forgotten for a while only
+        self.install({})
+        self.failure = Exception("Error in the network protocol")
+        self.assertEqual([], self.post())
+
+        proxy.transfer_syntax_cache = proxy.TransferSyntaxCache()
+        proxy.UNDELIVERABLE_TRANSFER_SYNTAXES_TTL = 0
+        self.assertEqual([JPEG], self.post())
+
+
+if __name__ == '__main__':
+    unittest.main()